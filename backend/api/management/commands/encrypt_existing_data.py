@@ -2,7 +2,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 from django.db.models import Q
 from api.models import User, EmergencyAccessLog, EmergencyPIN
-from api.utils.crypto import encryption
+from api.utils.crypto import encryption, is_encrypted, looks_encrypted
 
 class Command(BaseCommand):
     help = 'Encrypt existing unencrypted data in the database'
@@ -139,23 +139,9 @@ class Command(BaseCommand):
     
     def _is_likely_encrypted(self, value):
         """
-        Try to detect if a value is already encrypted.
-        This is a heuristic - encrypted data is base64-encoded and fairly long.
+        Detect a value that is already encrypted.
+
+        Every stored ciphertext starts with the same prefix (see
+        CIPHERTEXT_PREFIXES), so a prefix check replaces decoding the value.
         """
-        if not isinstance(value, str):
-            return False
-            
-        # Encrypted data should be fairly long base64 string
-        import base64
-        import re
-        
-        # Simple heuristic: check if it's a long base64 string
-        if len(value) > 100 and re.match(r'^[A-Za-z0-9_-]+={0,2}$', value):
-            # Try to decode and see if it might be base64
-            try:
-                base64.urlsafe_b64decode(value.encode('ascii'))
-                return True
-            except:
-                pass
-                
-        return False 
\ No newline at end of file
+        return is_encrypted(value) or looks_encrypted(value)
@@ -0,0 +1,112 @@
+import time
+
+from cryptography.fernet import InvalidToken
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import TextField
+from django.db.models.functions import Cast
+
+from api.utils.crypto import encryption
+from api.utils.fields import EncryptedCharField, EncryptedJSONField, EncryptedTextField
+
+ENCRYPTED_FIELDS = (EncryptedCharField, EncryptedTextField, EncryptedJSONField)
+
+
+class Command(BaseCommand):
+    help = 'Rewrite encrypted columns written in an older format with the current ENCRYPTION_ENGINE'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows read and rewritten per transaction',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.0,
+            help='Seconds to pause between batches, to throttle a run on a live database',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count the values that would be rewritten',
+        )
+
+    def handle(self, *args, **options):
+        engine = encryption.engine.name
+        self.stdout.write(f"Re-encrypting with the '{engine}' engine...")
+
+        total = skipped = 0
+        for model in apps.get_models():
+            for field in model._meta.concrete_fields:
+                if isinstance(field, ENCRYPTED_FIELDS):
+                    count, unreadable = self.reencrypt_column(model, field, options)
+                    total += count
+                    skipped += unreadable
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'DRY RUN: {total} values would be re-encrypted'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Re-encrypted {total} values'))
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f'Skipped {skipped} values that could not be decrypted; plaintext rows '
+                f'need encrypt_existing_data, others a key that is no longer configured'
+            ))
+
+    def reencrypt_column(self, model, field, options):
+        """
+        Walk one column in primary key order, rewriting values in other formats.
+
+        Returns the number of values rewritten and the number skipped
+        because they did not decrypt.
+        """
+        label = f"{model._meta.label}.{field.name}"
+        # Cast to a plain text column so the values come back as stored,
+        # without the field's from_db_value decrypting them
+        rows = (model._default_manager.exclude(**{f'{field.name}__isnull': True})
+                .annotate(stored=Cast(field.name, output_field=TextField()))
+                .order_by('pk'))
+
+        count = 0
+        unreadable = []
+        last_pk = None
+        while True:
+            batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            batch = list(batch.values_list('pk', 'stored')[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            rewrites = []
+            for pk, stored in batch:
+                if not stored or not encryption.needs_reencrypt(stored):
+                    continue
+                try:
+                    rewrites.append((pk, encryption.reencrypt(stored)))
+                except (InvalidToken, ValueError):
+                    # Plaintext, or under a key no longer configured; one
+                    # bad row must not stop the rest of the run
+                    unreadable.append(pk)
+            if rewrites and not options['dry_run']:
+                with transaction.atomic():
+                    for pk, ciphertext in rewrites:
+                        # update() skips save(), so auto_now fields and signals are untouched
+                        model._default_manager.filter(pk=pk).update(**{field.name: ciphertext})
+            count += len(rewrites)
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if count:
+            self.stdout.write(f"{label}: {count} values")
+        if unreadable:
+            shown = ', '.join(str(pk) for pk in unreadable[:10])
+            more = f' and {len(unreadable) - 10} more' if len(unreadable) > 10 else ''
+            self.stdout.write(self.style.WARNING(
+                f"{label}: skipped {len(unreadable)} values that do not decrypt (pk {shown}{more})"
+            ))
+        return count, len(unreadable)
@@ -0,0 +1,111 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.models import FaceData
+from services.face_basis import FaceBasis, latest_version
+
+
+class Command(BaseCommand):
+    help = 'Train a versioned PCA face basis over face_data and re-project the stored templates'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--components',
+            type=int,
+            default=64,
+            help='Number of principal components to keep',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Templates streamed from the database per batch',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Threads used to re-project templates',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from sklearn.decomposition import IncrementalPCA
+        except ImportError:
+            raise CommandError('scikit-learn is required to train a face basis')
+
+        components = options['components']
+        chunk_size = max(options['chunk_size'], components)
+        basis_dir = str(settings.FACE_BASIS_DIR)
+        version = latest_version(basis_dir) + 1
+
+        total = FaceData.objects.count()
+        if total < components:
+            raise CommandError(
+                f'Need at least {components} templates to fit {components} components, found {total}'
+            )
+
+        # Fit incrementally so the gallery never has to fit in memory at once
+        self.stdout.write(f"Fitting {components} components over {total} templates...")
+        pca = IncrementalPCA(n_components=components)
+        for _, templates in self._template_batches(chunk_size):
+            # partial_fit needs at least n_components samples per batch, which
+            # only a short final batch can fall below
+            if len(templates) >= components:
+                pca.partial_fit(templates)
+
+        basis = FaceBasis(version, pca.mean_, pca.components_)
+        explained = float(np.sum(pca.explained_variance_ratio_))
+        self.stdout.write(f"Basis v{version} explains {explained:.1%} of the template variance")
+
+        # Store projections before publishing the basis, so that workers
+        # switching to it find the rows already projected
+        workers = max(options['workers'], 1)
+        self.stdout.write(f"Re-projecting templates with {workers} workers...")
+        projected = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Keep only a few batches in flight so memory stays bounded
+            in_flight = deque()
+            for ids, templates in self._template_batches(chunk_size):
+                in_flight.append((ids, executor.submit(basis.project, templates)))
+                if len(in_flight) >= workers * 2:
+                    projected += self._store_projections(version, *in_flight.popleft())
+            while in_flight:
+                projected += self._store_projections(version, *in_flight.popleft())
+
+        path = basis.save(basis_dir)
+        self.stdout.write(self.style.SUCCESS(
+            f"Published face basis v{version} to {path} ({projected} templates re-projected)"
+        ))
+
+    def _store_projections(self, version, ids, future):
+        projections = future.result()
+        with transaction.atomic():
+            FaceData.objects.bulk_update(
+                [
+                    FaceData(id=row_id, projection=projection.tobytes(), basis_version=version)
+                    for row_id, projection in zip(ids, projections)
+                ],
+                ['projection', 'basis_version'],
+            )
+        return len(ids)
+
+    def _template_batches(self, chunk_size):
+        """Stream (ids, templates) batches from face_data in primary key order."""
+        rows = FaceData.objects.order_by('id').values_list('id', 'encoding').iterator(chunk_size=chunk_size)
+        ids = []
+        templates = []
+        for row_id, encoding in rows:
+            ids.append(row_id)
+            templates.append(np.frombuffer(encoding, dtype=np.uint8))
+            if len(ids) == chunk_size:
+                yield ids, np.stack(templates).astype(np.float32)
+                ids, templates = [], []
+        if ids:
+            yield ids, np.stack(templates).astype(np.float32)
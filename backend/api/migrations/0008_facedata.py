@@ -0,0 +1,52 @@
+# Generated by Django 4.2.10 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_fix_auth_token'),
+    ]
+
+    operations = [
+        # face_data used to be created ad hoc by the enrollment view without a
+        # primary key, so adopt the existing table instead of creating it
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='FaceData',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('user_id', models.TextField()),
+                        ('encoding', models.BinaryField()),
+                    ],
+                    options={
+                        'db_table': 'face_data',
+                        'indexes': [models.Index(fields=['user_id'], name='face_data_user_id_idx')],
+                    },
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    sql="""
+                        CREATE TABLE IF NOT EXISTS face_data (
+                            user_id TEXT,
+                            encoding BYTEA
+                        );
+                        ALTER TABLE face_data ADD COLUMN IF NOT EXISTS id BIGSERIAL PRIMARY KEY;
+                        DELETE FROM face_data WHERE user_id IS NULL OR encoding IS NULL;
+                        ALTER TABLE face_data ALTER COLUMN user_id SET NOT NULL;
+                        ALTER TABLE face_data ALTER COLUMN encoding SET NOT NULL;
+                        CREATE INDEX IF NOT EXISTS face_data_user_id_idx ON face_data (user_id);
+                    """,
+                    reverse_sql="""
+                        DROP INDEX IF EXISTS face_data_user_id_idx;
+                        ALTER TABLE face_data DROP COLUMN IF EXISTS id;
+                        ALTER TABLE face_data ALTER COLUMN user_id DROP NOT NULL;
+                        ALTER TABLE face_data ALTER COLUMN encoding DROP NOT NULL;
+                    """,
+                ),
+            ],
+        ),
+    ]
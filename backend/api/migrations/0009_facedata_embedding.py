@@ -0,0 +1,20 @@
+# Generated by Django 4.2.10 on 2026-10-17 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_facedata'),
+    ]
+
+    operations = [
+        # Left NULL for existing rows; the gallery cache computes and fills
+        # them in the first time it loads those templates
+        migrations.AddField(
+            model_name='facedata',
+            name='embedding',
+            field=models.BinaryField(null=True),
+        ),
+    ]
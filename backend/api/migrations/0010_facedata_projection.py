@@ -0,0 +1,23 @@
+# Generated by Django 4.2.10 on 2026-10-17 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_facedata_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='facedata',
+            name='projection',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='facedata',
+            name='basis_version',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.2.10 on 2026-10-17 18:30
+
+import logging
+
+import api.utils.fields
+from cryptography.fernet import InvalidToken
+from django.db import migrations, models
+from django.db.models.functions import Cast
+
+logger = logging.getLogger(__name__)
+
+BLIND_INDEXES = {
+    'phone_number_bidx': 'phone_number',
+    'license_number_bidx': 'license_number',
+}
+BATCH_SIZE = 500
+
+
+def backfill_blind_indexes(apps, schema_editor):
+    """
+    Compute the new blind index columns for existing users.
+
+    The historical model decrypts every field it loads, so the stored
+    ciphertext is read as plain text and decrypted one value at a time. A
+    value that does not decrypt leaves its index NULL and is logged rather
+    than failing the migration; reencrypt_data reports the same rows.
+    """
+    from api.utils.crypto import encryption
+
+    User = apps.get_model('api', 'User')
+    raw = {f'raw_{source}': Cast(source, models.TextField()) for source in BLIND_INDEXES.values()}
+    rows = User.objects.annotate(**raw).order_by('pk').values_list('pk', *raw)
+    batch = []
+    for pk, *stored in rows.iterator(chunk_size=BATCH_SIZE):
+        indexes = {}
+        for (index, source), value in zip(BLIND_INDEXES.items(), stored):
+            if not value:
+                indexes[index] = None
+                continue
+            try:
+                indexes[index] = encryption.blind_index(encryption.decrypt(value, 'str'))
+            except (InvalidToken, ValueError):
+                indexes[index] = None
+                logger.warning("User %s: %s does not decrypt; %s left empty", pk, source, index)
+        batch.append(User(pk=pk, **indexes))
+        if len(batch) >= BATCH_SIZE:
+            User.objects.bulk_update(batch, list(BLIND_INDEXES))
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, list(BLIND_INDEXES))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_facedata_projection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='phone_number_bidx',
+            field=api.utils.fields.BlindIndexField(blank=True, db_index=True, editable=False, max_length=64, null=True, source='phone_number'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='license_number_bidx',
+            field=api.utils.fields.BlindIndexField(blank=True, db_index=True, editable=False, max_length=64, null=True, source='license_number'),
+        ),
+        migrations.RunPython(backfill_blind_indexes, migrations.RunPython.noop),
+    ]
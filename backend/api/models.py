@@ -5,7 +5,7 @@ from django.utils import timezone
 import secrets
 import hashlib
 import uuid
-from api.utils.fields import EncryptedCharField, EncryptedTextField, EncryptedJSONField
+from api.utils.fields import BlindIndexField, EncryptedCharField, EncryptedTextField, EncryptedJSONField, with_blind_indexes
 
 class User(AbstractUser):
     ROLE_CHOICES = (
@@ -20,18 +20,23 @@ class User(AbstractUser):
     )
 
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default='patient')
-    phone_number = EncryptedCharField(max_length=150, blank=True)  # Increased size to accommodate encrypted data
+    # Encrypted fields are lazy: a user loaded for auth or an emergency view
+    # only decrypts the ones that are actually read
+    phone_number = EncryptedCharField(max_length=150, blank=True, lazy=True)  # Increased size to accommodate encrypted data
+    # Keyed hash for phone_number__blind lookups, kept current on save
+    phone_number_bidx = BlindIndexField(source='phone_number')
     date_of_birth = models.DateField(null=True, blank=True)
     gender = models.CharField(max_length=10, choices=GENDER_CHOICES, blank=True)
     
-    license_number = EncryptedCharField(max_length=150, blank=True)  # Increased size + encrypted
+    license_number = EncryptedCharField(max_length=150, blank=True, lazy=True)  # Increased size + encrypted
+    license_number_bidx = BlindIndexField(source='license_number')
     specialization = models.CharField(max_length=100, blank=True)
-    hospital_name = EncryptedCharField(max_length=250, blank=True)  # Increased size + encrypted
-    location = EncryptedCharField(max_length=250, blank=True)  # Increased size + encrypted
+    hospital_name = EncryptedCharField(max_length=250, blank=True, lazy=True)  # Increased size + encrypted
+    location = EncryptedCharField(max_length=250, blank=True, lazy=True)  # Increased size + encrypted
 
     # Emergency access fields - encrypted for privacy
-    emergency_contacts = EncryptedJSONField(default=list, blank=True)
-    critical_health_info = EncryptedJSONField(default=dict, blank=True)
+    emergency_contacts = EncryptedJSONField(default=list, blank=True, lazy=True)
+    critical_health_info = EncryptedJSONField(default=dict, blank=True, lazy=True)
     emergency_access_enabled = models.BooleanField(default=True)
     emergency_access_expires_at = models.DateTimeField(null=True, blank=True)
 
@@ -42,6 +47,12 @@ class User(AbstractUser):
     def __str__(self):
         return f"{self.get_full_name()} ({self.get_role_display()})"
 
+    def save(self, *args, **kwargs):
+        # Saving phone_number or license_number alone must refresh its index too
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = with_blind_indexes(self, kwargs['update_fields'])
+        super().save(*args, **kwargs)
+
     def has_active_emergency_access(self):
         if not self.emergency_access_enabled:
             return False
@@ -154,3 +165,17 @@ class EmergencyPIN(models.Model):
             user_agent=request.META.get('HTTP_USER_AGENT') if request else None,
             details=details or {}
         )
+
+class FaceData(models.Model):
+    # Kept as free text: enrollment accepts arbitrary client-side user ids
+    user_id = models.TextField()
+    encoding = models.BinaryField()  # 100x100 grayscale template, row-major uint8
+    embedding = models.BinaryField(null=True)  # compact LBP embedding used for matching
+    projection = models.BinaryField(null=True)  # float32 PCA projection onto basis_version
+    basis_version = models.IntegerField(null=True)
+
+    class Meta:
+        db_table = 'face_data'
+        indexes = [
+            models.Index(fields=['user_id'], name='face_data_user_id_idx'),
+        ]
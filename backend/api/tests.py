@@ -1,3 +1,555 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import io
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from cryptography.fernet import Fernet
+from django.apps import apps
+from django.core import serializers
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from api import views
+from api.models import FaceData, User
+from api.utils.crypto import Ciphertext, KeyRing, encryption, is_encrypted
+from api.utils.face_cache import FaceGalleryCache, face_basis_registry
+from api.utils.fields import SERIALIZED_CIPHERTEXT_PREFIX
+from services.face_basis import FaceBasis
+from services.face_executor import FacePoolBusy, FaceWorkPool
+from services.face_matcher import (
+    BATCH_SCORE_ELEMENTS, MATCH_THRESHOLD, FaceGallery, squared_l2_many,
+)
+from services.face_shards import ShardedFaceSearch
+from services.template_budget import select_templates
+from services.template_store import PackedTemplateStore
+
+
+def noisy_templates(base, count, rng, sigma=4.0):
+    """Variations of one 100x100 face: the base crop plus Gaussian pixel noise."""
+    noise = rng.normal(0, sigma, (count,) + base.shape)
+    return list(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+
+def make_encodings(users, rng, templates_per_user=8):
+    """``{user_id: [template, ...]}`` with one random base face per user."""
+    return {
+        user_id: noisy_templates(rng.integers(0, 256, (100, 100)).astype(np.float64),
+                                 templates_per_user, rng)
+        for user_id in users
+    }
+
+
+def smooth_face(rng):
+    """A random 100x100 crop with face-like, low-frequency structure."""
+    noise = rng.integers(0, 256, (100, 100)).astype(np.uint8)
+    face = cv2.GaussianBlur(noise, (0, 0), 3).astype(np.float64)
+    return (face - face.min()) * (255 / (face.max() - face.min()))
+
+
+def reference_identify(encodings_by_user, probe, threshold=MATCH_THRESHOLD):
+    """The original per-template loop FaceGallery.identify replaced."""
+    best_user, best_count = None, 0
+    for user_id, templates in encodings_by_user.items():
+        count = sum(np.mean(cv2.absdiff(probe, template)) < threshold for template in templates)
+        if best_user is None or count > best_count:
+            best_user, best_count = user_id, int(count)
+    return best_user, best_count
+
+
+class FaceGalleryIdentifyTests(SimpleTestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.encodings = make_encodings(["alice", "bob", "carol"], self.rng)
+        self.gallery = FaceGallery.from_encodings(self.encodings)
+
+    def probe_of(self, user_id):
+        return noisy_templates(self.encodings[user_id][0].astype(np.float64), 1, self.rng)[0]
+
+    def test_identify_matches_reference_loop(self):
+        for user_id in self.encodings:
+            probe = self.probe_of(user_id)
+            self.assertEqual(self.gallery.identify(probe), reference_identify(self.encodings, probe))
+            self.assertEqual(self.gallery.identify(probe)[0], user_id)
+
+    def test_unknown_face_matches_nobody(self):
+        stranger = self.rng.integers(0, 256, (100, 100)).astype(np.uint8)
+        _, count = self.gallery.identify(stranger)
+        self.assertEqual(count, 0)
+
+    def test_ties_go_to_earliest_enrolled_user(self):
+        twins = {"first": self.encodings["alice"], "second": self.encodings["alice"]}
+        gallery = FaceGallery.from_encodings(twins)
+        probe = self.probe_of("alice")
+        self.assertEqual(gallery.identify(probe)[0], "first")
+        self.assertEqual(gallery.identify(probe), reference_identify(twins, probe))
+
+    def test_empty_gallery(self):
+        self.assertEqual(FaceGallery().identify(self.probe_of("alice")), (None, 0))
+
+    def test_identify_many_matches_identify(self):
+        probes = np.stack([self.probe_of(user_id) for user_id in ["carol", "alice", "bob", "alice"]])
+        self.assertEqual(self.gallery.identify_many(probes),
+                         [self.gallery.identify(probe) for probe in probes])
+
+    def test_squared_l2_many_matches_per_probe_scores(self):
+        probes = np.stack([self.probe_of(user_id) for user_id in ["carol", "alice"]])
+        rows = np.concatenate([np.stack(templates) for templates in self.encodings.values()])
+        diffs = rows.reshape(1, len(rows), -1) - probes.reshape(len(probes), 1, -1).astype(np.float64)
+        expected = (diffs ** 2).sum(axis=2)
+        # A small budget forces one row per block
+        for max_elements in (1, BATCH_SCORE_ELEMENTS):
+            np.testing.assert_allclose(squared_l2_many(rows, probes, max_elements), expected)
+
+    def test_add_and_remove(self):
+        dave = make_encodings(["dave"], self.rng)["dave"]
+        self.gallery.add("dave", dave)
+        probe = noisy_templates(dave[0].astype(np.float64), 1, self.rng)[0]
+        self.assertEqual(self.gallery.identify(probe)[0], "dave")
+
+        self.gallery.remove("dave")
+        self.assertNotIn("dave", self.gallery)
+        self.assertEqual(self.gallery.identify(probe)[1], 0)
+
+    def test_nearest_users_ranks_by_closest_template(self):
+        probe = self.probe_of("bob")
+        self.assertEqual(self.gallery.nearest_users(probe, 1), ["bob"])
+        self.assertEqual(set(self.gallery.nearest_users(probe, 10)), {"alice", "bob", "carol"})
+        self.assertEqual(FaceGallery().nearest_users(probe, 3), [])
+
+
+class FaceGalleryCoarseTests(SimpleTestCase):
+    """nearest_users on a gallery past the hash prefilter cutoff."""
+
+    def setUp(self):
+        self.rng = np.random.default_rng(3)
+        self.faces = {f"user{i}": smooth_face(self.rng) for i in range(40)}
+        self.encodings = {user_id: noisy_templates(face, 8, self.rng)
+                          for user_id, face in self.faces.items()}
+        self.gallery = FaceGallery.from_encodings(self.encodings)
+        # 320 templates, so shrink the cutoffs rather than the test
+        for name, value in (("COARSE_MIN_ROWS", 64), ("COARSE_SHORTLIST_ROWS", 16)):
+            patcher = mock.patch(f"services.face_matcher.{name}", value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_nearest_users_after_hash_prefilter(self):
+        probe = noisy_templates(self.faces["user23"], 1, self.rng)[0]
+        self.assertEqual(self.gallery.nearest_users(probe, 1), ["user23"])
+
+
+class ShardedFaceSearchTests(SimpleTestCase):
+    """ShardedFaceSearch against FaceGallery on the same gallery as it changes."""
+
+    def setUp(self):
+        self.rng = np.random.default_rng(4)
+        self.encodings = make_encodings(["alice", "bob", "carol", "dave"], self.rng)
+        self.gallery = FaceGallery.from_encodings(self.encodings)
+        self.search = ShardedFaceSearch(2)
+        self.addCleanup(self.search.shutdown)
+        self.search.sync(self.gallery)
+
+    def assertSameAnswers(self, *user_ids):
+        for user_id in user_ids:
+            probe = noisy_templates(self.encodings[user_id][0].astype(np.float64), 1, self.rng)[0]
+            self.assertEqual(self.search.identify(probe), self.gallery.identify(probe))
+            self.assertEqual(self.search.nearest_users(probe, 3), self.gallery.nearest_users(probe, 3))
+
+    def test_full_sync(self):
+        self.assertSameAnswers("alice", "bob", "carol", "dave")
+
+    def test_add_replace_and_remove(self):
+        self.encodings.update(make_encodings(["erin"], self.rng))
+        self.gallery.add("erin", self.encodings["erin"])
+        self.search.sync(self.gallery, ["erin"])
+        self.assertSameAnswers("alice", "erin")
+
+        # alice now ties with bob but moved behind him in the gallery
+        self.encodings["alice"] = self.encodings["bob"]
+        self.gallery.replace("alice", self.encodings["alice"])
+        self.search.sync(self.gallery, ["alice"])
+        self.assertEqual(self.gallery.identify(self.encodings["bob"][0])[0], "bob")
+        self.assertSameAnswers("alice", "bob", "erin")
+
+        self.gallery.remove("bob")
+        self.search.sync(self.gallery, ["bob"])
+        self.assertSameAnswers("alice", "carol", "erin")
+
+    def test_nearest_users_after_hash_prefilter(self):
+        # 4160 templates, past COARSE_MIN_ROWS, so both sides prefilter by hash
+        users = [f"user{index}" for index in range(520)]
+        self.encodings = {
+            user_id: list(self.rng.integers(0, 256, (8, 16, 16), dtype=np.uint8)) for user_id in users
+        }
+        self.gallery = FaceGallery.from_encodings(self.encodings, template_shape=(16, 16))
+        self.search.sync(self.gallery)
+        probes = [noisy_templates(self.encodings[user_id][0].astype(np.float64), 1, self.rng, sigma=40)[0]
+                  for user_id in users[::13]]
+        probes += list(self.rng.integers(0, 256, (20, 16, 16), dtype=np.uint8))
+
+        def assert_same_rankings():
+            for probe in probes:
+                self.assertEqual(self.search.nearest_users(probe, 5), self.gallery.nearest_users(probe, 5))
+
+        assert_same_rankings()
+        self.gallery.replace("user0", self.encodings["user1"])
+        self.gallery.remove("user2")
+        self.search.sync(self.gallery, ["user0", "user2"])
+        assert_same_rankings()
+
+
+class SelectTemplatesTests(SimpleTestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(5)
+        self.face = smooth_face(self.rng)
+
+    def test_exact_repeats_are_dropped_down_to_the_minimum(self):
+        frames = [self.face.astype(np.uint8)] * 12
+        selection = select_templates(frames, max_templates=30, min_templates=4)
+        self.assertEqual(selection.kept, [0, 9, 10, 11])
+        self.assertEqual(selection.duplicates, list(range(1, 9)))
+        self.assertEqual(selection.over_budget, [])
+
+    def test_distinct_frames_are_capped(self):
+        frames = noisy_templates(self.face, 12, self.rng, sigma=10)
+        selection = select_templates(frames, max_templates=5, min_templates=2)
+        self.assertEqual(selection.duplicates, [])
+        self.assertEqual(len(selection.kept), 5)
+        self.assertEqual(selection.kept[0], 0)
+        self.assertEqual(sorted(selection.kept + selection.over_budget), list(range(12)))
+
+    def test_no_frames(self):
+        self.assertEqual(select_templates([]), ([], [], []))
+
+
+class VerifyProbeTests(TestCase):
+    """verify_probe end to end on face_data rows, with face detection bypassed."""
+
+    basis = None
+
+    def setUp(self):
+        self.rng = np.random.default_rng(1)
+        self.faces = {user_id: smooth_face(self.rng) for user_id in ("alice", "bob")}
+        self.cache = FaceGalleryCache()
+        for patcher in (
+            # No Postgres LISTEN/NOTIFY in tests
+            mock.patch.object(FaceGalleryCache, "_start_listener"),
+            mock.patch.object(FaceGalleryCache, "notify"),
+            mock.patch.object(face_basis_registry, "current", return_value=self.basis),
+            mock.patch.object(views, "face_gallery_cache", self.cache),
+            # Probes are passed as ready-made 100x100 crops
+            mock.patch.object(views, "probe_face", lambda face: (face, None)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        for user_id, face in self.faces.items():
+            views.store_face_encodings(user_id, noisy_templates(face, 8, self.rng, sigma=3))
+
+    def test_genuine_probe_is_verified(self):
+        probe = noisy_templates(self.faces["bob"], 1, self.rng, sigma=3)[0]
+        self.assertEqual(views.verify_probe(probe), ({"verified": True, "user_id": "bob"}, 200))
+
+    def test_impostor_probe_is_rejected(self):
+        impostor = noisy_templates(smooth_face(self.rng), 1, self.rng, sigma=3)[0]
+        self.assertEqual(views.verify_probe(impostor), ({"verified": False}, 200))
+
+    def test_reenrollment_replaces_earlier_templates(self):
+        views.store_face_encodings("alice", noisy_templates(self.faces["bob"], 8, self.rng, sigma=3))
+        self.assertEqual(FaceData.objects.filter(user_id="alice").count(), 8)
+        probe = noisy_templates(self.faces["alice"], 1, self.rng, sigma=3)[0]
+        self.assertEqual(views.verify_probe(probe), ({"verified": False}, 200))
+
+    def test_verification_reads_no_rows(self):
+        self.cache.get()
+        probe = noisy_templates(self.faces["bob"], 1, self.rng, sigma=3)[0]
+        with self.assertNumQueries(0):
+            self.assertTrue(views.verify_probe(probe)[0]["verified"])
+
+    def test_genuine_user_left_off_the_shortlist_is_verified(self):
+        probe = noisy_templates(self.faces["bob"], 1, self.rng, sigma=3)[0]
+        with mock.patch.object(self.cache, "_shortlist", return_value=["alice"]):
+            self.assertEqual(views.verify_probe(probe), ({"verified": True, "user_id": "bob"}, 200))
+
+    def test_batch_matches_one_call_per_probe(self):
+        # twin shares alice's face with one template fewer, so a probe of it
+        # matches both and alice wins whenever both are scored
+        views.store_face_encodings("twin", noisy_templates(self.faces["alice"], 7, self.rng, sigma=3))
+        probes = [noisy_templates(self.faces["alice"], 1, self.rng, sigma=3)[0] for _ in range(2)]
+        shortlists = [["twin"], ["alice"]]
+
+        with mock.patch.object(self.cache, "_shortlist", side_effect=shortlists):
+            batch = self.cache.identify_many(probes)
+        with mock.patch.object(self.cache, "_shortlist", side_effect=shortlists):
+            single = [self.cache.identify(probe) for probe in probes]
+        self.assertEqual(batch, single)
+        self.assertEqual(batch, [("twin", 7), ("alice", 8)])
+
+    def test_deleted_user_is_no_longer_verified(self):
+        probe = noisy_templates(self.faces["alice"], 1, self.rng, sigma=3)[0]
+        self.assertTrue(views.verify_probe(probe)[0]["verified"])
+        views.delete_user_data("alice")
+        self.assertEqual(views.verify_probe(probe), ({"verified": False}, 200))
+
+
+class ProjectedVerifyProbeTests(VerifyProbeTests):
+    """The same checks with the resident gallery in PCA projection space."""
+
+    basis = FaceBasis(1, np.full(100 * 100, 128.0),
+                      np.linalg.qr(np.random.default_rng(2).normal(size=(100 * 100, 4)))[0].T)
+
+    def test_face_differing_outside_the_basis_is_rejected(self):
+        # Same projection as bob's face, but far from it pixel for pixel
+        residual = self.rng.normal(0, 60, 100 * 100)
+        residual -= self.basis.components.T @ (self.basis.components @ residual)
+        impostor = self.faces["bob"] + residual.reshape(100, 100)
+        impostor = noisy_templates(impostor, 1, self.rng, sigma=0)[0]
+
+        projected = self.basis.project(np.stack([impostor, self.faces["bob"]]))
+        self.assertLess(np.linalg.norm(projected[0] - projected[1]) / 100, 1)
+        self.assertEqual(views.verify_probe(impostor), ({"verified": False}, 200))
+
+
+class EncryptedJSONFieldTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="alice", emergency_contacts=[{"name": "Bob"}])
+
+    def test_plaintext_shaped_like_ciphertext_is_still_encrypted(self):
+        field = User._meta.get_field("critical_health_info")
+        lookalike = "gAAAAAnot-really-a-token"
+        self.assertNotIsInstance(field.to_python(lookalike), Ciphertext)
+
+        self.user.critical_health_info = field.to_python(lookalike)
+        self.user.full_clean(exclude=["password"])
+        self.user.save()
+        stored = User.objects.values_list("critical_health_info", flat=True).get(pk=self.user.pk)
+        self.assertNotEqual(stored, lookalike)
+        self.assertEqual(encryption.decrypt(stored, "str"), lookalike)
+
+    def test_fixture_round_trip_is_not_encrypted_twice(self):
+        fixture = serializers.serialize("json", [self.user])
+        User.objects.all().delete()
+        for deserialized in serializers.deserialize("json", fixture):
+            deserialized.save()
+        self.assertEqual(User.objects.get(pk=self.user.pk).emergency_contacts, [{"name": "Bob"}])
+
+    def test_fixture_with_bare_tokens_is_not_encrypted_twice(self):
+        # Fixtures dumped before value_to_string tagged its output
+        fixture = serializers.serialize("json", [self.user]).replace(SERIALIZED_CIPHERTEXT_PREFIX, "")
+        User.objects.all().delete()
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as fixture_file:
+            fixture_file.write(fixture)
+            fixture_file.flush()
+            call_command("loaddata", fixture_file.name, verbosity=0)
+        self.assertEqual(User.objects.get(pk=self.user.pk).emergency_contacts, [{"name": "Bob"}])
+
+
+class KeyRotationTests(TestCase):
+    """Rotating ENCRYPTION_KEYS and moving stored values with reencrypt_data."""
+
+    def setUp(self):
+        self.old_key, self.new_key = Fernet.generate_key(), Fernet.generate_key()
+        self.use_keys(self.old_key)
+        self.user = User.objects.create(username="alice", location="Ward 4", emergency_contacts=["Bob"])
+
+    def use_keys(self, *keys):
+        for patcher in (
+            mock.patch.object(encryption, "keyring", KeyRing.from_keys(keys)),
+            mock.patch.object(encryption, "_state", None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stored(self, field):
+        return User.objects.values_list(field, flat=True).get(pk=self.user.pk)
+
+    def reencrypt(self):
+        out = io.StringIO()
+        call_command("reencrypt_data", stdout=out)
+        return out.getvalue()
+
+    def test_values_move_to_the_new_key(self):
+        self.use_keys(self.new_key, self.old_key)
+        self.assertTrue(encryption.needs_reencrypt(self.stored("location")))
+        self.reencrypt()
+
+        self.use_keys(self.new_key)
+        self.assertFalse(encryption.needs_reencrypt(self.stored("location")))
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual((user.location, user.emergency_contacts), ("Ward 4", ["Bob"]))
+
+    def test_blind_lookup_survives_retiring_the_old_key(self):
+        self.user.phone_number = "555-0100"
+        self.user.save()
+        self.use_keys(self.new_key, self.old_key)
+        self.reencrypt()
+        self.use_keys(self.new_key)
+        self.assertEqual(list(User.objects.filter(phone_number__blind="555-0100")), [self.user])
+
+    def test_plaintext_rows_are_skipped_and_reported(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"UPDATE {User._meta.db_table} SET hospital_name = %s", ["St Mary's"])
+        self.use_keys(self.new_key, self.old_key)
+
+        output = self.reencrypt()
+        self.assertIn(f"api.User.hospital_name: skipped 1 values that do not decrypt (pk {self.user.pk})", output)
+        self.assertEqual(self.stored("hospital_name"), "St Mary's")
+        self.assertFalse(encryption.needs_reencrypt(self.stored("location")))
+
+
+class LazyEncryptedFieldTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="alice", phone_number="555-0100",
+                                        critical_health_info={"allergies": ["penicillin"]})
+
+    def stored(self, field):
+        return User.objects.values_list(field, flat=True).get(pk=self.user.pk)
+
+    def test_round_trip_decrypts_on_first_read(self):
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(is_encrypted(user.__dict__["phone_number"]))
+        self.assertEqual(user.phone_number, "555-0100")
+        self.assertEqual(user.critical_health_info, {"allergies": ["penicillin"]})
+        self.assertEqual(user.__dict__["phone_number"], "555-0100")
+
+    def test_in_place_json_change_is_saved(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.critical_health_info["allergies"].append("latex")
+        user.save()
+        self.assertEqual(User.objects.get(pk=self.user.pk).critical_health_info,
+                         {"allergies": ["penicillin", "latex"]})
+
+    def test_untouched_values_are_saved_as_loaded(self):
+        before = {field: self.stored(field) for field in ("phone_number", "critical_health_info")}
+        user = User.objects.get(pk=self.user.pk)
+        user.save()
+        # Read but unchanged is written back as loaded too
+        self.assertEqual(user.phone_number, "555-0100")
+        user.critical_health_info
+        user.save()
+        self.assertEqual({field: self.stored(field) for field in before}, before)
+
+
+class BlindIndexTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="alice", phone_number="555-0100")
+
+    def test_lookup_by_value(self):
+        self.assertEqual(list(User.objects.filter(phone_number__blind="555-0100")), [self.user])
+        self.assertEqual(list(User.objects.filter(phone_number__blind=" 555-0100 ")), [self.user])
+        self.assertFalse(User.objects.filter(phone_number__blind="555-0199").exists())
+        self.assertFalse(User.objects.filter(license_number__blind="555-0100").exists())
+
+    def test_save_with_update_fields_refreshes_the_index(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.phone_number = "555-0199"
+        user.save(update_fields=["phone_number"])
+        self.assertEqual(list(User.objects.filter(phone_number__blind="555-0199")), [self.user])
+        self.assertFalse(User.objects.filter(phone_number__blind="555-0100").exists())
+
+    def test_untouched_source_keeps_its_index(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.save(update_fields=["phone_number", "first_name"])
+        self.assertEqual(list(User.objects.filter(phone_number__blind="555-0100")), [self.user])
+
+    def test_backfill_leaves_undecryptable_values_unindexed(self):
+        other = User.objects.create(username="bob", phone_number="555-0101", license_number="L-1")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {User._meta.db_table} SET phone_number_bidx = NULL, license_number_bidx = NULL"
+            )
+            cursor.execute(
+                f"UPDATE {User._meta.db_table} SET phone_number = %s WHERE id = %s",
+                ["gAAAAAnot-really-a-token", other.pk],
+            )
+        migration = importlib.import_module("api.migrations.0011_user_blind_indexes")
+        with self.assertLogs(migration.__name__, "WARNING") as logs:
+            migration.backfill_blind_indexes(apps, None)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn(f"User {other.pk}: phone_number", logs.output[0])
+
+        indexes = {pk: (phone, license) for pk, phone, license
+                   in User.objects.values_list("pk", "phone_number_bidx", "license_number_bidx")}
+        self.assertEqual(indexes[self.user.pk], (encryption.blind_index("555-0100"), None))
+        self.assertEqual(indexes[other.pk], (None, encryption.blind_index("L-1")))
+
+
+class PackedTemplateStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.reader, self.writer = PackedTemplateStore(directory), PackedTemplateStore(directory)
+        self.templates = make_encodings(["alice"], np.random.default_rng(6), templates_per_user=3)["alice"]
+        self.writer.put("alice", self.templates)
+
+    def test_read_racing_another_process_compaction(self):
+        # The reader has the index naming generation 0 but has not mapped it yet
+        self.reader._refresh_index()
+        self.writer.compact()
+        refresh = self.reader._refresh_index
+        calls = []
+
+        def stale_then_fresh():
+            calls.append(None)
+            if len(calls) > 1:
+                refresh()
+
+        with mock.patch.object(self.reader, "_refresh_index", side_effect=stale_then_fresh):
+            np.testing.assert_array_equal(self.reader.get("alice"), np.stack(self.templates))
+
+
+class FaceWorkPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = FaceWorkPool(workers=1, queue_depth=4, timeout=5)
+
+    def test_restart_runs_off_the_event_loop(self):
+        executor = ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        threads = []
+
+        def start():
+            threads.append(threading.current_thread())
+            self.pool._executor = executor
+
+        with mock.patch.object(self.pool, "start", side_effect=start), \
+                mock.patch("services.face_executor._call", lambda method, *args: (method, args)):
+            self.assertEqual(asyncio.run(self.pool.run("extract_face", b"frame")), ("extract_face", (b"frame",)))
+        self.assertNotEqual(threads, [threading.current_thread()])
+
+    def test_broken_pool_does_not_take_down_its_replacement(self):
+        broken, replacement = mock.Mock(), mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool()
+        # Another request replaced the pool after this one picked up the broken one
+        self.pool._executor = replacement
+        self.pool._discard(broken)
+        self.assertIs(self.pool._executor, replacement)
+        replacement.shutdown.assert_not_called()
+
+        self.pool._executor = broken
+        with self.assertRaises(FacePoolBusy):
+            asyncio.run(self.pool.run("extract_face", b"frame"))
+        broken.shutdown.assert_called_once()
+        self.assertIsNone(self.pool._executor)
+        self.assertEqual(self.pool._in_flight, 0)
+
+    def test_task_cancelled_by_a_pool_shutdown_is_busy(self):
+        future = Future()
+        executor = mock.Mock()
+        executor.submit.return_value = future
+        self.pool._executor = executor
+
+        async def verify():
+            task = asyncio.ensure_future(self.pool.run("verify_face", "alice", b"frame"))
+            await asyncio.sleep(0)
+            future.cancel()
+            return await task
+
+        with self.assertRaises(FacePoolBusy):
+            asyncio.run(verify())
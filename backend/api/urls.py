@@ -2,6 +2,7 @@ from django.urls import path
 from .views import (
     enroll_face,
     verify_face,
+    verify_faces_batch,
     delete_face_data,
     generate_emergency_pin,
     verify_emergency_pin,
@@ -14,6 +15,7 @@ from .views import (
 urlpatterns = [
     path('enroll_face/', enroll_face, name='enroll_face'),
     path('verify_face/', verify_face, name='verify_face'),
+    path('verify_face/batch/', verify_faces_batch, name='verify_faces_batch'),
     path('delete_face_data/', delete_face_data, name='delete_face_data'),
     path('emergency-pin/generate/', generate_emergency_pin, name='generate_emergency_pin'),
     path('emergency-pin/verify/', verify_emergency_pin, name='verify_emergency_pin'),
@@ -1,46 +1,319 @@
 import base64
+import functools
+import hashlib
+import hmac
 import os
-from typing import Optional, Union, Any
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Union
 import json
 
-from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from django.conf import settings
 
 
+# Fernet tokens start with the version byte 0x80 and a 64-bit timestamp whose
+# high bytes stay zero until the year 2106, so their text starts with
+# 'gAAAAA'. Values written before the cipher engines were introduced are the
+# base64 of such a token, and so start with 'Z0FBQUFB'.
+FERNET_PREFIX = 'gAAAAA'
+LEGACY_PREFIX = 'Z0FBQUFB'
+AESGCM_PREFIX = 'ag1:'
+CIPHERTEXT_PREFIXES = (FERNET_PREFIX, AESGCM_PREFIX, LEGACY_PREFIX)
+
+
+class Ciphertext(str):
+    """
+    A string that is already encrypted and must be stored as is.
+
+    ``FernetEncryption.encrypt`` returns these, so the encrypted model fields
+    can tell ciphertext from plaintext with an isinstance check instead of a
+    trial decryption.
+    """
+    __slots__ = ()
+
+
+def is_encrypted(value: Any) -> bool:
+    """True for values produced by ``encrypt`` (or wrapped as Ciphertext)."""
+    return isinstance(value, Ciphertext)
+
+
+def looks_encrypted(value: Any) -> bool:
+    """
+    True for strings shaped like a stored value, such as raw column contents.
+
+    Only a prefix is compared; use it for text from the database or a
+    fixture, never to decide whether user input needs encrypting.
+    """
+    return isinstance(value, str) and value.startswith(CIPHERTEXT_PREFIXES)
+
+
+def derive_subkey(key: bytes, info: bytes) -> bytes:
+    """Derive an independent 32-byte key for one purpose from the base64 Fernet key."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=info,
+    ).derive(base64.urlsafe_b64decode(key))
+
+
+class FernetEngine:
+    """Fernet tokens (AES-128-CBC + HMAC-SHA256), stored as their urlsafe base64 text."""
+    name = 'fernet'
+    prefix = FERNET_PREFIX
+
+    def __init__(self, keys: List[bytes]):
+        # Encrypts with the first key and decrypts with any of them
+        self.fernet = MultiFernet([Fernet(key) for key in keys])
+        self.primary = Fernet(keys[0])
+        self.rotated = len(keys) > 1
+
+    def encrypt(self, data: bytes) -> str:
+        return self.fernet.encrypt(data).decode('ascii')
+
+    def decrypt(self, token: str) -> bytes:
+        return self.fernet.decrypt(self._token(token))
+
+    def is_current(self, token: str) -> bool:
+        """True if the value is under the primary key."""
+        if not self.rotated:
+            return True
+        try:
+            self.primary.decrypt(self._token(token))
+            return True
+        except InvalidToken:
+            return False
+
+    def _token(self, token: str) -> bytes:
+        return token.encode('ascii')
+
+
+class LegacyFernetEngine(FernetEngine):
+    """The original format: a Fernet token base64-encoded a second time."""
+    name = 'fernet-legacy'
+    prefix = LEGACY_PREFIX
+
+    def encrypt(self, data: bytes) -> str:
+        return base64.urlsafe_b64encode(self.fernet.encrypt(data)).decode('ascii')
+
+    def _token(self, token: str) -> bytes:
+        return base64.urlsafe_b64decode(token.encode('ascii'))
+
+
+class AESGCMEngine:
+    """
+    AES-256-GCM with a random 96-bit nonce, stored as prefix + base64(nonce + ciphertext).
+
+    The AES key is derived from the Fernet key with HKDF, so one secret
+    serves every engine without reusing key material across algorithms.
+    Values are 12 bytes of nonce and a 16-byte tag longer than the
+    plaintext, against Fernet's 57 bytes plus CBC padding.
+    """
+    name = 'aesgcm'
+    prefix = AESGCM_PREFIX
+
+    def __init__(self, keys: List[bytes]):
+        self.ciphers = [AESGCM(derive_subkey(key, b'healthchain field encryption aes-gcm v1')) for key in keys]
+
+    def encrypt(self, data: bytes) -> str:
+        nonce = os.urandom(12)
+        sealed = self.ciphers[0].encrypt(nonce, data, None)
+        return self.prefix + base64.urlsafe_b64encode(nonce + sealed).decode('ascii').rstrip('=')
+
+    def decrypt(self, token: str, ciphers: Optional[List[AESGCM]] = None) -> bytes:
+        body = token[len(self.prefix):]
+        sealed = base64.urlsafe_b64decode(body + '=' * (-len(body) % 4))
+        for cipher in ciphers or self.ciphers:
+            try:
+                return cipher.decrypt(sealed[:12], sealed[12:], None)
+            except InvalidTag:
+                continue
+        raise InvalidToken
+
+    def is_current(self, token: str) -> bool:
+        """True if the value is under the primary key."""
+        if len(self.ciphers) == 1:
+            return True
+        try:
+            self.decrypt(token, self.ciphers[:1])
+            return True
+        except InvalidToken:
+            return False
+
+
+# Engines new values can be written with, by ENCRYPTION_ENGINE setting
+ENGINES = {engine.name: engine for engine in (FernetEngine, AESGCMEngine)}
+
+# ENCRYPTION_KEYS entries with this prefix are Fernet keys, used as they are
+RAW_KEY_PREFIX = 'fernet:'
+
+
+@functools.lru_cache(maxsize=None)
+def derive_key(password: bytes, salt: bytes) -> bytes:
+    """
+    Stretch a password into a Fernet key with PBKDF2 (100,000 iterations).
+
+    Cached, so each password is derived once per process; a master process
+    that derives before forking hands the result to its workers.
+    """
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=100000,
+    )
+    return base64.urlsafe_b64encode(kdf.derive(password))
+
+
+class KeyRing:
+    """
+    The Fernet keys in use, primary first.
+
+    Secrets come from the ENCRYPTION_KEYS setting. Passwords are stretched
+    with ``derive_key`` the first time the ring is used, not at import;
+    entries written as 'fernet:<key>' are used directly and skip PBKDF2
+    altogether. To rotate, put the new secret first: new values use it,
+    existing ones still decrypt under the others until ``reencrypt_data``
+    has moved them.
+
+    Blind indexes use a separate key from the BLIND_INDEX_KEY setting, which
+    is not part of the rotation: stored indexes are only ever compared, so
+    they stay valid while the keys above come and go.
+    """
+
+    def __init__(self, secrets: Optional[List[str]] = None, salt: Union[str, bytes, None] = None,
+                 keys: Optional[List[bytes]] = None, blind_index_secret: Optional[str] = None):
+        self._secrets = secrets
+        self._salt = salt
+        self._keys = keys
+        self._blind_index_secret = blind_index_secret
+        self._blind_index_key = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_keys(cls, keys: List[bytes], blind_index_secret: Optional[str] = None) -> 'KeyRing':
+        """A ring of ready Fernet keys, which needs no derivation."""
+        return cls(keys=list(keys), blind_index_secret=blind_index_secret)
+
+    @property
+    def keys(self) -> List[bytes]:
+        if self._keys is None:
+            with self._lock:
+                if self._keys is None:
+                    self._keys = [self._resolve(secret) for secret in self._configured_secrets()]
+        return self._keys
+
+    @property
+    def blind_index_key(self) -> bytes:
+        if self._blind_index_key is None:
+            with self._lock:
+                if self._blind_index_key is None:
+                    self._blind_index_key = self._resolve(self._configured_blind_index_secret())
+        return self._blind_index_key
+
+    def _configured_blind_index_secret(self) -> str:
+        if self._blind_index_secret is not None:
+            return self._blind_index_secret
+        secret = getattr(settings, 'BLIND_INDEX_KEY', None)
+        return secret or getattr(settings, 'ENCRYPTION_KEY', settings.SECRET_KEY)
+
+    def _configured_secrets(self) -> List[str]:
+        if self._secrets is not None:
+            return self._secrets
+        secrets = getattr(settings, 'ENCRYPTION_KEYS', None)
+        return secrets or [getattr(settings, 'ENCRYPTION_KEY', settings.SECRET_KEY)]
+
+    def _resolve(self, secret: str) -> bytes:
+        if secret.startswith(RAW_KEY_PREFIX):
+            return secret[len(RAW_KEY_PREFIX):].encode('ascii')
+        salt = self._salt if self._salt is not None else getattr(settings, 'ENCRYPTION_SALT', b'healthchain_salt')
+        if isinstance(salt, str):
+            salt = salt.encode()
+        return derive_key(secret.encode(), salt)
+
+
+class _CipherState(NamedTuple):
+    engine: Any
+    readers: Dict[str, Any]
+    blind_index_key: bytes
+
+
 class FernetEncryption:
     """
     Utility class for encrypting and decrypting data using Fernet (AES-256).
     
     This implementation uses a key derivation function (PBKDF2) to generate
     a secure encryption key from a password and salt.
+
+    New values are written by the engine named in the ENCRYPTION_ENGINE
+    setting. Decryption picks the engine from the value's prefix, so values
+    written by any engine, including the legacy double-encoded format, stay
+    readable; ``manage.py reencrypt_data`` moves them to the current one.
     """
     
-    def __init__(self, key: Optional[bytes] = None):
+    def __init__(self, key: Optional[bytes] = None, engine: Optional[str] = None,
+                 keyring: Optional[KeyRing] = None):
         """
         Initialize the encryption utility with a key.
         
-        If no key is provided, it will use the SECRET_KEY from Django settings
-        to generate a key using PBKDF2.
+        If no key is provided, the keys come from a KeyRing over the
+        ENCRYPTION_KEYS setting (falling back to ENCRYPTION_KEY, then
+        SECRET_KEY), derived with PBKDF2 on first use. Nothing is derived
+        here, so importing this module stays cheap; call ``warm`` to derive
+        ahead of the first request.
         """
-        if key is None:
-            # Get the secret key from Django settings or use a default
-            password = getattr(settings, 'ENCRYPTION_KEY', settings.SECRET_KEY).encode()
-            salt = getattr(settings, 'ENCRYPTION_SALT', b'healthchain_salt')
-            
-            # Generate a key using PBKDF2
-            kdf = PBKDF2HMAC(
-                algorithm=hashes.SHA256(),
-                length=32,
-                salt=salt,
-                iterations=100000,
-            )
-            key = base64.urlsafe_b64encode(kdf.derive(password))
-        
-        self.fernet = Fernet(key)
+        self.keyring = KeyRing.from_keys([key]) if key is not None else (keyring or KeyRing())
+        self.engine_name = engine
+        self._state = None
+        self._lock = threading.Lock()
+
+    def warm(self) -> None:
+        """Derive the keys and build the engines now rather than on first use."""
+        self._load()
+
+    @property
+    def engine(self):
+        return self._load().engine
+
+    @property
+    def readers(self) -> Dict[str, Any]:
+        return self._load().readers
+
+    @property
+    def fernet(self) -> MultiFernet:
+        return self.readers[FERNET_PREFIX].fernet
+
+    @property
+    def blind_index_key(self) -> bytes:
+        return self._load().blind_index_key
+
+    def _load(self) -> _CipherState:
+        if self._state is None:
+            with self._lock:
+                if self._state is None:
+                    keys = self.keyring.keys
+                    engine = ENGINES[self.engine_name or getattr(settings, 'ENCRYPTION_ENGINE', 'fernet')](keys)
+                    self._state = _CipherState(
+                        engine=engine,
+                        # Every readable format, by prefix; the current engine is reused
+                        readers={
+                            engine_class.prefix: engine if type(engine) is engine_class else engine_class(keys)
+                            for engine_class in (FernetEngine, AESGCMEngine, LegacyFernetEngine)
+                        },
+                        # A subkey, so an index never reveals the key it came
+                        # from; that key is not rotated, so indexes outlive
+                        # every cipher key
+                        blind_index_key=derive_subkey(self.keyring.blind_index_key,
+                                                      b'healthchain blind index v1'),
+                    )
+        return self._state
     
-    def encrypt(self, data: Union[str, bytes, dict, list, int, float, bool]) -> str:
+    def encrypt(self, data: Union[str, bytes, dict, list, int, float, bool]) -> Ciphertext:
         """
         Encrypt data of various types.
         
@@ -48,7 +321,7 @@ class FernetEncryption:
             data: The data to encrypt (string, bytes, dict, list, or primitive types)
             
         Returns:
-            str: Base64-encoded encrypted data
+            Ciphertext: Encrypted data as text, in the current engine's format
         """
         if isinstance(data, bytes):
             # Already bytes, just encrypt
@@ -60,28 +333,20 @@ class FernetEncryption:
             # For other types (dict, list, int, etc.), convert to JSON string first
             serialized_data = json.dumps(data).encode('utf-8')
         
-        # Perform encryption
-        encrypted_data = self.fernet.encrypt(serialized_data)
-        
-        # Return as base64 string
-        return base64.urlsafe_b64encode(encrypted_data).decode('ascii')
+        return Ciphertext(self.engine.encrypt(serialized_data))
     
     def decrypt(self, encrypted_data: str, output_type: str = 'auto') -> Any:
         """
         Decrypt data and optionally convert to the specified type.
         
         Args:
-            encrypted_data: Base64-encoded encrypted data
+            encrypted_data: Encrypted data as written by any engine
             output_type: The type to convert the decrypted data to ('str', 'bytes', 'json', or 'auto')
             
         Returns:
             The decrypted data in the specified type
         """
-        # Convert from base64 string to bytes
-        encrypted_bytes = base64.urlsafe_b64decode(encrypted_data.encode('ascii'))
-        
-        # Decrypt the data
-        decrypted_bytes = self.fernet.decrypt(encrypted_bytes)
+        decrypted_bytes = self._reader(encrypted_data).decrypt(encrypted_data)
         
         # Handle output based on requested type
         if output_type == 'bytes':
@@ -101,6 +366,35 @@ class FernetEncryption:
         else:
             raise ValueError(f"Unsupported output_type: {output_type}")
 
+    def blind_index(self, value: Any) -> Optional[str]:
+        """
+        Keyed HMAC-SHA256 of a value, for equality lookups on encrypted columns.
+
+        Unlike the ciphertext it is deterministic, so equal values share an
+        index. Surrounding whitespace is ignored; empty values have none.
+        """
+        if value is None:
+            return None
+        text = (value if isinstance(value, str) else json.dumps(value)).strip()
+        if not text:
+            return None
+        return hmac.new(self.blind_index_key, text.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def needs_reencrypt(self, encrypted_data: str) -> bool:
+        """True if a stored value was written in another engine's format or under an older key."""
+        engine = self.engine
+        return not encrypted_data.startswith(engine.prefix) or not engine.is_current(encrypted_data)
+
+    def reencrypt(self, encrypted_data: str) -> Ciphertext:
+        """Rewrite a stored value with the current engine, keeping its exact bytes."""
+        return self.encrypt(self.decrypt(encrypted_data, 'bytes'))
+
+    def _reader(self, encrypted_data: str):
+        for prefix, engine in self.readers.items():
+            if encrypted_data.startswith(prefix):
+                return engine
+        raise InvalidToken
+
 
 # Create a singleton instance for easy import
 encryption = FernetEncryption() 
\ No newline at end of file
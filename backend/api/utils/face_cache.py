@@ -0,0 +1,382 @@
+import os
+import select
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import Case, Q, When
+
+from api.models import FaceData
+from services.face_basis import BasisRegistry, FaceBasis
+from services.face_embedding import EMBEDDING_DIM, embed_faces
+from services.face_matcher import MATCH_THRESHOLD, FaceGallery
+from services.face_shards import ShardedFaceSearch
+
+
+def connect():
+    """
+    Open a dedicated connection with the same parameters as the ORM.
+
+    Only the listener uses this; LISTEN needs a long-lived autocommit
+    connection that Django's per-request connection handling would close.
+    """
+    return psycopg2.connect(**connection.get_connection_params())
+
+
+def decode_encoding(encoding) -> np.ndarray:
+    """Turn a stored BYTEA template back into a 100x100 grayscale image."""
+    return np.frombuffer(encoding, dtype=np.uint8).reshape(100, 100)
+
+
+def decode_vector(vector, basis: Optional[FaceBasis]) -> np.ndarray:
+    """Turn a stored BYTEA embedding (or projection, when a basis is active) back into a vector."""
+    return np.frombuffer(vector, dtype=np.float32 if basis is not None else np.uint8)
+
+
+def gallery_vectors(templates, basis: Optional[FaceBasis]) -> np.ndarray:
+    """
+    Map templates into the space the gallery matches in.
+
+    That is the PCA projection of the newest trained basis when there is one,
+    and the LBP embedding otherwise.
+    """
+    if basis is not None:
+        return basis.project(templates)
+    return embed_faces(templates)
+
+
+def new_gallery(basis: Optional[FaceBasis]) -> FaceGallery:
+    """Create an empty gallery for the given matching space."""
+    if basis is not None:
+        return FaceGallery(template_shape=(basis.dim,), dtype=np.float32,
+                           metric="rms", rms_length=basis.template_dim)
+    return FaceGallery(template_shape=(EMBEDDING_DIM,))
+
+
+# Newest projection basis published by the train_face_basis command
+face_basis_registry = BasisRegistry(str(settings.FACE_BASIS_DIR))
+
+# Matching full templates a probe needs for its user to be verified
+VERIFY_MIN_MATCHES = 6
+
+
+class FaceGalleryCache:
+    """
+    Process-wide, warm copy of the face_data table.
+
+    Two galleries are kept resident: the full 100x100 templates, and
+    compact vectors of the same rows (LBP embeddings, or PCA projections
+    once a basis has been trained). The compact vectors only shortlist the
+    FACE_VERIFY_CANDIDATES nearest users for a probe; whether it matches
+    is decided on those users' full templates, and a probe none of them
+    matches is scored against every template, so the shortlist never
+    costs recall.
+
+    The gallery is loaded once per worker and then kept up to date
+    incrementally: local enrollments and deletions are applied directly, and
+    changes made by other workers arrive through Postgres ``LISTEN/NOTIFY``
+    on ``CHANNEL``. In the steady state a verification reads no rows.
+
+    If the listener loses its connection, notifications may have been
+    missed, so the cache is marked stale and fully reloaded on next use.
+    A newly published basis also triggers a reload, in the new space.
+
+    With ``FACE_SEARCH_SHARDS`` set, the shortlist is searched across that
+    many local shard processes instead (see ShardedFaceSearch). Users
+    changed since the last query have their shards republished first.
+    """
+
+    CHANNEL = "face_data_changed"
+    RECONNECT_DELAY = 5  # seconds between listener reconnect attempts
+    POLL_TIMEOUT = 30  # seconds to block in select() before re-checking
+    LOAD_CHUNK_SIZE = 2000  # rows per server-side cursor fetch on full loads
+
+    def __init__(self):
+        # (gallery, basis, templates) is swapped as one tuple so a probe is
+        # always mapped into the same space as the gallery it is scored
+        # against, and the full templates belong to the same load
+        self._resident = None
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listening = threading.Event()
+        # Identifies this process in notification payloads so it can skip
+        # the changes it already applied itself
+        self._token = uuid.uuid4().hex
+        self._pid = os.getpid()
+        self.version = 0
+        self._shards = None
+        self._shard_lock = threading.Lock()
+        # Gallery last published to the shards, and users changed since
+        self._shard_gallery = None
+        self._shard_changes = set()
+
+    def warm(self) -> None:
+        """
+        Load the gallery ahead of the first request; errors are deferred to first use.
+
+        The ORM connection the load opened is closed again. Under a preloading
+        server this runs in the master, and a connection kept open for
+        CONN_MAX_AGE would otherwise be inherited, and shared, by every
+        forked worker.
+        """
+        try:
+            self.get()
+        except Exception as e:
+            print(f"Error warming face gallery cache: {str(e)}")
+        finally:
+            connections.close_all()
+
+    def get(self) -> Tuple[FaceGallery, Optional[FaceBasis], FaceGallery]:
+        """
+        Return the resident gallery, the basis it was built with and the
+        full-template gallery, loading them if needed.
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+        basis = face_basis_registry.current()
+        resident = self._resident
+        if resident is not None and resident[1] is basis:
+            return resident
+        with self._lock:
+            resident = self._resident
+            if resident is None or resident[1] is not basis:
+                self._start_listener()
+                gallery, templates = self._load_all(basis)
+                resident = (gallery, basis, templates)
+                self._resident = resident
+                self.version += 1
+            return resident
+
+    def identify(self, face: np.ndarray) -> Tuple[Optional[str], int]:
+        """
+        Find the enrolled user with the most templates matching a 100x100 probe.
+
+        The compact gallery shortlists the nearest users and their full
+        templates are matched first, ties going to the nearer user. A
+        shortlisted user with VERIFY_MIN_MATCHES matches is returned as is;
+        otherwise every template is scored, as ``FaceGallery.identify``.
+        """
+        return self.identify_many([face])[0]
+
+    def identify_many(self, faces: List[np.ndarray]) -> List[Tuple[Optional[str], int]]:
+        """
+        ``identify`` for a batch of probes.
+
+        Each probe is matched on its own shortlist only, so a batch returns
+        exactly what one ``identify`` call per probe would.
+        """
+        if not faces:
+            return []
+        gallery, basis, templates = self.get()
+        results = [
+            templates.identify_among(face, self._shortlist(gallery, probe), MATCH_THRESHOLD)
+            for face, probe in zip(faces, gallery_vectors(np.stack(faces), basis))
+        ]
+
+        # The shortlist ranks on compact vectors only, so a genuine user it
+        # left out is still found by scoring every template
+        missed = [index for index, (_, count) in enumerate(results) if count < VERIFY_MIN_MATCHES]
+        if missed:
+            exhaustive = templates.identify_many(np.stack([faces[index] for index in missed]), MATCH_THRESHOLD)
+            for index, result in zip(missed, exhaustive):
+                results[index] = result
+        return results
+
+    def invalidate(self) -> None:
+        """Drop the resident gallery so the next access reloads it from the database."""
+        with self._lock:
+            self._resident = None
+            self.version += 1
+
+    def apply_enrollment(self, user_id: str, templates) -> None:
+        """Swap a user's templates in the resident gallery for freshly enrolled ones."""
+        resident = self._resident
+        if resident is not None:
+            gallery, basis, full_templates = resident
+            gallery.replace(user_id, gallery_vectors(templates, basis))
+            full_templates.replace(user_id, templates)
+            self._shard_changes.add(user_id)
+            self.version += 1
+
+    def apply_deletion(self, user_id: str) -> None:
+        """Remove a user's templates from the resident gallery."""
+        resident = self._resident
+        if resident is not None:
+            resident[0].remove(user_id)
+            resident[2].remove(user_id)
+            self._shard_changes.add(user_id)
+            self.version += 1
+
+    def notify(self, user_id: str) -> None:
+        """
+        Queue a change notification for the other workers.
+
+        Must be called inside the transaction that wrote the change; Postgres
+        only delivers the notification when that transaction commits.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", (self.CHANNEL, f"{self._token}:{user_id}"))
+
+    def _after_fork(self) -> None:
+        # A gallery inherited from a preloading parent has no listener
+        # thread in this process, so it cannot be trusted to stay current
+        self._lock = threading.Lock()
+        self._listener = None
+        self._resident = None
+        self._token = uuid.uuid4().hex
+        self._pid = os.getpid()
+        # Shard processes belong to the parent
+        self._shards = None
+        self._shard_lock = threading.Lock()
+        self._shard_gallery = None
+        self._shard_changes = set()
+
+    def _shortlist(self, gallery: FaceGallery, probe: np.ndarray) -> List[str]:
+        """Users whose resident vectors are nearest a probe's, nearest first."""
+        if settings.FACE_SEARCH_SHARDS:
+            try:
+                return self._sharded_search(gallery).nearest_users(probe, settings.FACE_VERIFY_CANDIDATES)
+            except Exception as e:
+                # A shard process died; search in-process until it is rebuilt
+                print(f"Error in sharded face search: {str(e)}")
+                self._reset_shards()
+        return gallery.nearest_users(probe, settings.FACE_VERIFY_CANDIDATES)
+
+    def _sharded_search(self, gallery: FaceGallery) -> ShardedFaceSearch:
+        """Return the shard processes, bringing them up to date with the gallery."""
+        with self._shard_lock:
+            if self._shards is None:
+                self._shards = ShardedFaceSearch(settings.FACE_SEARCH_SHARDS)
+            if self._shard_gallery is not gallery:
+                # A full reload replaced the gallery; republish every shard
+                self._shard_changes = set()
+                self._shards.sync(gallery)
+                self._shard_gallery = gallery
+            elif self._shard_changes:
+                changes, self._shard_changes = self._shard_changes, set()
+                self._shards.sync(gallery, changes)
+            return self._shards
+
+    def _reset_shards(self) -> None:
+        with self._shard_lock:
+            if self._shards is not None:
+                self._shards.shutdown()
+            self._shards = None
+            self._shard_gallery = None
+
+    def _load_all(self, basis: Optional[FaceBasis]) -> Tuple[FaceGallery, FaceGallery]:
+        """Load every row as (compact gallery, full-template gallery), in enrollment order."""
+        if basis is None:
+            current = Q(embedding__isnull=False)
+            column, extra = "embedding", {}
+        else:
+            current = Q(basis_version=basis.version, projection__isnull=False)
+            column, extra = "projection", {"basis_version": basis.version}
+
+        # Rows without a stored vector for this space have it computed from
+        # their template here and written back once
+        rows = (
+            FaceData.objects.order_by("id")
+            .annotate(stored_vector=Case(When(current, then=column)))
+            .values_list("id", "user_id", "stored_vector", "encoding")
+            .iterator(chunk_size=self.LOAD_CHUNK_SIZE)
+        )
+        vectors_by_user = {}
+        templates_by_user = {}
+        backfill = []
+        for row_id, user_id, vector, encoding in rows:
+            template = decode_encoding(encoding)
+            if vector is None:
+                vector = gallery_vectors(template, basis)[0]
+                backfill.append(FaceData(id=row_id, **{column: vector.tobytes()}, **extra))
+            else:
+                vector = decode_vector(vector, basis)
+            vectors_by_user.setdefault(user_id, []).append(vector)
+            templates_by_user.setdefault(user_id, []).append(template)
+
+        if backfill:
+            FaceData.objects.bulk_update(backfill, [column, *extra], batch_size=self.LOAD_CHUNK_SIZE)
+
+        gallery = new_gallery(basis)
+        gallery.load(vectors_by_user.items())
+        return gallery, FaceGallery.from_encodings(templates_by_user)
+
+    def _reload_user(self, conn, user_id: str) -> None:
+        # Waits out an initial load in progress, whose snapshot may predate
+        # the change being notified
+        with self._lock:
+            resident = self._resident
+        if resident is None:
+            return
+        gallery, basis, full_templates = resident
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT embedding, projection, basis_version, encoding FROM face_data WHERE user_id = %s",
+            (user_id,)
+        )
+        vectors = []
+        templates = []
+        for embedding, projection, basis_version, encoding in cur:
+            templates.append(decode_encoding(encoding))
+            if basis is None and embedding is not None:
+                vectors.append(decode_vector(embedding, basis))
+            elif basis is not None and projection is not None and basis_version == basis.version:
+                vectors.append(decode_vector(projection, basis))
+            else:
+                vectors.append(gallery_vectors(decode_encoding(encoding), basis)[0])
+        cur.close()
+        gallery.replace(user_id, vectors)
+        full_templates.replace(user_id, templates)
+        self._shard_changes.add(user_id)
+        self.version += 1
+
+    def _start_listener(self) -> None:
+        if self._listener is not None and self._listener.is_alive():
+            return
+        self._listening.clear()
+        self._listener = threading.Thread(target=self._listen, name="face-gallery-listener", daemon=True)
+        self._listener.start()
+        # LISTEN must be in place before the initial load, or changes
+        # committed in between would never reach this worker
+        self._listening.wait(timeout=self.RECONNECT_DELAY)
+
+    def _listen(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {self.CHANNEL}")
+                cur.close()
+                self._listening.set()
+
+                while True:
+                    if select.select([conn], [], [], self.POLL_TIMEOUT) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notification = conn.notifies.pop(0)
+                        token, _, user_id = notification.payload.partition(":")
+                        if token != self._token:
+                            self._reload_user(conn, user_id)
+            except Exception as e:
+                print(f"Face gallery listener error: {str(e)}")
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            # Notifications may have been lost while disconnected
+            self._listening.set()
+            self.invalidate()
+            time.sleep(self.RECONNECT_DELAY)
+
+
+# Create a singleton instance for easy import
+face_gallery_cache = FaceGalleryCache()
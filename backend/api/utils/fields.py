@@ -1,9 +1,95 @@
+import json
+
+from cryptography.fernet import InvalidToken
+from django.core.exceptions import FieldError
 from django.db import models
-from django.conf import settings
-from .crypto import encryption
+from django.db.models.query_utils import DeferredAttribute
+from .crypto import Ciphertext, encryption, is_encrypted, looks_encrypted
+
+# Instance __dict__ key holding, per lazily decrypted field that has been
+# read, the stored ciphertext and a fingerprint of the plaintext it decrypted to
+LOADED_CIPHERTEXT = '_loaded_ciphertext'
+
+# EncryptedJSONField.value_to_string tags the ciphertext it serializes with
+# this. Fixtures dumped before the tag hold bare tokens, which are still
+# taken back as already encrypted when they decrypt under our keys
+SERIALIZED_CIPHERTEXT_PREFIX = 'ciphertext:'
 
 
-class EncryptedTextField(models.TextField):
+class EncryptedAttribute(DeferredAttribute):
+    """
+    Descriptor for encrypted fields declared with ``lazy=True``.
+
+    Rows load with the stored ciphertext in the instance's __dict__; the
+    first read decrypts it and memoizes the plaintext, so fields a request
+    never touches are never decrypted.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if not is_encrypted(value):
+            return value
+        plaintext = self.field.decrypt(value)
+        instance.__dict__[self.field.attname] = plaintext
+        instance.__dict__.setdefault(LOADED_CIPHERTEXT, {})[self.field.attname] = (
+            value, self.field.fingerprint(plaintext)
+        )
+        return plaintext
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class LazyDecryptMixin:
+    """
+    Adds the ``lazy`` option to an encrypted field.
+
+    With ``lazy=True``, from_db_value keeps the ciphertext and the
+    EncryptedAttribute descriptor decrypts on first access. Saving writes
+    the loaded ciphertext back unchanged when the value was never read, or
+    still matches what was read, instead of encrypting it again.
+
+    Lazy fields read through values() or values_list() come back as
+    Ciphertext; pass them to the field's ``decrypt``.
+    """
+
+    def __init__(self, *args, lazy=False, **kwargs):
+        # Not part of deconstruct(): it only changes how instances hold the
+        # value, not the column, so migrations need not know about it
+        self.lazy = lazy
+        super().__init__(*args, **kwargs)
+
+    @property
+    def descriptor_class(self):
+        return EncryptedAttribute if self.lazy else DeferredAttribute
+
+    def decrypt(self, value):
+        return encryption.decrypt(value, 'str')
+
+    def fingerprint(self, value):
+        """Comparable form of a plaintext value, to detect changes before saving."""
+        return value
+
+    def pre_save(self, model_instance, add):
+        if self.lazy and self.attname in model_instance.__dict__:
+            value = model_instance.__dict__[self.attname]
+            if is_encrypted(value):
+                return value
+            loaded = model_instance.__dict__.setdefault(LOADED_CIPHERTEXT, {})
+            fingerprint = self.fingerprint(value)
+            if self.attname in loaded and loaded[self.attname][1] == fingerprint:
+                return loaded[self.attname][0]
+            ciphertext = self.get_prep_value(value)
+            # Remembered too, so saving the instance again reuses it
+            if is_encrypted(ciphertext):
+                loaded[self.attname] = (ciphertext, fingerprint)
+            return ciphertext
+        return super().pre_save(model_instance, add)
+
+
+class EncryptedTextField(LazyDecryptMixin, models.TextField):
     """
     A TextField that encrypts its contents when saving to the database
     and decrypts when retrieving from the database.
@@ -15,41 +101,31 @@ class EncryptedTextField(models.TextField):
 
     def from_db_value(self, value, expression, connection):
         """Convert from database value to Python value"""
-        if value is None:
+        # get_prep_value stores empty strings as they are
+        if value is None or value == '':
             return value
-        return encryption.decrypt(value, 'str')
+        if self.lazy:
+            return Ciphertext(value)
+        return self.decrypt(value)
 
     def to_python(self, value):
         """Convert from serialized value to Python value"""
-        if value is None or not isinstance(value, str) or not value.strip():
-            return value
-        
-        # Check if the value is already decrypted
-        # This is needed because to_python can be called multiple times
-        # during form validation
-        try:
-            # If we can decrypt, it's encrypted
-            encryption.decrypt(value, 'str')
-            return value  # Return encrypted (will be decrypted by from_db_value)
-        except Exception:
-            # If decryption fails, it's likely already decrypted
-            return value
+        # Instances hold plaintext; from_db_value has already decrypted it
+        return value
 
     def get_prep_value(self, value):
         """Prepare value for database query"""
         if value is None or value == '':
             return value
             
-        # Don't encrypt already encrypted values
-        try:
-            encryption.decrypt(value, 'str')
-            return value  # Already encrypted
-        except Exception:
-            # Not encrypted yet, so encrypt
-            return encryption.encrypt(value)
+        # Ciphertext from encryption.encrypt is stored as is; anything else
+        # is plaintext and gets encrypted
+        if is_encrypted(value):
+            return value
+        return encryption.encrypt(value)
 
 
-class EncryptedCharField(models.CharField):
+class EncryptedCharField(LazyDecryptMixin, models.CharField):
     """
     A CharField that encrypts its contents when saving to the database
     and decrypts when retrieving from the database.
@@ -61,35 +137,28 @@ class EncryptedCharField(models.CharField):
 
     def from_db_value(self, value, expression, connection):
         """Convert from database value to Python value"""
-        if value is None:
+        # get_prep_value stores empty strings as they are
+        if value is None or value == '':
             return value
-        return encryption.decrypt(value, 'str')
+        if self.lazy:
+            return Ciphertext(value)
+        return self.decrypt(value)
 
     def to_python(self, value):
         """Convert from serialized value to Python value"""
-        if value is None or not isinstance(value, str) or not value.strip():
-            return value
-            
-        # Check if the value is already decrypted
-        try:
-            encryption.decrypt(value, 'str')
-            return value  # Return encrypted (will be decrypted by from_db_value)
-        except Exception:
-            # If decryption fails, it's likely already decrypted
-            return value
+        # Instances hold plaintext; from_db_value has already decrypted it
+        return value
 
     def get_prep_value(self, value):
         """Prepare value for database query"""
         if value is None or value == '':
             return value
             
-        # Don't encrypt already encrypted values
-        try:
-            encryption.decrypt(value, 'str')
-            return value  # Already encrypted
-        except Exception:
-            # Not encrypted yet, so encrypt
-            return encryption.encrypt(value)
+        # Ciphertext from encryption.encrypt is stored as is; anything else
+        # is plaintext and gets encrypted
+        if is_encrypted(value):
+            return value
+        return encryption.encrypt(value)
 
 
 class EncryptedEmailField(EncryptedCharField):
@@ -111,7 +180,7 @@ class EncryptedEmailField(EncryptedCharField):
         return super().formfield(**defaults)
 
 
-class EncryptedJSONField(models.TextField):
+class EncryptedJSONField(LazyDecryptMixin, models.TextField):
     """
     A TextField that encrypts JSON content when saving to the database
     and decrypts when retrieving from the database.
@@ -121,11 +190,20 @@ class EncryptedJSONField(models.TextField):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    def decrypt(self, value):
+        return encryption.decrypt(value, 'json')
+
+    def fingerprint(self, value):
+        # Dicts and lists can be changed in place, so compare their JSON
+        return json.dumps(value)
+
     def from_db_value(self, value, expression, connection):
         """Convert from database value to Python value"""
         if value is None:
             return value
-        return encryption.decrypt(value, 'json')
+        if self.lazy:
+            return Ciphertext(value)
+        return self.decrypt(value)
 
     def to_python(self, value):
         """Convert from serialized value to Python value"""
@@ -136,28 +214,117 @@ class EncryptedJSONField(models.TextField):
         if isinstance(value, (dict, list)):
             return value
             
-        # Check if the value is already decrypted JSON
+        # value_to_string serializes the ciphertext, so fixtures hand it back
+        # here, tagged or (from older dumps) bare. Forms and full_clean also
+        # pass through, so only a value that decrypts under our keys is kept
+        # as stored; anything else is plaintext and gets encrypted on save
+        if not isinstance(value, str):
+            return value
+        if value.startswith(SERIALIZED_CIPHERTEXT_PREFIX):
+            ciphertext = value[len(SERIALIZED_CIPHERTEXT_PREFIX):]
+        elif looks_encrypted(value):
+            ciphertext = value
+        else:
+            return value
         try:
-            encryption.decrypt(value, 'json')
-            return value  # Return encrypted (will be decrypted by from_db_value)
-        except Exception:
-            # If decryption fails, it might be a JSON string
+            self.decrypt(ciphertext)
+        except (InvalidToken, ValueError):
             return value
+        return Ciphertext(ciphertext)
 
     def get_prep_value(self, value):
         """Prepare value for database query"""
         if value is None:
             return value
             
-        # Don't encrypt already encrypted values
-        try:
-            encryption.decrypt(value, 'json')
-            return value  # Already encrypted
-        except Exception:
-            # Not encrypted yet, so encrypt
-            return encryption.encrypt(value)
+        if is_encrypted(value):
+            return value
+        return encryption.encrypt(value)
             
     def value_to_string(self, obj):
         """Return string value of this field from the passed obj"""
         value = self.value_from_object(obj)
-        return self.get_prep_value(value) 
\ No newline at end of file
+        if value is None:
+            return value
+        return SERIALIZED_CIPHERTEXT_PREFIX + self.get_prep_value(value)
+
+class BlindIndexField(models.CharField):
+    """
+    Keyed HMAC of another encrypted field, for indexed equality lookups.
+
+    Declared next to its source, e.g.
+    ``phone_number_bidx = BlindIndexField(source='phone_number')``, it is
+    recomputed on every save and lets ``phone_number__blind=value`` filter
+    in SQL instead of decrypting every row.
+
+    The index is only written when the model saves it: models with blind
+    indexes pass ``update_fields`` through ``with_blind_indexes`` in their
+    save(). ``QuerySet.update()`` bypasses save() altogether, so it must
+    not be used on a source field; load the instances and save them.
+    """
+    description = "Blind index of an encrypted field"
+
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        kwargs.setdefault('max_length', 64)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('blank', True)
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('db_index', True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        source = model_instance._meta.get_field(self.source)
+        value = model_instance.__dict__.get(source.attname)
+        if is_encrypted(value) and self.attname in model_instance.__dict__:
+            # A lazy source that was never read is unchanged, and so is its index
+            return model_instance.__dict__[self.attname]
+        index = encryption.blind_index(getattr(model_instance, source.attname))
+        setattr(model_instance, self.attname, index)
+        return index
+
+
+def with_blind_indexes(model_instance, update_fields):
+    """
+    ``update_fields`` plus the BlindIndexFields of any source field it lists.
+
+    save() only runs pre_save for the fields it writes, so a save limited to
+    a source field would otherwise leave its index stale.
+    """
+    if update_fields is None:
+        return None
+    update_fields = set(update_fields)
+    for field in model_instance._meta.concrete_fields:
+        if isinstance(field, BlindIndexField) and field.source in update_fields:
+            update_fields.add(field.name)
+    return update_fields
+
+
+class BlindLookup(models.Lookup):
+    """
+    ``<encrypted field>__blind=value``: equality through the field's BlindIndexField.
+    """
+    lookup_name = 'blind'
+    # The value is hashed here, not encrypted by the field's get_prep_value
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        source = self.lhs.target
+        index_field = next(
+            (field for field in source.model._meta.concrete_fields
+             if isinstance(field, BlindIndexField) and field.source == source.name),
+            None,
+        )
+        if index_field is None:
+            raise FieldError(f"{source.model._meta.label}.{source.name} has no BlindIndexField")
+        lhs_sql, lhs_params = compiler.compile(index_field.get_col(self.lhs.alias))
+        return f"{lhs_sql} = %s", [*lhs_params, encryption.blind_index(self.rhs)]
+
+
+for _field_class in (EncryptedCharField, EncryptedTextField, EncryptedJSONField):
+    _field_class.register_lookup(BlindLookup)
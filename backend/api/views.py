@@ -9,10 +9,7 @@ import os
 from dotenv import load_dotenv
 import sys
 import cv2
-import numpy as np
-import psycopg2
-import base64
-from .models import EmergencyPIN, EmergencyAccessLog
+from .models import EmergencyPIN, EmergencyAccessLog, FaceData
 from django.core.mail import send_mail
 from django.conf import settings
 from rest_framework import status
@@ -27,6 +24,13 @@ from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth import authenticate
 from rest_framework.views import APIView
 from django.db import transaction
+from services.face_embedding import embed_faces
+from services.face_detector import face_detectors
+from services.face_decode import decode_gray
+from services.face_pipeline import map_frames
+from services.template_budget import select_templates
+from services.verify_cache import VerificationCache
+from .utils.face_cache import VERIFY_MIN_MATCHES, face_basis_registry, face_gallery_cache
 
 load_dotenv()
 User = get_user_model()
@@ -79,61 +83,88 @@ class CreateUserView(generics.CreateAPIView):
 def health_check(request):
     return Response({"status": "healthy"})
 
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+# Largest number of probes accepted by verify_faces_batch
+MAX_VERIFY_BATCH = 64
+
+# Recent verify_face responses, keyed by frame digest and gallery version,
+# so a client retrying the same frame is answered without a new match
+verify_results = VerificationCache()
 
 def store_face_encodings(user_id, encodings):
-    conn = psycopg2.connect(
-        dbname=os.getenv("DB_NAME"), 
-        user=os.getenv("DB_USER"), 
-        password=os.getenv("DB_PASSWORD"), 
-        host=os.getenv("DB_HOST"), 
-        port=os.getenv("DB_PORT")
-    )
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS face_data (
-            user_id TEXT,
-            encoding BYTEA
-        )
-    """)
-    for encoding in encodings:
-        cur.execute("INSERT INTO face_data (user_id, encoding) VALUES (%s, %s)", (user_id, encoding.tobytes()))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def load_face_encodings():
-    conn = psycopg2.connect(
-        dbname=os.getenv("DB_NAME"), 
-        user=os.getenv("DB_USER"), 
-        password=os.getenv("DB_PASSWORD"), 
-        host=os.getenv("DB_HOST"), 
-        port=os.getenv("DB_PORT")
-    )
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, encoding FROM face_data")
-    data = cur.fetchall()
-    cur.close()
-    conn.close()
-    encodings_by_user = {}
-    for user_id, encoding in data:
-        img = np.frombuffer(encoding, dtype=np.uint8).reshape(100, 100)
-        encodings_by_user.setdefault(user_id, []).append(img)
-    return encodings_by_user
+    """Make ``encodings`` the user's templates, replacing any from an earlier enrollment."""
+    embeddings = embed_faces(encodings)
+    basis = face_basis_registry.current()
+    projections = basis.project(encodings) if basis is not None else [None] * len(encodings)
+    # Swap the rows in one transaction, so the per-enrollment template cap
+    # is also the per-user cap; one multi-row INSERT over the ORM's
+    # persistent connection
+    with transaction.atomic():
+        FaceData.objects.filter(user_id=user_id).delete()
+        FaceData.objects.bulk_create([
+            FaceData(
+                user_id=user_id,
+                encoding=encoding.tobytes(),
+                embedding=embedding.tobytes(),
+                projection=projection.tobytes() if projection is not None else None,
+                basis_version=basis.version if basis is not None else None,
+            )
+            for encoding, embedding, projection in zip(encodings, embeddings, projections)
+        ])
+        face_gallery_cache.notify(user_id)
+    face_gallery_cache.apply_enrollment(user_id, encodings)
 
 def delete_user_data(user_id):
-    conn = psycopg2.connect(
-        dbname=os.getenv("DB_NAME"), 
-        user=os.getenv("DB_USER"), 
-        password=os.getenv("DB_PASSWORD"), 
-        host=os.getenv("DB_HOST"), 
-        port=os.getenv("DB_PORT")
-    )
-    cur = conn.cursor()
-    cur.execute("DELETE FROM face_data WHERE user_id = %s", (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with transaction.atomic():
+        FaceData.objects.filter(user_id=user_id).delete()
+        face_gallery_cache.notify(user_id)
+    face_gallery_cache.apply_deletion(user_id)
+
+def uploaded_bytes(upload):
+    """Contents of an uploaded file; in-memory uploads hand over their buffer rather than re-reading it."""
+    if hasattr(upload.file, "getvalue"):
+        return upload.file.getvalue()
+    return upload.read()
+
+def request_frames(request, field):
+    """
+    Collect the frames sent in ``field``.
+
+    Frames may come as multipart file parts, as a raw ``image/*`` request
+    body (single frame only), or as base64 strings in JSON. Binary frames are
+    handed to the decoder as-is, so they skip the base64 round trip.
+    """
+    if request.content_type.startswith("image/"):
+        return [request.body] if request.body else []
+    if request.FILES:
+        return [uploaded_bytes(upload) for upload in request.FILES.getlist(field)]
+    value = request.data.get(field)
+    if isinstance(value, list):
+        return value
+    return [value] if value else []
+
+def probe_face(img_data):
+    """
+    Decode a frame and crop its first face to 100x100.
+
+    Returns (face, None), or (None, error message) when the frame cannot be
+    decoded or holds no face.
+    """
+    try:
+        frame = decode_gray(img_data)
+    except Exception:
+        return None, "Invalid image data"
+    if frame is None:
+        return None, "Invalid image data"
+    gray = frame.gray
+    faces = face_detectors.detect(gray, 1.3, 5, source_scale=frame.scale)
+    if len(faces) == 0:
+        return None, "No face detected."
+    (x, y, w, h) = faces[0]
+    return cv2.resize(gray[y:y+h, x:x+w], (100, 100)), None
+
+def enrollment_face(img_data):
+    """Decode one enrollment frame and crop its first face, or None if that fails."""
+    return probe_face(img_data)[0]
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -144,29 +175,26 @@ def enroll_face(request):
       "user_id": "example_user",
       "images": ["<base64-image-string>", "<base64-image-string>", ...]
     }
+    or a multipart form with a "user_id" field and one "images" file part
+    per frame.
     """
     user_id = request.data.get("user_id")
-    images = request.data.get("images", [])
+    images = request_frames(request, "images")
     if not user_id or not images:
         return Response({"error": "user_id and images are required"}, status=400)
     
-    encodings = []
-    for img_str in images:
-        try:
-            img_data = base64.b64decode(img_str)
-            np_arr = np.frombuffer(img_data, np.uint8)
-            img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        except Exception as e:
-            continue
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-        if len(faces) > 0:
-            (x, y, w, h) = faces[0]
-            face_img = cv2.resize(gray[y:y+h, x:x+w], (100, 100))
-            encodings.append(face_img)
+    # Frames are decoded and detected in parallel; results keep their order
+    encodings = [face for face in map_frames(enrollment_face, images) if face is not None]
     if encodings:
-        store_face_encodings(user_id, encodings)
-        return Response({"message": f"Enrollment completed for {user_id} with {len(encodings)} images."})
+        # Near-duplicate frames are dropped and the template count capped
+        selection = select_templates(encodings)
+        store_face_encodings(user_id, [encodings[i] for i in selection.kept])
+        return Response({
+            "message": f"Enrollment completed for {user_id} with {len(encodings)} images.",
+            "templates_stored": len(selection.kept),
+            "duplicates_dropped": len(selection.duplicates),
+            "over_budget_dropped": len(selection.over_budget),
+        })
     else:
         return Response({"error": "No face detected in any image."}, status=400)
 
@@ -178,38 +206,73 @@ def verify_face(request):
     {
       "image": "<base64-image-string>"
     }
+    or a multipart form with an "image" file part, or the raw image as the
+    request body with an image/jpeg or image/png content type.
     """
-    image_str = request.data.get("image")
-    if not image_str:
+    images = request_frames(request, "image")
+    if not images:
         return Response({"error": "image is required"}, status=400)
-    try:
-        img_data = base64.b64decode(image_str)
-        np_arr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-    except Exception as e:
-        return Response({"error": "Invalid image data"}, status=400)
-    
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-    if not faces:
-        return Response({"error": "No face detected."}, status=400)
-    
-    (x, y, w, h) = faces[0]
-    face_img = cv2.resize(gray[y:y+h, x:x+w], (100, 100))
-    known_encodings = load_face_encodings()
-    match_counts = {user: 0 for user in known_encodings.keys()}
+    # Read before matching, so a result is never cached under a newer version
+    cache_key = verify_results.key(images[0], None, face_gallery_cache.version)
+    cached = verify_results.get(cache_key)
+    if cached is not None:
+        return Response(*cached)
+    data, status_code = verify_probe(images[0])
+    verify_results.put(cache_key, (data, status_code))
+    return Response(data, status=status_code)
+
+def verify_probe(img_data):
+    """Identify the face in one frame; returns (response data, status code)."""
+    face_img, error = probe_face(img_data)
+    if error:
+        return {"error": error}, 400
     
-    for user_id, encodings in known_encodings.items():
-        for known in encodings:
-            diff = np.mean(cv2.absdiff(face_img, known))
-            if diff < 20:
-                match_counts[user_id] += 1
-    
-    if match_counts:
-        matched_user = max(match_counts, key=match_counts.get)
-        if match_counts[matched_user] > 5:
-            return Response({"verified": True, "user_id": matched_user})
-    return Response({"verified": False})
+    # Shortlist users on the resident gallery vectors, then count each one's
+    # full templates that match the probe pixel for pixel (all users' when
+    # no shortlisted one has enough)
+    matched_user, match_count = face_gallery_cache.identify(face_img)
+    if matched_user is not None and match_count >= VERIFY_MIN_MATCHES:
+        return {"verified": True, "user_id": matched_user}, 200
+    return {"verified": False}, 200
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def verify_faces_batch(request):
+    """
+    Verify a queue of probes in one call.
+
+    Expected JSON payload:
+    {
+      "images": ["<base64-image-string>", "<base64-image-string>", ...]
+    }
+    or a multipart form with one "images" file part per probe.
+
+    Responds with one result per probe, in order, each shaped like the
+    verify_face response or carrying that probe's "error".
+    """
+    images = request_frames(request, "images")
+    if not images:
+        return Response({"error": "images are required"}, status=400)
+    if len(images) > MAX_VERIFY_BATCH:
+        return Response({"error": f"At most {MAX_VERIFY_BATCH} images per batch"}, status=400)
+
+    # Decode and detect in parallel, then score every face against the
+    # gallery as a single (probes x templates) matrix
+    probes = map_frames(probe_face, images)
+    faces = [face for face, error in probes if error is None]
+    matches = iter(face_gallery_cache.identify_many(faces))
+
+    results = []
+    for index, (face, error) in enumerate(probes):
+        if error:
+            results.append({"index": index, "error": error})
+            continue
+        matched_user, match_count = next(matches)
+        if matched_user is not None and match_count >= VERIFY_MIN_MATCHES:
+            results.append({"index": index, "verified": True, "user_id": matched_user})
+        else:
+            results.append({"index": index, "verified": False})
+    return Response({"results": results})
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
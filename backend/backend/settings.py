@@ -91,6 +91,10 @@ DATABASES = {
         'PASSWORD': os.environ.get('DB_PASSWORD'),
         'HOST': os.environ.get('DB_HOST'),
         'PORT': os.environ.get('DB_PORT'),
+        # Keep connections open between requests instead of reconnecting
+        # on every face enrollment/verification
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
@@ -189,6 +193,30 @@ CORS_ALLOW_HEADERS = [
     'expires',
 ]
 
+# Versioned PCA face bases written by `manage.py train_face_basis`
+FACE_BASIS_DIR = os.environ.get('FACE_BASIS_DIR', BASE_DIR / 'face_basis')
+
+# Users the resident face gallery shortlists per probe. Their full
+# templates are compared pixel by pixel first; a probe none of them matches
+# is compared with every template, so this trades speed, never recall
+FACE_VERIFY_CANDIDATES = int(os.environ.get('FACE_VERIFY_CANDIDATES', 5))
+
+# Worker processes the 1:N face search is sharded across in each Django
+# worker; 0 searches in-process
+FACE_SEARCH_SHARDS = int(os.environ.get('FACE_SEARCH_SHARDS', 0))
+
 # Encryption settings
 ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', SECRET_KEY)
-ENCRYPTION_SALT = os.environ.get('ENCRYPTION_SALT', b'healthchain_salt')
\ No newline at end of file
+ENCRYPTION_SALT = os.environ.get('ENCRYPTION_SALT', b'healthchain_salt')
+# Comma-separated keyring, primary first: new values use the first entry,
+# and any entry decrypts. Entries are passwords (stretched with PBKDF2 on
+# first use) or 'fernet:<key>' Fernet keys used as they are
+ENCRYPTION_KEYS = [key for key in os.environ.get('ENCRYPTION_KEYS', '').split(',') if key] or [ENCRYPTION_KEY]
+# Secret behind the blind indexes (password or 'fernet:<key>'). It is kept
+# out of the keyring so rotating ENCRYPTION_KEYS never invalidates them;
+# changing it means recomputing every stored index
+BLIND_INDEX_KEY = os.environ.get('BLIND_INDEX_KEY', ENCRYPTION_KEY)
+
+# Cipher new values are written with: 'fernet' or 'aesgcm'. Values written
+# by any engine, including the old double-encoded Fernet format, stay readable
+ENCRYPTION_ENGINE = os.environ.get('ENCRYPTION_ENGINE', 'fernet')
@@ -14,3 +14,14 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Load the face gallery and detectors, and derive the field encryption keys,
+# when the worker starts instead of on the first login. Under a preloading
+# server this runs once in the master and the workers inherit the keys
+from api.utils.crypto import encryption  # noqa: E402
+from api.utils.face_cache import face_gallery_cache  # noqa: E402
+from services.face_detector import face_detectors  # noqa: E402
+
+encryption.warm()
+face_gallery_cache.warm()
+face_detectors.warm_up()
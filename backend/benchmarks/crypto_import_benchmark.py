@@ -0,0 +1,64 @@
+"""
+Measure what importing the field encryption module costs a process.
+
+Usage (from the backend directory):
+
+    python benchmarks/crypto_import_benchmark.py [--repeat N]
+
+Each run starts a fresh interpreter and times, separately: ``django.setup()``,
+which imports ``api.utils.crypto`` through the models, the first ``encrypt``
+(which derives the keys), and a later ``encrypt`` once they are cached. Key
+derivation used to happen at import, so every manage.py command and worker
+start paid for it inside setup.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, time
+import django
+start = time.perf_counter()
+django.setup()
+from api.utils.crypto import encryption
+imported = time.perf_counter()
+encryption.encrypt("warm-up")
+first = time.perf_counter()
+encryption.encrypt("cached")
+cached = time.perf_counter()
+print(json.dumps({
+    "setup": imported - start,
+    "first_encrypt": first - imported,
+    "cached_encrypt": cached - first,
+}))
+"""
+
+
+def run_once():
+    env = dict(os.environ)
+    env.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+    env.setdefault("SECRET_KEY", "benchmark-secret")
+    output = subprocess.run([sys.executable, "-c", CHILD], cwd=BACKEND_DIR, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to time")
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.repeat)]
+    print(f"{'step':>15} {'median ms':>10} {'min ms':>8}")
+    for step in ("setup", "first_encrypt", "cached_encrypt"):
+        times = [run[step] * 1000 for run in runs]
+        print(f"{step:>15} {statistics.median(times):10.2f} {min(times):8.2f}")
+
+
+if __name__ == "__main__":
+    main()
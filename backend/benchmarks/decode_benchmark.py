@@ -0,0 +1,79 @@
+"""
+Compare the old color decode with the reduced-resolution grayscale decode.
+
+Usage (from the backend directory):
+
+    python benchmarks/decode_benchmark.py [image.jpg ...] [--repeat N]
+
+Without image arguments, synthetic JPEG frames at common camera resolutions
+are used. For each frame it reports the time per decode and the size of the
+decoded frame, for the previous path (IMREAD_COLOR + cvtColor) and for
+``decode_gray``.
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.face_decode import decode_gray, decode_mode  # noqa: E402
+
+SYNTHETIC_SIZES = [(640, 480), (1280, 720), (1920, 1080), (4032, 3024)]
+
+
+def synthetic_frame(width, height):
+    """A smooth random image, which compresses like a camera frame rather than noise."""
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def color_decode(data):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), image.nbytes
+
+
+def gray_decode(data):
+    frame = decode_gray(data)
+    return frame.gray, frame.gray.nbytes
+
+
+def time_decode(decode, data, repeat):
+    decode(data)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        _, nbytes = decode(data)
+    return (time.perf_counter() - start) / repeat * 1000, nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="Encoded images to decode")
+    parser.add_argument("--repeat", type=int, default=20, help="Decodes timed per frame and path")
+    args = parser.parse_args()
+
+    if args.images:
+        frames = []
+        for path in args.images:
+            with open(path, "rb") as f:
+                frames.append((os.path.basename(path), f.read()))
+    else:
+        frames = [(f"{w}x{h}", synthetic_frame(w, h)) for w, h in SYNTHETIC_SIZES]
+
+    print(f"{'frame':>12} {'reduction':>9} {'color ms':>9} {'gray ms':>8} {'speedup':>8} "
+          f"{'color KB':>9} {'gray KB':>8}")
+    for name, data in frames:
+        _, reduction = decode_mode(np.frombuffer(data, np.uint8))
+        color_ms, color_bytes = time_decode(color_decode, data, args.repeat)
+        gray_ms, gray_bytes = time_decode(gray_decode, data, args.repeat)
+        print(f"{name:>12} {'1/' + str(reduction):>9} {color_ms:9.2f} {gray_ms:8.2f} "
+              f"{color_ms / gray_ms:7.1f}x {color_bytes // 1024:9d} {gray_bytes // 1024:8d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -41,6 +41,15 @@ app.add_middleware(
 # Include routers
 app.include_router(face_id.router, prefix="/api/face-id", tags=["face-id"])
 
+@app.on_event("startup")
+async def start_face_workers():
+    # Spawn the face workers up front so the first request doesn't pay for it
+    face_id.face_work_pool.start()
+
+@app.on_event("shutdown")
+async def stop_face_workers():
+    face_id.face_work_pool.shutdown()
+
 @app.get("/")
 async def root():
     return {"message": "Healthcare API is running"}
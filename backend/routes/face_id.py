@@ -1,14 +1,30 @@
-from fastapi import APIRouter, HTTPException, Depends, Header
+import asyncio
+import os
+from fastapi import APIRouter, HTTPException, Depends, Header, File, Form, Request, UploadFile, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 from typing import List, Optional
-from services.face_id_service import FaceIDService
+from services.enrollment_sessions import EnrollmentSessionError, EnrollmentSessions, SessionNotFound
+from services.face_executor import FacePoolBusy, FaceWorkPool
+from services.template_store import PackedTemplateStore
+from services.verify_cache import VerificationCache
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 # We'll use a simplified auth approach for testing
 # from auth.auth_handler import get_current_user
 
 router = APIRouter()
-face_id_service = FaceIDService()
+# Face work runs in worker processes so it never blocks the event loop
+face_work_pool = FaceWorkPool()
+# Progressive enrollment sessions, whose frames are processed in that pool
+enrollment_sessions = EnrollmentSessions(face_work_pool)
+# Results of recent /verify calls, so a resent frame skips the pool entirely
+verify_results = VerificationCache()
+# The workers' template store, read here only to version cached results:
+# any enrollment or reset of a user, from any process, changes its stamp
+gallery_index = PackedTemplateStore(face_work_pool.storage_path)
+
+# Consecutive stream frames that must agree before /verify/stream decides
+STREAM_AGREE_FRAMES = int(os.environ.get("FACE_STREAM_AGREE_FRAMES", 3))
 
 class FaceIDSetupRequest(BaseModel):
     images: List[str]  # List of base64 encoded images
@@ -18,68 +34,354 @@ class FaceIDVerifyRequest(BaseModel):
     image: str  # Base64 encoded image
     user_id: Optional[str] = "test_user_id"  # Default user ID for testing
 
-# Helper function to get user ID from Authorization header for testing
-async def get_user_id(authorization: Optional[str] = Header(None)):
-    if authorization:
-        return "authenticated_user_id"
-    return "test_user_id"
+class FaceIDSessionRequest(BaseModel):
+    user_id: Optional[str] = None
 
-@router.post("/setup")
-async def setup_face_id(request: FaceIDSetupRequest, user_id: str = Depends(get_user_id)):
+def busy_response(error: FacePoolBusy) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"success": False, "message": str(error)},
+        headers={"Retry-After": "1"}
+    )
+
+async def run_face_task(method: str, *args, cache_key=None):
+    """
+    Run a FaceIDService method in the pool and turn its result into a response.
+
+    With a ``cache_key``, a result cached in ``verify_results`` is returned
+    without running the task, and a fresh result is cached under that key.
+    """
     try:
-        if not request.images:
-            return JSONResponse(
-                status_code=400,
-                content={"success": False, "message": "No images provided"}
-            )
-            
-        result = face_id_service.setup_face_id(request.user_id or user_id, request.images)
+        result = verify_results.get(cache_key) if cache_key is not None else None
+        if result is None:
+            result = await face_work_pool.run(method, *args)
+            if cache_key is not None:
+                verify_results.put(cache_key, result)
         if not result["success"]:
             return JSONResponse(
                 status_code=400,
                 content=result
             )
         return result
+    except FacePoolBusy as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"success": False, "message": str(e)}
         )
 
+def verify_cache_key(image, user_id: str):
+    """Key of a verification in ``verify_results``; the version is read before the match runs."""
+    return verify_results.key(image, user_id, gallery_index.version(user_id))
+
+# Helper function to get user ID from Authorization header for testing
+async def get_user_id(authorization: Optional[str] = Header(None)):
+    if authorization:
+        return "authenticated_user_id"
+    return "test_user_id"
+
+@router.post("/setup")
+async def setup_face_id(request: FaceIDSetupRequest, user_id: str = Depends(get_user_id)):
+    if not request.images:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "message": "No images provided"}
+        )
+    return await run_face_task("setup_face_id", request.user_id or user_id, request.images)
+
 @router.post("/verify")
 async def verify_face(request: FaceIDVerifyRequest, user_id: str = Depends(get_user_id)):
-    try:
-        if not request.image:
-            return JSONResponse(
-                status_code=400,
-                content={"success": False, "message": "No image provided"}
-            )
-            
-        result = face_id_service.verify_face(request.user_id or user_id, request.image)
-        if not result["success"]:
-            return JSONResponse(
-                status_code=400,
-                content=result
-            )
-        return result
-    except Exception as e:
+    if not request.image:
         return JSONResponse(
-            status_code=500,
-            content={"success": False, "message": str(e)}
+            status_code=400,
+            content={"success": False, "message": "No image provided"}
         )
+    target = request.user_id or user_id
+    return await run_face_task("verify_face", target, request.image,
+                               cache_key=verify_cache_key(request.image, target))
 
 @router.post("/reset")
 async def reset_face_id(user_id: str = Depends(get_user_id)):
+    return await run_face_task("reset_face_id", user_id)
+
+# Binary upload variants of /setup and /verify. Frames arrive as multipart
+# parts or a raw image body and go to the decoder as bytes, skipping the
+# base64 inflation and the JSON parse of the endpoints above.
+
+@router.post("/setup/upload")
+async def setup_face_id_upload(
+    images: List[UploadFile] = File(...),
+    form_user_id: Optional[str] = Form(None, alias="user_id"),
+    user_id: str = Depends(get_user_id)
+):
+    frames = [await image.read() for image in images]
+    if not any(frames):
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "message": "No images provided"}
+        )
+    return await run_face_task("setup_face_id", form_user_id or user_id, frames)
+
+async def read_image_upload(request: Request, field: str):
+    """
+    Read one frame from a multipart part named ``field`` or a raw image body.
+
+    Returns (image bytes, user_id from the form or query string), or None
+    for any other content type.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get(field)
+        image = await upload.read() if hasattr(upload, "read") else b""
+        return image, form.get("user_id")
+    if content_type.startswith("image/"):
+        return await request.body(), request.query_params.get("user_id")
+    return None
+
+def unsupported_upload_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=415,
+        content={"success": False, "message": "Expected an image body or multipart form"}
+    )
+
+@router.post("/verify/upload")
+async def verify_face_upload(request: Request, user_id: str = Depends(get_user_id)):
+    """
+    Accepts either a multipart form with an ``image`` part (and optional
+    ``user_id`` field), or a raw ``image/jpeg`` / ``image/png`` body with the
+    user passed as a ``user_id`` query parameter.
+    """
+    upload = await read_image_upload(request, "image")
+    if upload is None:
+        return unsupported_upload_response()
+    image, requested_user_id = upload
+
+    if not image:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "message": "No image provided"}
+        )
+    target = requested_user_id or user_id
+    return await run_face_task("verify_face", target, image, cache_key=verify_cache_key(image, target))
+
+# Progressive enrollment: open a session, push frames as they are captured
+# (each is processed while the next one uploads), then finalize to store
+# the faces found.
+
+def session_error_response(error: EnrollmentSessionError) -> JSONResponse:
+    return JSONResponse(
+        status_code=404 if isinstance(error, SessionNotFound) else 400,
+        content={"success": False, "message": str(error)}
+    )
+
+@router.post("/setup/session")
+async def open_enrollment_session(request: Optional[FaceIDSessionRequest] = None,
+                                  user_id: str = Depends(get_user_id)):
+    session_id = enrollment_sessions.open((request.user_id if request else None) or user_id)
+    return {
+        "success": True,
+        "session_id": session_id,
+        "max_frames": enrollment_sessions.max_frames,
+        "expires_in": enrollment_sessions.ttl
+    }
+
+@router.post("/setup/session/{session_id}/frames")
+async def push_enrollment_frame(session_id: str, request: Request):
+    """Add one frame, sent as an ``image`` multipart part or a raw image body."""
+    upload = await read_image_upload(request, "image")
+    if upload is None:
+        return unsupported_upload_response()
+    image, _ = upload
+    if not image:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "message": "No image provided"}
+        )
     try:
-        result = face_id_service.reset_face_id(user_id)
-        if not result["success"]:
-            return JSONResponse(
-                status_code=400,
-                content=result
-            )
-        return result
+        index, _ = enrollment_sessions.push(session_id, image)
+    except EnrollmentSessionError as e:
+        return session_error_response(e)
+    return {"success": True, "session_id": session_id, "frame_index": index}
+
+@router.post("/setup/session/{session_id}/finalize")
+async def finalize_enrollment_session(session_id: str):
+    try:
+        result = await enrollment_sessions.finalize(session_id)
+    except EnrollmentSessionError as e:
+        return session_error_response(e)
+    except FacePoolBusy as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"success": False, "message": str(e)}
-        ) 
\ No newline at end of file
+        )
+    if not result["success"]:
+        return JSONResponse(
+            status_code=400,
+            content=result
+        )
+    return result
+
+@router.delete("/setup/session/{session_id}")
+async def discard_enrollment_session(session_id: str):
+    enrollment_sessions.discard(session_id)
+    return {"success": True, "message": "Enrollment session discarded"}
+
+@router.websocket("/setup/stream")
+async def enrollment_stream(websocket: WebSocket, user_id: Optional[str] = None,
+                            default_user_id: str = Depends(get_user_id)):
+    """
+    Socket variant of the enrollment session.
+
+    Every binary (encoded image) or text (base64) message is a frame and is
+    answered with ``{"type": "frame", "index": ..., "face_detected": ...}``
+    once processed, or with ``{"type": "busy", "index": ...}`` when the face
+    pool had no room for it; the enrollment then fails, and the client
+    should back off and start over. The text message ``finalize`` stores
+    the enrollment, answers with ``{"type": "result", ...}`` and closes the
+    socket. Disconnecting before that discards the session.
+    """
+    await websocket.accept()
+    session_id = enrollment_sessions.open(user_id or default_user_id)
+
+    async def report(index, future):
+        try:
+            face = await asyncio.shield(future)
+        except FacePoolBusy as e:
+            # The client should slow down, not re-aim the camera
+            await websocket.send_json({"type": "busy", "index": index, "success": False, "message": str(e)})
+            return
+        await websocket.send_json({"type": "frame", "index": index, "face_detected": face is not None})
+
+    reports = set()
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            data = message.get("bytes") or message.get("text")
+            if not data:
+                continue
+            if data == "finalize":
+                break
+            try:
+                index, future = enrollment_sessions.push(session_id, data)
+            except EnrollmentSessionError as e:
+                await websocket.send_json({"type": "error", "success": False, "message": str(e)})
+                continue
+            task = asyncio.create_task(report(index, future))
+            reports.add(task)
+            task.add_done_callback(reports.discard)
+
+        try:
+            result = await enrollment_sessions.finalize(session_id)
+        except (EnrollmentSessionError, FacePoolBusy) as e:
+            result = {"success": False, "message": str(e)}
+        # Let every frame report go out before the result
+        await asyncio.gather(*reports, return_exceptions=True)
+        await websocket.send_json({"type": "result", **result})
+        await websocket.close()
+    except WebSocketDisconnect:
+        return
+    finally:
+        for task in reports:
+            task.cancel()
+        enrollment_sessions.discard(session_id)
+
+@router.websocket("/verify/stream")
+async def verify_face_stream(websocket: WebSocket, user_id: Optional[str] = None,
+                             default_user_id: str = Depends(get_user_id)):
+    """
+    Live-camera verification over a WebSocket.
+
+    The client streams frames as binary messages (encoded JPEG/PNG) or text
+    messages (base64). Only one frame is verified at a time; frames arriving
+    while it is in flight are dropped, so a fast camera never builds up a
+    backlog. Each verified frame is answered with a ``{"type": "frame"}``
+    message, and the face box it found is used as the search region for the
+    next one. As soon as STREAM_AGREE_FRAMES consecutive frames with a face
+    agree, a ``{"type": "decision"}`` message is sent and the socket closed.
+    """
+    await websocket.accept()
+    user_id = user_id or default_user_id
+    frames = asyncio.Queue(maxsize=1)
+    busy = False
+    skipped = 0
+
+    async def receive_frames():
+        nonlocal busy, skipped
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            data = message.get("bytes") or message.get("text")
+            if not data:
+                continue
+            if busy:
+                skipped += 1
+                continue
+            busy = True
+            frames.put_nowait(data)
+
+    async def verify_frames():
+        nonlocal busy
+        roi = None
+        streak_verified = None
+        streak = 0
+        processed = 0
+        while True:
+            data = await frames.get()
+            try:
+                result = await face_work_pool.run("verify_frame", user_id, data, roi)
+            except FacePoolBusy as e:
+                await websocket.send_json({"type": "busy", "message": str(e)})
+                continue
+            except Exception as e:
+                await websocket.send_json({"type": "error", "success": False, "message": str(e)})
+                return
+            finally:
+                busy = False
+
+            if not result["success"]:
+                await websocket.send_json({"type": "error", **result})
+                if result["message"] != "Invalid image data":
+                    return
+                continue
+
+            processed += 1
+            roi = result["box"]
+            await websocket.send_json({"type": "frame", **result})
+            if not result["face_detected"]:
+                continue
+
+            if result["verified"] == streak_verified:
+                streak += 1
+            else:
+                streak_verified, streak = result["verified"], 1
+            if streak >= STREAM_AGREE_FRAMES:
+                await websocket.send_json({
+                    "type": "decision",
+                    "verified": streak_verified,
+                    "confidence": result["confidence"],
+                    "frames_processed": processed,
+                    "frames_skipped": skipped
+                })
+                return
+
+    receiver = asyncio.create_task(receive_frames())
+    verifier = asyncio.create_task(verify_frames())
+    try:
+        done, _ = await asyncio.wait({receiver, verifier}, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    except WebSocketDisconnect:
+        return
+    finally:
+        receiver.cancel()
+        verifier.cancel()
+
+    if verifier in done:
+        await websocket.close()
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple, Union
+
+from services.face_executor import FacePoolBusy, FaceWorkPool
+
+logger = logging.getLogger(__name__)
+
+
+class EnrollmentSessionError(Exception):
+    """Raised when a frame or finalize call cannot be applied to a session."""
+
+
+class SessionNotFound(EnrollmentSessionError):
+    """Raised for unknown, expired or already finalized sessions."""
+
+
+class EnrollmentSession:
+    def __init__(self, user_id: str, ttl: float, parallel_frames: int):
+        self.user_id = user_id
+        self.ttl = ttl
+        self.frames: List[asyncio.Future] = []
+        self.finalizing = False
+        # Limits how many of this session's frames occupy the pool at once,
+        # so one client cannot crowd out everybody else
+        self.slots = asyncio.Semaphore(parallel_frames)
+        self.touch()
+
+    def touch(self) -> None:
+        self.expires_at = time.monotonic() + self.ttl
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() > self.expires_at
+
+
+class EnrollmentSessions:
+    """
+    Progressive enrollment: open a session, push frames, finalize.
+
+    Each pushed frame is decoded, detected and cropped in the face pool as
+    soon as it arrives, so processing overlaps the upload of the next frame.
+    Only the 100x100 crops are kept here; finalize waits for any frames still
+    in flight and hands the crops to ``FaceIDService.finalize_enrollment``,
+    which stores them through ``_save_face_data``.
+
+    A frame that cannot be decoded or holds no face resolves to None. A
+    frame the pool could not process (FacePoolBusy, a timeout, a crashed
+    worker) fails instead: finalize re-raises that error and discards the
+    session, so a busy pool reaches the client as backpressure rather than
+    as a frame without a face.
+
+    Sessions live in the memory of the API process and are dropped after
+    ``ttl`` seconds without activity. Limits come from the
+    FACE_ENROLL_SESSION_TTL, FACE_ENROLL_SESSION_MAX_FRAMES and
+    FACE_ENROLL_SESSION_PARALLEL environment variables.
+    """
+
+    def __init__(self, pool: FaceWorkPool, ttl: Optional[float] = None,
+                 max_frames: Optional[int] = None, parallel_frames: Optional[int] = None):
+        self.pool = pool
+        self.ttl = ttl or float(os.environ.get("FACE_ENROLL_SESSION_TTL", 300))
+        self.max_frames = max_frames or int(os.environ.get("FACE_ENROLL_SESSION_MAX_FRAMES", 60))
+        self.parallel_frames = parallel_frames or int(os.environ.get("FACE_ENROLL_SESSION_PARALLEL", 2))
+        self._sessions: Dict[str, EnrollmentSession] = {}
+
+    def open(self, user_id: str) -> str:
+        """Start a session for a user and return its id."""
+        self._expire()
+        session_id = uuid.uuid4().hex
+        self._sessions[session_id] = EnrollmentSession(user_id, self.ttl, self.parallel_frames)
+        return session_id
+
+    def push(self, session_id: str, image_data: Union[str, bytes]) -> Tuple[int, asyncio.Future]:
+        """
+        Queue a frame for processing.
+
+        Returns the frame's index in the session, which sets its place in the
+        eyes-open/eyes-closed split at finalize, and a future resolving to
+        the extracted face (None if the frame had none).
+        """
+        session = self._get(session_id)
+        if session.finalizing:
+            raise EnrollmentSessionError("Session is already being finalized")
+        if len(session.frames) >= self.max_frames:
+            raise EnrollmentSessionError(f"Session is limited to {self.max_frames} frames")
+        session.touch()
+        future = asyncio.ensure_future(self._extract(session, image_data))
+        session.frames.append(future)
+        return len(session.frames) - 1, future
+
+    async def finalize(self, session_id: str) -> Dict:
+        """Wait for the session's frames and store the faces found in them."""
+        session = self._get(session_id)
+        if session.finalizing:
+            raise EnrollmentSessionError("Session is already being finalized")
+        if not session.frames:
+            raise EnrollmentSessionError("No images provided")
+        session.finalizing = True
+        try:
+            faces = await asyncio.gather(*session.frames)
+        except BaseException:
+            # The frames left can no longer make up the enrollment
+            self.discard(session_id)
+            raise
+        try:
+            result = await self.pool.run("finalize_enrollment", session.user_id, faces)
+        except BaseException:
+            session.finalizing = False
+            raise
+        self._sessions.pop(session_id, None)
+        result["frames_received"] = len(faces)
+        result["frames_without_face"] = [i for i, face in enumerate(faces) if face is None]
+        return result
+
+    def discard(self, session_id: str) -> None:
+        """Abandon a session and cancel its frames still in flight."""
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            for future in session.frames:
+                future.cancel()
+
+    def _get(self, session_id: str) -> EnrollmentSession:
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise SessionNotFound("Enrollment session not found or expired")
+        return session
+
+    def _expire(self) -> None:
+        for session_id in [sid for sid, session in self._sessions.items()
+                           if session.expired and not session.finalizing]:
+            self.discard(session_id)
+
+    async def _extract(self, session: EnrollmentSession, image_data: Union[str, bytes]):
+        # extract_face already turns undecodable frames and frames without
+        # a face into None; anything raised here is the pool failing
+        async with session.slots:
+            try:
+                return await self.pool.run("extract_face", image_data)
+            except FacePoolBusy:
+                raise
+            except Exception:
+                logger.exception("Error processing enrollment frame for %s", session.user_id)
+                raise
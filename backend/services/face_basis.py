@@ -0,0 +1,114 @@
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+_ARTIFACT_PATTERN = re.compile(r"^face_basis_v(\d+)\.npy$")
+
+
+def artifact_name(version: int) -> str:
+    return f"face_basis_v{version}.npy"
+
+
+def latest_version(directory: str) -> int:
+    """Return the highest published basis version in a directory, or 0 if none."""
+    if not os.path.isdir(directory):
+        return 0
+    versions = [
+        int(match.group(1))
+        for match in map(_ARTIFACT_PATTERN.match, os.listdir(directory))
+        if match
+    ]
+    return max(versions, default=0)
+
+
+class FaceBasis:
+    """
+    PCA projection basis for 100x100 face templates.
+
+    Stored on disk as a single ``.npy`` array of shape (k + 1, D): the first
+    row is the mean face and the remaining k rows are orthonormal components.
+    Because the components are orthonormal, the L2 distance between two
+    projections is a lower bound on the L2 distance between the templates:
+    whatever two faces differ in outside the basis is invisible to it. So
+    projections only rank candidates; a match is decided on full templates.
+    """
+
+    def __init__(self, version: int, mean: np.ndarray, components: np.ndarray):
+        self.version = version
+        self.mean = np.ascontiguousarray(mean, dtype=np.float32).reshape(-1)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.template_dim = self.mean.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[0]
+
+    def project(self, faces) -> np.ndarray:
+        """Project a stack of templates into the basis, returning (N, k) float32."""
+        rows = np.asarray(faces, dtype=np.float32).reshape(-1, self.template_dim)
+        return (rows - self.mean) @ self.components.T
+
+    def save(self, directory: str) -> str:
+        """Publish the basis as a versioned artifact; the rename makes it visible atomically."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, artifact_name(self.version))
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.vstack([self.mean, self.components]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return path
+
+    @classmethod
+    def load(cls, directory: str, version: int) -> "FaceBasis":
+        data = np.load(os.path.join(directory, artifact_name(version)))
+        return cls(version, data[0], data[1:])
+
+
+class BasisRegistry:
+    """
+    Tracks the newest published basis in a directory.
+
+    The directory is re-scanned at most every ``poll_interval`` seconds, so a
+    freshly trained basis is picked up by running workers without a restart.
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 30.0):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self._basis = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def current(self) -> Optional[FaceBasis]:
+        """Return the newest basis, or None if none has been trained yet."""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.poll_interval:
+            return self._basis
+        with self._lock:
+            if self._checked_at is None or now - self._checked_at >= self.poll_interval:
+                self._refresh()
+                self._checked_at = now
+        return self._basis
+
+    def refresh(self) -> Optional[FaceBasis]:
+        """Re-scan the directory immediately."""
+        with self._lock:
+            self._refresh()
+            self._checked_at = time.monotonic()
+        return self._basis
+
+    def _refresh(self) -> None:
+        version = latest_version(self.directory)
+        if version == 0:
+            self._basis = None
+        elif self._basis is None or self._basis.version != version:
+            try:
+                self._basis = FaceBasis.load(self.directory, version)
+            except Exception as e:
+                print(f"Error loading face basis v{version}: {str(e)}")
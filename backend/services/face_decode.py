@@ -0,0 +1,97 @@
+from typing import NamedTuple, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from services.face_detector import DetectorPool, face_detectors
+from services.face_pipeline import frame_buffer
+
+# libjpeg can scale by 1/2, 1/4 and 1/8 while decoding, in the DCT domain,
+# so the full-resolution frame is never materialized
+REDUCED_GRAYSCALE_MODES = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+# JPEG start-of-frame markers, which carry the image dimensions
+_SOF_MARKERS = frozenset({0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                          0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF})
+# Markers that stand alone, without a length field
+_STANDALONE_MARKERS = frozenset({0x01, *range(0xD0, 0xDA)})
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class Frame(NamedTuple):
+    """A decoded grayscale frame and its size relative to the encoded image."""
+    gray: np.ndarray
+    scale: float
+
+
+def image_size(buffer: np.ndarray) -> Optional[Tuple[str, int, int]]:
+    """
+    Read ``(format, width, height)`` from a JPEG or PNG header without decoding.
+
+    Returns None for other formats or a header that cannot be parsed.
+    """
+    data = memoryview(buffer).cast("B")
+    if bytes(data[:8]) == _PNG_SIGNATURE and len(data) >= 24:
+        return "png", int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if bytes(data[:2]) != b"\xff\xd8":
+        return None
+
+    i = 2
+    while i + 3 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before the marker
+            i += 1
+            continue
+        if marker in _STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker in _SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return "jpeg", width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def decode_mode(buffer: np.ndarray, detectors: DetectorPool = face_detectors) -> Tuple[int, int]:
+    """
+    Choose the ``cv2.imdecode`` flag for an encoded frame.
+
+    Returns ``(flag, reduction)``. JPEGs much larger than the detector needs
+    are decoded at 1/2, 1/4 or 1/8 size, as long as the reduced frame still
+    has at least as many pixels as the detector would keep; everything else
+    is decoded straight to full-size grayscale.
+    """
+    size = image_size(buffer)
+    if size is None or size[0] != "jpeg":
+        return cv2.IMREAD_GRAYSCALE, 1
+
+    _, width, height = size
+    scale = detectors.detection_scale((height, width))
+    for reduction, flag in REDUCED_GRAYSCALE_MODES:
+        if reduction * scale <= 1:
+            return flag, reduction
+    return cv2.IMREAD_GRAYSCALE, 1
+
+
+def decode_gray(image_data: Union[str, bytes], detectors: DetectorPool = face_detectors) -> Optional[Frame]:
+    """
+    Decode an uploaded frame straight to grayscale, at reduced resolution when possible.
+
+    Returns None when the data is not a decodable image.
+    """
+    buffer = frame_buffer(image_data)
+    flag, reduction = decode_mode(buffer, detectors)
+    gray = cv2.imdecode(buffer, flag)
+    if gray is None:
+        return None
+    return Frame(gray, 1.0 / reduction)
@@ -0,0 +1,158 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import cv2
+import numpy as np
+
+CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+
+# Frames whose longer side exceeds this are detected on a downscaled copy;
+# 0 always detects at full resolution
+DETECT_MAX_SIDE = int(os.environ.get("FACE_DETECT_MAX_SIDE", 640))
+
+# Smallest face, in full-resolution pixels, that must stay detectable.
+# Downscaling never goes so far that such a face would shrink below the
+# cascade's own window size
+DETECT_MIN_FACE = int(os.environ.get("FACE_DETECT_MIN_FACE", 80))
+
+# Per-thread scratch image the downscaled copy is resized into, reused as
+# long as consecutive frames have the same size
+_scratch = threading.local()
+
+
+class DetectorPool:
+    """
+    Pool of preloaded Haar cascades shared by the Django and FastAPI paths.
+
+    A CascadeClassifier must not run detections from two threads at once, so
+    every detection checks one out for its exclusive use and returns it
+    afterwards. ``warm_up`` loads ``size`` cascades ahead of the first
+    request; if more threads detect concurrently than that, the pool grows
+    instead of making them wait, so no thread ever blocks on another's
+    detection.
+
+    The pool size defaults to the FACE_DETECTOR_POOL_SIZE environment
+    variable, or the CPU count. Each process (gunicorn worker, face pool
+    worker) holds its own pool; FaceWorkPool workers shrink theirs to
+    their share of the CPUs.
+
+    Large frames are detected on a copy scaled down to at most ``max_side``
+    pixels, and the boxes are mapped back to full resolution, so detection
+    cost stays roughly constant whatever the camera resolution. Faces of at
+    least ``min_face`` pixels are still found.
+    """
+
+    def __init__(self, cascade_path: str = CASCADE_PATH, size: Optional[int] = None,
+                 max_side: int = DETECT_MAX_SIDE, min_face: int = DETECT_MIN_FACE):
+        self.cascade_path = cascade_path
+        self.size = size or int(os.environ.get("FACE_DETECTOR_POOL_SIZE", os.cpu_count() or 1))
+        self.max_side = max_side
+        self.min_face = min_face
+        self._idle = queue.SimpleQueue()
+        self._available = None
+        # Detection window of the cascade, known once one has been loaded
+        self._window = 24
+
+    @property
+    def available(self) -> bool:
+        """Whether the cascade file can be loaded at all."""
+        if self._available is None:
+            self.warm_up(1)
+        return self._available
+
+    def warm_up(self, count: Optional[int] = None) -> None:
+        """Preload cascades until ``count`` (default: the pool size) are idle."""
+        count = self.size if count is None else count
+        while self._idle.qsize() < count:
+            cascade = self._load()
+            if cascade is None:
+                return
+            self._idle.put(cascade)
+
+    @contextmanager
+    def acquire(self) -> Iterator[Optional[cv2.CascadeClassifier]]:
+        """Check out a cascade for exclusive use; yields None if detection is unavailable."""
+        try:
+            cascade = self._idle.get_nowait()
+        except queue.Empty:
+            cascade = self._load() if self._available is not False else None
+        try:
+            yield cascade
+        finally:
+            if cascade is not None:
+                self._idle.put(cascade)
+
+    def detect(self, gray: np.ndarray, scale_factor: float = 1.3, min_neighbors: int = 5,
+               source_scale: float = 1.0):
+        """
+        Run ``detectMultiScale`` on a grayscale image.
+
+        ``source_scale`` is the size of ``gray`` relative to the camera frame
+        when it was already decoded at reduced resolution, so ``min_face``
+        keeps meaning full-resolution pixels.
+
+        Returns (x, y, w, h) boxes in the coordinates of ``gray``, or no
+        faces if detection is unavailable.
+        """
+        scale = self.detection_scale(gray.shape, source_scale)
+        with self.acquire() as cascade:
+            if cascade is None:
+                return ()
+            if scale >= 1:
+                return cascade.detectMultiScale(gray, scale_factor, min_neighbors)
+
+            height, width = gray.shape[:2]
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            small = cv2.resize(gray, size, dst=self._scratch(size), interpolation=cv2.INTER_AREA)
+            faces = cascade.detectMultiScale(small, scale_factor, min_neighbors)
+        if len(faces) == 0:
+            return faces
+
+        # Map the boxes back onto the full-resolution frame
+        ratio = np.array([width / size[0], height / size[1]] * 2)
+        boxes = np.rint(np.asarray(faces, dtype=np.float64) * ratio).astype(np.int32)
+        np.clip(boxes[:, 0], 0, width - 1, out=boxes[:, 0])
+        np.clip(boxes[:, 1], 0, height - 1, out=boxes[:, 1])
+        np.minimum(boxes[:, 2], width - boxes[:, 0], out=boxes[:, 2])
+        np.minimum(boxes[:, 3], height - boxes[:, 1], out=boxes[:, 3])
+        return boxes
+
+    def detection_scale(self, shape, source_scale: float = 1.0) -> float:
+        """Factor a frame of ``shape`` is shrunk by before detection (1 keeps full resolution)."""
+        longest = max(shape[:2])
+        if not self.max_side or longest <= self.max_side:
+            return 1.0
+        scale = self.max_side / longest
+        if self.min_face:
+            # Keep min_face-sized faces at least as large as the detection window
+            scale = max(scale, self._window / (self.min_face * source_scale))
+        return min(scale, 1.0)
+
+    @staticmethod
+    def _scratch(size) -> np.ndarray:
+        width, height = size
+        buffer = getattr(_scratch, "image", None)
+        if buffer is None or buffer.shape != (height, width):
+            buffer = np.empty((height, width), dtype=np.uint8)
+            _scratch.image = buffer
+        return buffer
+
+    def _load(self) -> Optional[cv2.CascadeClassifier]:
+        try:
+            cascade = cv2.CascadeClassifier(self.cascade_path)
+            if cascade.empty():
+                raise Exception("Could not load face cascade classifier")
+        except Exception as e:
+            print(f"Error loading face cascade: {str(e)}")
+            self._available = False
+            return None
+        self._window = min(cascade.getOriginalWindowSize())
+        self._available = True
+        return cascade
+
+
+# Create a singleton instance for easy import
+face_detectors = DetectorPool()
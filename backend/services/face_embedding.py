@@ -0,0 +1,86 @@
+import numpy as np
+
+# Face crops are split into a GRID x GRID layout of cells, and each cell is
+# summarized by a rotation-invariant uniform LBP histogram (P=8 neighbours,
+# so 9 uniform patterns plus one bin for everything non-uniform)
+GRID = 4
+LBP_BINS = 10
+EMBEDDING_DIM = GRID * GRID * LBP_BINS
+
+# Each cell histogram is scaled to sum to this value so it fits in uint8
+CELL_MASS = 255
+
+# Neighbour offsets (dy, dx) in circular order, starting at the top-left
+_NEIGHBOURS = ((-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1))
+
+
+def _riu2_table() -> np.ndarray:
+    """Map each 8-bit LBP code to its rotation-invariant uniform bin."""
+    table = np.empty(256, dtype=np.intp)
+    for code in range(256):
+        bits = [(code >> i) & 1 for i in range(8)]
+        transitions = sum(bits[i] != bits[(i + 1) % 8] for i in range(8))
+        table[code] = sum(bits) if transitions <= 2 else LBP_BINS - 1
+    return table
+
+
+_RIU2 = _riu2_table()
+
+
+def lbp_codes(faces: np.ndarray) -> np.ndarray:
+    """Compute 8-neighbour LBP codes for a (N, H, W) stack of grayscale crops."""
+    faces = np.asarray(faces)
+    height, width = faces.shape[-2:]
+    center = faces[:, 1:-1, 1:-1]
+    codes = np.zeros(center.shape, dtype=np.uint8)
+    for bit, (dy, dx) in enumerate(_NEIGHBOURS):
+        neighbour = faces[:, 1 + dy:height - 1 + dy, 1 + dx:width - 1 + dx]
+        codes |= (neighbour >= center).astype(np.uint8) << bit
+    return codes
+
+
+def _pool(faces: np.ndarray) -> np.ndarray:
+    """2x2 average pooling; LBP on raw pixels is dominated by sensor noise in flat regions."""
+    count, height, width = faces.shape
+    height, width = height - height % 2, width - width % 2
+    blocks = faces[:, :height, :width].reshape(count, height // 2, 2, width // 2, 2)
+    return blocks.mean(axis=(2, 4), dtype=np.float32)
+
+
+def embed_faces(faces) -> np.ndarray:
+    """
+    Turn a stack of grayscale face crops into compact LBP embeddings.
+
+    Args:
+        faces: Array of shape (N, H, W), or a list of (H, W) crops
+
+    Returns:
+        np.ndarray: uint8 array of shape (N, EMBEDDING_DIM)
+    """
+    faces = np.asarray(faces)
+    if faces.ndim == 2:
+        faces = faces[np.newaxis]
+    count = faces.shape[0]
+    if count == 0:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.uint8)
+
+    bins = _RIU2[lbp_codes(_pool(faces))]
+    height, width = bins.shape[1:]
+
+    # Cell index of every LBP pixel, combined with its bin into one flat
+    # histogram slot so all cells of all faces are counted in one bincount
+    cell_rows = (np.arange(height) * GRID) // height
+    cell_cols = (np.arange(width) * GRID) // width
+    cells = cell_rows[:, np.newaxis] * GRID + cell_cols[np.newaxis, :]
+    slots = (np.arange(count)[:, np.newaxis, np.newaxis] * (GRID * GRID) + cells) * LBP_BINS + bins
+    histograms = np.bincount(slots.ravel(), minlength=count * EMBEDDING_DIM)
+    histograms = histograms.reshape(count, GRID * GRID, LBP_BINS).astype(np.float64)
+
+    cell_sizes = np.bincount(cells.ravel(), minlength=GRID * GRID)[:, np.newaxis]
+    embeddings = np.rint(histograms * (CELL_MASS / cell_sizes))
+    return embeddings.reshape(count, EMBEDDING_DIM).astype(np.uint8)
+
+
+def embed_face(face: np.ndarray) -> np.ndarray:
+    """Embed a single (H, W) grayscale face crop."""
+    return embed_faces(face[np.newaxis])[0]
@@ -0,0 +1,157 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Optional
+
+from services.face_detector import face_detectors
+from services.face_id_service import FaceIDService
+from services.face_pipeline import cpu_share, set_enroll_workers
+
+
+class FacePoolBusy(Exception):
+    """Raised when the face pool is saturated or a task exceeds its deadline."""
+
+
+# Per-process service, created once by the pool initializer so each worker
+# preloads its detector pool a single time and keeps it warm
+_service = None
+
+
+def _init_worker(storage_path: str, processes: int) -> None:
+    global _service
+    # Each pool process runs its own enrollment threads and cascades; sized
+    # by the CPU count alone, the pool would start processes x CPUs of each
+    if "FACE_ENROLL_WORKERS" not in os.environ:
+        set_enroll_workers(cpu_share(processes))
+    if "FACE_DETECTOR_POOL_SIZE" not in os.environ:
+        face_detectors.size = cpu_share(processes)
+    _service = FaceIDService(storage_path)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _call(method: str, *args) -> Any:
+    return getattr(_service, method)(*args)
+
+
+class FaceWorkPool:
+    """
+    Bounded process pool for the CPU-bound face pipeline.
+
+    Base64 decoding, ``cv2.imdecode`` and cascade detection all run in worker
+    processes, so they never block the event loop serving other requests.
+    At most ``queue_depth`` tasks may be queued or running at once; beyond
+    that ``run`` fails fast with FacePoolBusy instead of letting latency grow
+    without bound. Tasks that take longer than ``timeout`` seconds also
+    raise FacePoolBusy.
+
+    When a worker dies the pool is broken: requests in flight get
+    FacePoolBusy, and the next request starts a new pool from a thread, so
+    the event loop keeps serving meanwhile.
+
+    Each worker preloads cascades and runs enrollment threads for its share
+    of the CPUs (cpu_count // workers, at least 1), not for the whole host.
+
+    Defaults come from the FACE_POOL_WORKERS, FACE_POOL_QUEUE_DEPTH and
+    FACE_POOL_TIMEOUT environment variables.
+    """
+
+    def __init__(self, workers: Optional[int] = None, queue_depth: Optional[int] = None,
+                 timeout: Optional[float] = None, storage_path: str = "face_data"):
+        self.workers = workers or int(os.environ.get("FACE_POOL_WORKERS", os.cpu_count() or 1))
+        self.queue_depth = queue_depth or int(os.environ.get("FACE_POOL_QUEUE_DEPTH", self.workers * 4))
+        self.timeout = timeout or float(os.environ.get("FACE_POOL_TIMEOUT", 30))
+        self.storage_path = storage_path
+        self._executor = None
+        self._in_flight = 0
+        # Guards the executor swap and the in-flight count
+        self._lock = threading.Lock()
+        # Lets one request restart a broken pool while the others wait
+        self._restart_lock = asyncio.Lock()
+
+    def start(self) -> None:
+        """Spawn the workers and wait until each one has preloaded its cascades."""
+        with self._lock:
+            if self._executor is not None:
+                return
+            # spawn rather than fork: forking a process that already runs
+            # OpenCV or event loop threads can deadlock the child
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.storage_path, self.workers),
+            )
+            self._executor = executor
+        for future in [executor.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, method: str, *args) -> Any:
+        """Run a FaceIDService method in the pool and await its result."""
+        executor = self._executor
+        if executor is None:
+            executor = await self._restart()
+
+        with self._lock:
+            if self._in_flight >= self.queue_depth:
+                raise FacePoolBusy("Face service is busy, please retry")
+            self._in_flight += 1
+
+        try:
+            future = executor.submit(_call, method, *args)
+        except (BrokenProcessPool, RuntimeError):
+            # A worker died (or another request already shut this pool
+            # down); replace it so later requests can succeed
+            self._release()
+            self._discard(executor)
+            raise FacePoolBusy("Face service is restarting, please retry")
+
+        # The slot is only freed once the worker is done with the task, even
+        # if the caller has already given up on it
+        future.add_done_callback(lambda _: self._release())
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise FacePoolBusy(f"Face processing timed out after {self.timeout:g}s")
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise FacePoolBusy("Face service is restarting, please retry")
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                # The caller itself was cancelled
+                raise
+            # Dropped by the shutdown of a broken pool before it ran
+            raise FacePoolBusy("Face service is restarting, please retry")
+
+    async def _restart(self) -> ProcessPoolExecutor:
+        """Start the pool in a thread, so spawning workers never blocks the event loop."""
+        async with self._restart_lock:
+            if self._executor is None:
+                await asyncio.get_running_loop().run_in_executor(None, self.start)
+            executor = self._executor
+        if executor is None:
+            raise FacePoolBusy("Face service is restarting, please retry")
+        return executor
+
+    def _discard(self, executor: ProcessPoolExecutor) -> None:
+        """Shut down a broken executor, unless another request has already replaced it."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
@@ -1,58 +1,93 @@
 import os
-import json
-import base64
 import cv2
 import numpy as np
-from typing import List, Dict, Tuple
-import io
-from datetime import datetime
+from typing import List, Dict, Optional, Tuple, Union
+from services.face_matcher import MATCH_THRESHOLD, mean_abs_diff
+from services.face_detector import face_detectors
+from services.face_decode import Frame, decode_gray
+from services.face_pipeline import map_frames
+from services.template_store import PackedTemplateStore
+from services.write_behind import STORE_FSYNC, WRITE_BEHIND, WriteBehindStore
+from services.template_budget import select_templates
 
 class FaceIDService:
+    # How far around the previous face box a stream frame is searched first,
+    # as a fraction of the box size on each side
+    ROI_MARGIN = 0.5
+
     def __init__(self, storage_path: str = "face_data"):
         self.storage_path = storage_path
         os.makedirs(storage_path, exist_ok=True)
+        self.template_store = PackedTemplateStore(storage_path, fsync=STORE_FSYNC)
+        if WRITE_BEHIND:
+            # Writes are acknowledged from memory and flushed in the background
+            self.template_store = WriteBehindStore(self.template_store)
         
-        # Load Haar Cascade for face detection
-        try:
-            self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-            if self.face_cascade.empty():
-                raise Exception("Could not load face cascade classifier")
-        except Exception as e:
-            print(f"Error loading face cascade: {str(e)}")
-            # Create a simple placeholder if OpenCV resources aren't available
-            self.face_cascade = None
+        # Preload this process's Haar cascades, shared with any other face code
+        face_detectors.warm_up()
             
-    def _decode_image(self, base64_image: str) -> np.ndarray:
-        """Decode a base64 image into an OpenCV image."""
+    def _decode_image(self, image_data: Union[str, bytes]) -> Optional[Frame]:
+        """
+        Decode a base64 string or raw encoded bytes straight to grayscale.
+
+        Large JPEGs are decoded at reduced resolution; the frame's ``scale``
+        records how much.
+        """
         try:
-            img_data = base64.b64decode(base64_image)
-            nparr = np.frombuffer(img_data, np.uint8)
-            return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            return decode_gray(image_data)
         except Exception as e:
             print(f"Error decoding image: {str(e)}")
             return None
     
-    def _process_face(self, image: np.ndarray) -> np.ndarray:
-        """Detect and extract a face from an image."""
-        if image is None or self.face_cascade is None:
+    def _process_face(self, frame: Optional[Frame]) -> np.ndarray:
+        """Detect and extract a face from a decoded frame."""
+        if frame is None:
             return None
-            
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        box = self._detect_face(frame)
+        if box is None:
+            return None
+        return self._crop_face(frame, box)
+
+    def _detect_face(self, frame: Frame, roi: Optional[Tuple[int, int, int, int]] = None) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Find the largest face in a frame, in the frame's own pixel coordinates.
+
+        With ``roi`` (a box from a previous frame, in full-resolution pixels)
+        only the area around it is searched first; the whole frame is only
+        searched if the face has left that area.
+        """
+        gray, scale = frame
+        if roi is not None:
+            x, y, w, h = (int(v * scale) for v in roi)
+            margin_x, margin_y = int(w * self.ROI_MARGIN), int(h * self.ROI_MARGIN)
+            left, top = max(x - margin_x, 0), max(y - margin_y, 0)
+            right = min(x + w + margin_x, gray.shape[1])
+            bottom = min(y + h + margin_y, gray.shape[0])
+            if right > left and bottom > top:
+                faces = face_detectors.detect(gray[top:bottom, left:right], 1.3, 5, source_scale=scale)
+                if len(faces) > 0:
+                    (x, y, w, h) = max(faces, key=lambda face: face[2] * face[3])
+                    return (int(x) + left, int(y) + top, int(w), int(h))
         
         # Detect faces
-        faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
+        faces = face_detectors.detect(gray, 1.3, 5, source_scale=scale)
         if len(faces) == 0:
             return None
             
         # Process the first (or largest) face
         (x, y, w, h) = max(faces, key=lambda face: face[2] * face[3])
+        return (int(x), int(y), int(w), int(h))
+
+    def _crop_face(self, frame: Frame, box: Tuple[int, int, int, int]) -> np.ndarray:
+        """Cut a detected face out of a frame as a 100x100 grayscale template."""
+        gray, scale = frame
+        (x, y, w, h) = box
         
-        # Apply zoom if face is small
+        # Apply zoom if face is small (sizes in full-resolution pixels)
         zoom_factor = 1
-        if w < 100 or h < 100:
+        if w < 100 * scale or h < 100 * scale:
             zoom_factor = 2
-        elif w < 150 or h < 150:
+        elif w < 150 * scale or h < 150 * scale:
             zoom_factor = 1.5
             
         if zoom_factor > 1:
@@ -73,47 +108,63 @@ class FaceIDService:
         # Resize to standard size
         face_img = cv2.resize(face_img, (100, 100))
         return face_img
+
+    def extract_face(self, image_data: Union[str, bytes]) -> Optional[np.ndarray]:
+        """Decode one enrollment frame and extract its face, or None if either step fails."""
+        return self._process_face(self._decode_image(image_data))
         
     def _save_face_data(self, user_id: str, face_encodings: List[np.ndarray]) -> None:
-        """Save face encodings to a file."""
-        # Create user directory if it doesn't exist
-        user_dir = os.path.join(self.storage_path, user_id)
-        os.makedirs(user_dir, exist_ok=True)
-        
-        # Save timestamp and metadata
-        metadata = {
-            "timestamp": datetime.now().isoformat(),
-            "image_count": len(face_encodings),
-            "user_id": user_id
-        }
-        
-        with open(os.path.join(user_dir, "metadata.json"), 'w') as f:
-            json.dump(metadata, f)
-            
-        # Save individual face images
-        for i, face in enumerate(face_encodings):
-            filename = f"face_{i}.png"
-            cv2.imwrite(os.path.join(user_dir, filename), face)
-        
+        """
+        Save face encodings to the packed template store.
+
+        With write-behind enabled this returns once the templates are
+        visible in memory; the store flushes them to disk shortly after.
+        """
+        self.template_store.put(user_id, face_encodings)
         print(f"Saved {len(face_encodings)} face encodings for user {user_id}")
             
-    def _load_face_data(self, user_id: str) -> List[np.ndarray]:
-        """Load face encodings from a file."""
-        user_dir = os.path.join(self.storage_path, user_id)
-        if not os.path.exists(user_dir):
-            return []
+    def _load_face_data(self, user_id: str) -> np.ndarray:
+        """Load face encodings as a zero-copy view of the template store."""
+        faces = self.template_store.get(user_id)
+        if faces is None:
+            faces = self._migrate_legacy_face_data(user_id)
+        return faces
+
+    def _legacy_user_dir(self, user_id: str) -> str:
+        return os.path.join(self.storage_path, user_id)
+
+    def _migrate_legacy_face_data(self, user_id: str) -> np.ndarray:
+        """Move a user's old per-file PNG templates into the template store."""
+        user_dir = self._legacy_user_dir(user_id)
+        if not os.path.isdir(user_dir):
+            return np.empty((0, 100, 100), dtype=np.uint8)
             
         faces = []
-        for filename in os.listdir(user_dir):
+        for filename in sorted(os.listdir(user_dir)):
             if filename.startswith("face_") and filename.endswith(".png"):
                 filepath = os.path.join(user_dir, filename)
                 face = cv2.imread(filepath, cv2.IMREAD_GRAYSCALE)
                 if face is not None:
                     faces.append(face)
-                    
-        return faces
+        
+        if not faces:
+            return np.empty((0, 100, 100), dtype=np.uint8)
             
-    def setup_face_id(self, user_id: str, images_data: List[str]) -> Dict:
+        self.template_store.put(user_id, faces)
+        self._remove_legacy_face_data(user_id)
+        return self.template_store.get(user_id)
+
+    def _remove_legacy_face_data(self, user_id: str) -> None:
+        user_dir = self._legacy_user_dir(user_id)
+        if not os.path.isdir(user_dir):
+            return
+        for filename in os.listdir(user_dir):
+            file_path = os.path.join(user_dir, filename)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        os.rmdir(user_dir)
+            
+    def setup_face_id(self, user_id: str, images_data: List[Union[str, bytes]]) -> Dict:
         """Setup Face ID for a user using multiple images."""
         if not images_data:
             return {
@@ -121,27 +172,34 @@ class FaceIDService:
                 "message": "No images provided"
             }
         
-        if self.face_cascade is None:
+        if not face_detectors.available:
             return {
                 "success": False,
                 "message": "Face detection is not available"
             }
             
-        # Process each image to extract faces
+        # Frames are decoded and detected in parallel; results keep their order
+        faces = map_frames(self.extract_face, images_data)
+        return self.finalize_enrollment(user_id, faces)
+
+    def finalize_enrollment(self, user_id: str, faces: List[Optional[np.ndarray]]) -> Dict:
+        """
+        Store the faces extracted from a user's enrollment frames.
+
+        ``faces`` holds one entry per frame, in capture order, with None for
+        frames where no face was found.
+        """
         processed_faces = []
+        frame_indices = []
         eyes_open_count = 0
         eyes_closed_count = 0
         
         # First half of images are with eyes open
-        for i, img_data in enumerate(images_data):
-            img = self._decode_image(img_data)
-            if img is None:
-                continue
-                
-            face = self._process_face(img)
+        for i, face in enumerate(faces):
             if face is not None:
                 processed_faces.append(face)
-                if i < len(images_data) // 2:
+                frame_indices.append(i)
+                if i < len(faces) // 2:
                     eyes_open_count += 1
                 else:
                     eyes_closed_count += 1
@@ -151,30 +209,37 @@ class FaceIDService:
                 "success": False,
                 "message": "No valid faces detected in the provided images"
             }
-            
+        
+        # Drop near-duplicate frames and cap the template count, so the
+        # per-user gallery stays bounded however many frames were sent
+        selection = select_templates(processed_faces)
+        
         # Save the processed faces
-        self._save_face_data(user_id, processed_faces)
+        self._save_face_data(user_id, [processed_faces[i] for i in selection.kept])
         
         return {
             "success": True,
             "message": f"Successfully processed {len(processed_faces)} images",
             "images_processed": len(processed_faces),
             "eyes_open_count": eyes_open_count,
-            "eyes_closed_count": eyes_closed_count
+            "eyes_closed_count": eyes_closed_count,
+            "templates_stored": len(selection.kept),
+            "duplicate_frames": [frame_indices[i] for i in selection.duplicates],
+            "over_budget_frames": [frame_indices[i] for i in selection.over_budget]
         }
         
-    def verify_face(self, user_id: str, image_data: str) -> Dict:
+    def verify_face(self, user_id: str, image_data: Union[str, bytes]) -> Dict:
         """Verify if a face matches the stored face data."""
         # Load stored face encodings
         stored_faces = self._load_face_data(user_id)
-        if not stored_faces:
+        if len(stored_faces) == 0:
             return {
                 "success": False,
                 "message": "No face data found for this user",
                 "verified": False
             }
             
-        if self.face_cascade is None:
+        if not face_detectors.available:
             return {
                 "success": False,
                 "message": "Face detection is not available",
@@ -182,15 +247,15 @@ class FaceIDService:
             }
             
         # Process the new image
-        img = self._decode_image(image_data)
-        if img is None:
+        frame = self._decode_image(image_data)
+        if frame is None:
             return {
                 "success": False,
                 "message": "Invalid image data",
                 "verified": False
             }
             
-        face = self._process_face(img)
+        face = self._process_face(frame)
         if face is None:
             return {
                 "success": False,
@@ -198,18 +263,62 @@ class FaceIDService:
                 "verified": False
             }
             
-        # Compare with stored faces
-        match_count = 0
-        min_diff = float('inf')
-        
-        for stored_face in stored_faces:
-            # Calculate the absolute difference between the images
-            diff = np.mean(cv2.absdiff(face, stored_face))
-            min_diff = min(min_diff, diff)
-            
-            # Low difference means the faces are similar
-            if diff < 20:  # Threshold can be adjusted
-                match_count += 1
+        return self._match_face(stored_faces, face)
+
+    def verify_frame(self, user_id: str, image_data: Union[str, bytes],
+                     roi: Optional[Tuple[int, int, int, int]] = None) -> Dict:
+        """
+        Verify one frame of a live camera stream.
+
+        Like verify_face, but a frame without a face is not an error, the
+        search starts from ``roi`` (the face box of the previous frame) and
+        the face box found is returned as ``box`` for the next frame.
+        """
+        stored_faces = self._load_face_data(user_id)
+        if len(stored_faces) == 0:
+            return {
+                "success": False,
+                "message": "No face data found for this user",
+                "verified": False
+            }
+            
+        if not face_detectors.available:
+            return {
+                "success": False,
+                "message": "Face detection is not available",
+                "verified": False
+            }
+            
+        frame = self._decode_image(image_data)
+        if frame is None:
+            return {
+                "success": False,
+                "message": "Invalid image data",
+                "verified": False
+            }
+            
+        box = self._detect_face(frame, roi)
+        if box is None:
+            return {
+                "success": True,
+                "face_detected": False,
+                "verified": False,
+                "box": None
+            }
+            
+        result = self._match_face(stored_faces, self._crop_face(frame, box))
+        result["face_detected"] = True
+        # Report the box in full-resolution pixels, whatever the decode reduction
+        result["box"] = [int(round(v / frame.scale)) for v in box]
+        return result
+
+    def _match_face(self, stored_faces: np.ndarray, face: np.ndarray) -> Dict:
+        """Score a 100x100 face against a user's stored templates."""
+        # Compare with all stored faces in a single vectorized pass;
+        # a low difference means the faces are similar
+        diffs = mean_abs_diff(stored_faces, face)
+        match_count = int(np.count_nonzero(diffs < MATCH_THRESHOLD))
+        min_diff = float(diffs.min()) if len(diffs) else float('inf')
                 
         # Determine if verified based on match count
         verified = match_count >= 5  # At least 5 matches required
@@ -225,20 +334,16 @@ class FaceIDService:
         
     def reset_face_id(self, user_id: str) -> Dict:
         """Reset Face ID data for a user."""
-        user_dir = os.path.join(self.storage_path, user_id)
-        if not os.path.exists(user_dir):
+        has_legacy_data = os.path.isdir(self._legacy_user_dir(user_id))
+        if user_id not in self.template_store and not has_legacy_data:
             return {
                 "success": False,
                 "message": "No Face ID data found for this user"
             }
             
-        # Remove all files in the user directory
         try:
-            for filename in os.listdir(user_dir):
-                file_path = os.path.join(user_dir, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-            os.rmdir(user_dir)
+            self.template_store.delete(user_id)
+            self._remove_legacy_face_data(user_id)
             
             return {
                 "success": True,
@@ -248,4 +353,4 @@ class FaceIDService:
             return {
                 "success": False,
                 "message": f"Error resetting Face ID data: {str(e)}"
-            } 
\ No newline at end of file
+            }
@@ -0,0 +1,501 @@
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Mean absolute pixel difference below which two 100x100 crops are
+# considered the same face
+MATCH_THRESHOLD = 20
+
+# Rows scored per NumPy pass; keeps the int16 scratch buffer around 80MB
+# for 100x100 templates no matter how large the gallery grows
+SCORE_CHUNK_ROWS = 4096
+
+# Elements of the (probes, rows, dim) difference tensor materialized per
+# pass when scoring several probes at once, about 32MB in int16
+BATCH_SCORE_ELEMENTS = 1 << 24
+
+# FaceGallery.nearest_users prefilters by hash from this many templates;
+# smaller galleries are always ranked exhaustively
+COARSE_MIN_ROWS = 4096
+# Templates kept by the Hamming prefilter: at least this many, or this
+# fraction of the gallery if larger
+COARSE_SHORTLIST_ROWS = 512
+COARSE_SHORTLIST_FRACTION = 0.02
+# Bits in the sign-projection hash of each template
+HASH_BITS = 64
+
+# Set bits in every byte value, for popcounts over the packed hashes
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def mean_abs_diff(templates: np.ndarray, probe: np.ndarray,
+                  chunk_rows: int = SCORE_CHUNK_ROWS) -> np.ndarray:
+    """
+    Score a probe against a stack of templates in one batched pass.
+
+    Equivalent to ``np.mean(cv2.absdiff(probe, t))`` for every template ``t``,
+    but computed over the whole matrix at once instead of one template at a
+    time.
+
+    Args:
+        templates: Array of shape (N, ...) holding N templates
+        probe: A single template with the same trailing shape
+        chunk_rows: Number of templates scored per vectorized pass
+
+    Returns:
+        np.ndarray: Float array of shape (N,) with the mean absolute difference
+    """
+    count = templates.shape[0]
+    rows = templates.reshape(count, -1)
+    flat_probe = probe.reshape(-1)
+    if rows.shape[1] != flat_probe.shape[0]:
+        raise ValueError("Probe shape does not match the template shape")
+
+    scores = np.empty(count, dtype=np.float64)
+    if count == 0:
+        return scores
+
+    if rows.dtype == np.uint8:
+        # Widen to int16 so the subtraction cannot wrap around
+        work_dtype = np.int16
+        flat_probe = flat_probe.astype(np.int16)
+    else:
+        work_dtype = np.float32
+        flat_probe = flat_probe.astype(np.float32)
+
+    for start in range(0, count, chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        diff = np.subtract(chunk, flat_probe, dtype=work_dtype)
+        np.abs(diff, out=diff)
+        scores[start:start + len(chunk)] = diff.sum(axis=1, dtype=np.float64)
+
+    scores /= rows.shape[1]
+    return scores
+
+
+def squared_l2(templates: np.ndarray, probe: np.ndarray,
+               chunk_rows: int = SCORE_CHUNK_ROWS) -> np.ndarray:
+    """
+    Squared L2 distance between a probe and every row of a stack of vectors.
+
+    Used for PCA projections, where the L2 distance is the meaningful one.
+    """
+    count = templates.shape[0]
+    rows = templates.reshape(count, -1)
+    flat_probe = probe.reshape(-1).astype(np.float32)
+    if rows.shape[1] != flat_probe.shape[0]:
+        raise ValueError("Probe shape does not match the template shape")
+
+    scores = np.empty(count, dtype=np.float64)
+    for start in range(0, count, chunk_rows):
+        diff = rows[start:start + chunk_rows] - flat_probe
+        scores[start:start + len(diff)] = np.einsum("ij,ij->i", diff, diff)
+    return scores
+
+
+def nearest_per_user(scores: np.ndarray, owners: np.ndarray, users: int) -> np.ndarray:
+    """Smallest score of each user's templates; inf for users with none scored."""
+    nearest = np.full(users, np.inf)
+    np.minimum.at(nearest, owners, scores)
+    return nearest
+
+
+def hamming_distances(codes: np.ndarray, probe_code: np.uint64) -> np.ndarray:
+    """Number of differing bits between each 64-bit code and the probe's, as uint8."""
+    differing = np.bitwise_xor(codes, probe_code)
+    return _POPCOUNT[differing.view(np.uint8)].reshape(len(codes), 8).sum(axis=1, dtype=np.uint8)
+
+
+def coarse_keep(rows: int) -> int:
+    """Templates the Hamming prefilter keeps out of ``rows``."""
+    return max(COARSE_SHORTLIST_ROWS, int(rows * COARSE_SHORTLIST_FRACTION))
+
+
+def hash_shortlist(distances: np.ndarray, owners: np.ndarray, keep: int) -> np.ndarray:
+    """
+    Indices of the ``keep`` rows with the smallest Hamming distances, ascending.
+
+    Rows tied at the cutoff go to the lowest owner first, then the earliest
+    row, so the selection is the same however the rows are split up.
+    """
+    if keep >= len(distances):
+        return np.arange(len(distances))
+    cutoff = np.partition(distances, keep - 1)[keep - 1]
+    below = np.flatnonzero(distances < cutoff)
+    tied = np.flatnonzero(distances == cutoff)
+    tied = tied[np.argsort(owners[tied], kind="stable")][:keep - len(below)]
+    return np.sort(np.concatenate([below, tied]))
+
+
+def mean_abs_diff_many(templates: np.ndarray, probes: np.ndarray,
+                       max_elements: int = BATCH_SCORE_ELEMENTS) -> np.ndarray:
+    """
+    Mean absolute difference between every probe and every template.
+
+    Returns a (P, N) matrix, scoring the templates in row blocks sized so the
+    broadcast difference tensor stays under ``max_elements``.
+    """
+    count = templates.shape[0]
+    rows = templates.reshape(count, -1)
+    flat_probes = probes.reshape(probes.shape[0], -1)
+    if rows.shape[1] != flat_probes.shape[1]:
+        raise ValueError("Probe shape does not match the template shape")
+
+    scores = np.empty((flat_probes.shape[0], count), dtype=np.float64)
+    if count == 0 or not len(flat_probes):
+        return scores
+
+    work_dtype = np.int16 if rows.dtype == np.uint8 else np.float32
+    flat_probes = flat_probes.astype(work_dtype)[:, np.newaxis, :]
+    block = max(1, max_elements // (flat_probes.shape[0] * rows.shape[1]))
+    for start in range(0, count, block):
+        chunk = rows[start:start + block]
+        diff = np.subtract(chunk[np.newaxis], flat_probes, dtype=work_dtype)
+        np.abs(diff, out=diff)
+        scores[:, start:start + len(chunk)] = diff.sum(axis=2, dtype=np.float64)
+
+    scores /= rows.shape[1]
+    return scores
+
+
+def squared_l2_many(templates: np.ndarray, probes: np.ndarray,
+                    max_elements: int = BATCH_SCORE_ELEMENTS) -> np.ndarray:
+    """
+    Squared L2 distance between every probe and every template, as a (P, N) matrix.
+
+    Expands ``|t - p|^2`` as ``|t|^2 + |p|^2 - 2 t.p`` so the bulk of the work
+    is a matrix product, taken over row blocks sized so the widened block of
+    templates and its block of products stay under ``max_elements``.
+    """
+    count = templates.shape[0]
+    rows = templates.reshape(count, -1)
+    flat_probes = probes.reshape(probes.shape[0], -1).astype(np.float64)
+    if rows.shape[1] != flat_probes.shape[1]:
+        raise ValueError("Probe shape does not match the template shape")
+
+    scores = np.empty((flat_probes.shape[0], count), dtype=np.float64)
+    if count == 0 or not len(flat_probes):
+        return scores
+
+    probe_norms = np.einsum("ij,ij->i", flat_probes, flat_probes)[:, np.newaxis]
+    block = max(1, max_elements // (flat_probes.shape[0] + rows.shape[1]))
+    for start in range(0, count, block):
+        chunk = rows[start:start + block].astype(np.float64, copy=False)
+        out = scores[:, start:start + len(chunk)]
+        np.matmul(flat_probes, chunk.T, out=out)
+        out *= -2
+        out += np.einsum("ij,ij->i", chunk, chunk)[np.newaxis, :]
+        out += probe_norms
+    # Cancellation can leave tiny negatives for identical vectors
+    np.maximum(scores, 0, out=scores)
+    return scores
+
+
+class FaceGallery:
+    """
+    In-memory 1:N face gallery.
+
+    All templates live in one contiguous ``(N, D)`` matrix with a parallel
+    array of owner indices, so a probe is scored against every enrolled
+    template in a single NumPy pass and the per-user match counts come from
+    one ``np.bincount`` instead of a Python loop over users.
+
+    Users keep the order in which they were first added, which preserves the
+    tie-breaking of the original dict-based implementation.
+
+    ``metric`` is either ``"mad"`` (mean absolute difference) or ``"rms"``
+    (root-mean-square difference). For ``"rms"``, ``rms_length`` sets the
+    length the squared distance is averaged over; PCA projections pass the
+    original template size so scores stay in pixel units.
+
+    Every template also carries a 64-bit sign-projection hash (the signs of
+    its centered vector against 64 fixed random directions), which
+    ``nearest_users`` compares by Hamming distance to pick the templates
+    worth scoring in large galleries.
+    """
+
+    def __init__(self, template_shape: Tuple[int, ...] = (100, 100), dtype=np.uint8,
+                 metric: str = "mad", rms_length: Optional[int] = None):
+        if metric not in ("mad", "rms"):
+            raise ValueError(f"Unsupported metric: {metric}")
+        self.template_shape = tuple(template_shape)
+        self.dtype = np.dtype(dtype)
+        self.metric = metric
+        self._dim = int(np.prod(self.template_shape))
+        self.rms_length = rms_length or self._dim
+        self._lock = threading.Lock()
+        # Random hyperplanes are fixed per dimension so hashes are comparable
+        # across galleries; the center is taken from the first templates seen
+        self._planes = np.random.default_rng(self._dim).standard_normal((self._dim, HASH_BITS)).astype(np.float32)
+        self._center = None
+        # (templates, owners, user_ids, hashes) is swapped as a single tuple
+        # so readers never see a matrix that disagrees with its owner array
+        self._state = self._empty_state()
+        # Per-user row order and owner codes, rebuilt when state changes
+        self._groups = None
+
+    @classmethod
+    def from_encodings(cls, encodings_by_user: Dict[str, List[np.ndarray]],
+                       template_shape: Tuple[int, ...] = (100, 100),
+                       dtype=np.uint8) -> "FaceGallery":
+        """Build a gallery from a ``{user_id: [template, ...]}`` mapping."""
+        gallery = cls(template_shape, dtype)
+        gallery.load(encodings_by_user.items())
+        return gallery
+
+    def load(self, items: Iterable[Tuple[str, List[np.ndarray]]]) -> None:
+        """Replace the gallery contents with the given (user_id, templates) pairs."""
+        user_ids = []
+        blocks = []
+        owners = []
+        for user_id, templates in items:
+            block = self._as_rows(templates)
+            if not len(block):
+                continue
+            owners.append(np.full(len(block), len(user_ids), dtype=np.intp))
+            user_ids.append(user_id)
+            blocks.append(block)
+
+        if blocks:
+            rows = np.concatenate(blocks)
+            center = rows.mean(axis=0, dtype=np.float64).astype(np.float32)
+            state = (rows, np.concatenate(owners), tuple(user_ids), self._hash_rows(rows, center))
+        else:
+            center = None
+            state = self._empty_state()
+        with self._lock:
+            self._center = center
+            self._state = state
+
+    def add(self, user_id: str, templates: List[np.ndarray]) -> None:
+        """Append templates for a user, creating the user if needed."""
+        block = self._as_rows(templates)
+        if not len(block):
+            return
+        with self._lock:
+            rows, owners, user_ids, hashes = self._state
+            if user_id in user_ids:
+                code = user_ids.index(user_id)
+            else:
+                code = len(user_ids)
+                user_ids = user_ids + (user_id,)
+            if self._center is None:
+                self._center = block.mean(axis=0, dtype=np.float64).astype(np.float32)
+            self._state = (
+                np.concatenate([rows, block]),
+                np.concatenate([owners, np.full(len(block), code, dtype=np.intp)]),
+                user_ids,
+                np.concatenate([hashes, self._hash_rows(block)]),
+            )
+
+    def remove(self, user_id: str) -> None:
+        """Drop every template belonging to a user."""
+        with self._lock:
+            rows, owners, user_ids, hashes = self._state
+            if user_id not in user_ids:
+                return
+            code = user_ids.index(user_id)
+            keep = owners != code
+            owners = owners[keep]
+            # Close the gap left in the user index
+            owners[owners > code] -= 1
+            self._state = (
+                rows[keep],
+                owners,
+                user_ids[:code] + user_ids[code + 1:],
+                hashes[keep],
+            )
+
+    def replace(self, user_id: str, templates: List[np.ndarray]) -> None:
+        """Swap a user's templates for a new set."""
+        self.remove(user_id)
+        self.add(user_id, templates)
+
+    def __len__(self) -> int:
+        return len(self._state[0])
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._state[2]
+
+    @property
+    def user_ids(self) -> Tuple[str, ...]:
+        return self._state[2]
+
+    def templates_for(self, user_id: str) -> np.ndarray:
+        """Return the (count, *template_shape) templates of one user."""
+        rows, owners, user_ids, _ = self._state
+        if user_id not in user_ids:
+            return np.empty((0,) + self.template_shape, dtype=self.dtype)
+        selected = rows[owners == user_ids.index(user_id)]
+        return selected.reshape((-1,) + self.template_shape)
+
+    def score(self, probe: np.ndarray) -> np.ndarray:
+        """Distance from the probe to every template, in gallery order."""
+        return self._score(self._state[0], probe)
+
+    def _score(self, rows: np.ndarray, probe: np.ndarray) -> np.ndarray:
+        if self.metric == "rms":
+            return np.sqrt(squared_l2(rows, probe) / self.rms_length)
+        return mean_abs_diff(rows, probe)
+
+    def match_counts(self, probe: np.ndarray,
+                     threshold: float = MATCH_THRESHOLD) -> Dict[str, int]:
+        """Count, per user, how many templates are within ``threshold`` of the probe."""
+        rows, owners, user_ids, _ = self._state
+        if not user_ids:
+            return {}
+        matched = self._score(rows, probe) < threshold
+        counts = np.bincount(owners[matched], minlength=len(user_ids))
+        return dict(zip(user_ids, counts.tolist()))
+
+    def identify(self, probe: np.ndarray,
+                 threshold: float = MATCH_THRESHOLD) -> Tuple[Optional[str], int]:
+        """
+        Find the enrolled user with the most matching templates.
+
+        Returns:
+            Tuple of (user_id, match_count), or (None, 0) for an empty gallery
+        """
+        rows, owners, user_ids, _ = self._state
+        if not user_ids:
+            return None, 0
+        matched = self._score(rows, probe) < threshold
+        counts = np.bincount(owners[matched], minlength=len(user_ids))
+        # argmax returns the first maximum, i.e. the earliest enrolled user
+        best = int(np.argmax(counts))
+        return user_ids[best], int(counts[best])
+
+    def identify_among(self, probe: np.ndarray, user_ids: Iterable[str],
+                       threshold: float = MATCH_THRESHOLD) -> Tuple[Optional[str], int]:
+        """
+        ``identify`` over the templates of ``user_ids`` only.
+
+        Ties go to the user listed first. Users not in the gallery are
+        skipped, and (None, 0) is returned when none of them is.
+        """
+        state = self._state
+        rows = state[0]
+        order, starts, codes = self._grouped(state)
+        best_user, best_count = None, 0
+        for user_id in user_ids:
+            code = codes.get(user_id)
+            if code is None:
+                continue
+            user_rows = rows[order[starts[code]:starts[code + 1]]]
+            count = int(np.count_nonzero(self._score(user_rows, probe) < threshold))
+            if best_user is None or count > best_count:
+                best_user, best_count = user_id, count
+        return best_user, best_count
+
+    def identify_many(self, probes: np.ndarray,
+                      threshold: float = MATCH_THRESHOLD) -> List[Tuple[Optional[str], int]]:
+        """
+        ``identify`` for a batch of probes, scored as one (P, N) matrix.
+
+        Returns one (user_id, match_count) pair per probe, in probe order,
+        with the same tie-breaking as ``identify``.
+        """
+        rows, owners, user_ids, _ = self._state
+        count = len(probes)
+        if not user_ids:
+            return [(None, 0)] * count
+        if self.metric == "rms":
+            scores = np.sqrt(squared_l2_many(rows, probes) / self.rms_length)
+        else:
+            scores = mean_abs_diff_many(rows, probes)
+        matched = scores < threshold
+
+        # One bincount over (probe, user) pairs gives every per-probe tally
+        users = len(user_ids)
+        pairs = np.arange(count)[:, np.newaxis] * users + owners[np.newaxis, :]
+        counts = np.bincount(pairs[matched], minlength=count * users).reshape(count, users)
+        best = np.argmax(counts, axis=1)
+        return [(user_ids[b], int(counts[i, b])) for i, b in enumerate(best)]
+
+    def partition(self, shard_of_user: Callable[[str], int], shards: Iterable[int]):
+        """
+        Split the gallery into shards of whole users.
+
+        Returns the user ids of the snapshot that was split, in gallery
+        order, and ``{shard: (templates, owners, user_ids, hashes)}`` for
+        each of ``shards``, where owners index into that shard's own user_ids.
+        """
+        rows, owners, user_ids, hashes = self._state
+        user_shards = np.array([shard_of_user(user_id) for user_id in user_ids], dtype=np.intp)
+        row_shards = user_shards[owners]
+        parts = {}
+        for shard in shards:
+            members = np.flatnonzero(user_shards == shard)
+            local = np.full(len(user_ids), -1, dtype=np.intp)
+            local[members] = np.arange(len(members))
+            mask = row_shards == shard
+            parts[shard] = (rows[mask], local[owners[mask]], tuple(user_ids[i] for i in members), hashes[mask])
+        return user_ids, parts
+
+    def nearest_users(self, probe: np.ndarray, limit: int) -> List[str]:
+        """
+        The ``limit`` users whose closest template is nearest the probe, nearest first.
+
+        This only ranks; no threshold is applied, so it suits shortlisting
+        candidates for an exact check. Ties keep gallery order. Galleries of
+        COARSE_MIN_ROWS templates or more only score the templates whose
+        hashes are nearest the probe's.
+        """
+        state = self._state
+        rows, owners, user_ids, _ = state
+        if not user_ids:
+            return []
+        if len(rows) >= COARSE_MIN_ROWS:
+            kept = self._hash_shortlist(state, probe)
+            rows, owners = rows[kept], owners[kept]
+        nearest = nearest_per_user(self._score(rows, probe), owners, len(user_ids))
+        order = np.argsort(nearest, kind="stable")[:limit]
+        return [user_ids[code] for code in order.tolist() if np.isfinite(nearest[code])]
+
+    def probe_hash(self, probe: np.ndarray) -> np.uint64:
+        """The probe's 64-bit sign-projection hash, comparable with the templates' hashes."""
+        return self._hash_rows(self._as_rows([probe]))[0]
+
+    def _hash_shortlist(self, state, probe: np.ndarray) -> np.ndarray:
+        """Indices of the templates whose hashes are nearest the probe's."""
+        rows, owners, _, hashes = state
+        distances = hamming_distances(hashes, self.probe_hash(probe))
+        return hash_shortlist(distances, owners, coarse_keep(len(rows)))
+
+    def _grouped(self, state) -> Tuple[np.ndarray, np.ndarray, Dict[str, int]]:
+        """Row indices sorted by owner, where each owner's run starts, and each user's owner code."""
+        groups = self._groups
+        if groups is None or groups[0] is not state:
+            owners, user_ids = state[1], state[2]
+            order = np.argsort(owners, kind="stable")
+            starts = np.searchsorted(owners[order], np.arange(len(user_ids) + 1))
+            groups = (state, order, starts, {user_id: code for code, user_id in enumerate(user_ids)})
+            self._groups = groups
+        return groups[1], groups[2], groups[3]
+
+    def _hash_rows(self, rows: np.ndarray, center: Optional[np.ndarray] = None) -> np.ndarray:
+        """64-bit sign-projection hashes of a block of rows."""
+        if not len(rows):
+            return np.empty(0, dtype=np.uint64)
+        centered = rows.astype(np.float32) - (self._center if center is None else center)
+        bits = (centered @ self._planes) > 0
+        return np.packbits(bits, axis=1).view(np.uint64).reshape(-1)
+
+    def _empty_state(self):
+        return (
+            np.empty((0, self._dim), dtype=self.dtype),
+            np.empty(0, dtype=np.intp),
+            (),
+            np.empty(0, dtype=np.uint64),
+        )
+
+    def _as_rows(self, templates) -> np.ndarray:
+        if isinstance(templates, np.ndarray):
+            block = templates
+        else:
+            templates = list(templates)
+            if not templates:
+                return np.empty((0, self._dim), dtype=self.dtype)
+            block = np.stack(templates)
+        return np.ascontiguousarray(block, dtype=self.dtype).reshape(-1, self._dim)
@@ -0,0 +1,67 @@
+import base64
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Sequence, TypeVar, Union
+
+import numpy as np
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Threads used to process the frames of one enrollment; 1 disables the
+# parallel mode. OpenCV releases the GIL in imdecode and detectMultiScale,
+# so threads scale across cores without a process pool. FaceWorkPool
+# processes get their share of the CPUs instead (see cpu_share).
+ENROLL_WORKERS = int(os.environ.get("FACE_ENROLL_WORKERS", os.cpu_count() or 1))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def cpu_share(processes: int) -> int:
+    """CPUs each of ``processes`` processes doing face work side by side can keep busy."""
+    return max(1, (os.cpu_count() or 1) // max(1, processes))
+
+
+def set_enroll_workers(workers: int) -> None:
+    """Resize the enrollment threads; takes effect on the next map_frames call."""
+    global ENROLL_WORKERS, _executor
+    with _executor_lock:
+        ENROLL_WORKERS = workers
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ENROLL_WORKERS, thread_name_prefix="face-enroll")
+    return _executor
+
+
+def map_frames(func: Callable[[T], R], frames: Sequence[T]) -> List[R]:
+    """
+    Apply ``func`` to every frame across the enrollment threads.
+
+    Results come back in the same order as ``frames``; a frame that fails
+    should make ``func`` return None rather than raise.
+    """
+    if ENROLL_WORKERS <= 1 or len(frames) <= 1:
+        return [func(frame) for frame in frames]
+    return list(_get_executor().map(func, frames))
+
+
+def frame_buffer(image_data: Union[str, bytes, bytearray, memoryview]) -> np.ndarray:
+    """
+    Wrap an uploaded frame as the uint8 array ``cv2.imdecode`` reads.
+
+    Raw bytes from binary bodies and multipart parts are wrapped without a
+    copy; strings are the base64 frames sent by the JSON endpoints.
+    """
+    if isinstance(image_data, str):
+        image_data = base64.b64decode(image_data)
+    return np.frombuffer(image_data, np.uint8)
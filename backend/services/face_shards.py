@@ -0,0 +1,304 @@
+import multiprocessing
+import threading
+import zlib
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from services.face_matcher import (
+    COARSE_MIN_ROWS,
+    FaceGallery,
+    MATCH_THRESHOLD,
+    coarse_keep,
+    hamming_distances,
+    hash_shortlist,
+    mean_abs_diff,
+    nearest_per_user,
+    squared_l2,
+)
+
+
+def shard_of(user_id: str, shards: int) -> int:
+    """Stable shard number of a user; unlike hash() it is the same in every process."""
+    return zlib.crc32(user_id.encode("utf-8")) % shards
+
+
+def _shard_worker(conn) -> None:
+    """Serve identify requests for one shard until told to stop."""
+    segments = []
+    rows = owners = hashes = ranks = None
+    metric, rms_length = "mad", 1
+    while True:
+        message = conn.recv()
+        kind = message[0]
+        if kind == "map":
+            # Drop the views before closing, or close() fails on exported buffers
+            rows = owners = hashes = ranks = None
+            for segment in segments:
+                segment.close()
+            segments = []
+            spec = message[1]
+            if spec is not None:
+                rows_segment = shared_memory.SharedMemory(name=spec["rows"])
+                owners_segment = shared_memory.SharedMemory(name=spec["owners"])
+                hashes_segment = shared_memory.SharedMemory(name=spec["hashes"])
+                segments = [rows_segment, owners_segment, hashes_segment]
+                rows = np.ndarray(spec["shape"], dtype=spec["dtype"], buffer=rows_segment.buf)
+                owners = np.ndarray(spec["shape"][0], dtype=np.intp, buffer=owners_segment.buf)
+                hashes = np.ndarray(spec["shape"][0], dtype=np.uint64, buffer=hashes_segment.buf)
+                ranks = np.asarray(spec["ranks"], dtype=np.int64)
+                metric, rms_length = spec["metric"], spec["rms_length"]
+            conn.send(True)
+        elif kind == "identify":
+            _, probe, threshold = message
+            conn.send(_best_match(rows, owners, ranks, probe, threshold, metric, rms_length))
+        elif kind == "hashes":
+            _, probe_code, keep = message
+            conn.send(_nearest_hashes(owners, hashes, ranks, probe_code, keep))
+        elif kind == "nearest":
+            _, probe, limit, selected = message
+            if selected is not None and rows is not None:
+                conn.send(_nearest(rows[selected], owners[selected], ranks, probe, limit, metric, rms_length))
+            else:
+                conn.send(_nearest(rows, owners, ranks, probe, limit, metric, rms_length))
+        elif kind == "stop":
+            rows = owners = hashes = None
+            for segment in segments:
+                segment.close()
+            return
+
+
+def _scores(rows, probe, metric, rms_length) -> np.ndarray:
+    if metric == "rms":
+        return np.sqrt(squared_l2(rows, probe) / rms_length)
+    return mean_abs_diff(rows, probe)
+
+
+def _best_match(rows, owners, ranks, probe, threshold, metric, rms_length) -> Optional[Tuple[int, int, int]]:
+    """The shard's best (match_count, global rank, local user) for a probe."""
+    if rows is None or not len(ranks):
+        return None
+    scores = _scores(rows, probe, metric, rms_length)
+    counts = np.bincount(owners[scores < threshold], minlength=len(ranks))
+    best = counts.max()
+    # Among equal counts the earliest enrolled user wins, as in FaceGallery.identify
+    tied = np.flatnonzero(counts == best)
+    local = int(tied[np.argmin(ranks[tied])])
+    return int(best), int(ranks[local]), local
+
+
+def _nearest_hashes(owners, hashes, ranks, probe_code, keep) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The shard's ``keep`` templates nearest the probe by hash, as (distances,
+    global ranks, local rows) in row order. The overall prefilter keeps a
+    subset of the union of these.
+    """
+    if hashes is None:
+        empty = np.empty(0, dtype=np.intp)
+        return np.empty(0, dtype=np.uint8), empty, empty
+    distances = hamming_distances(hashes, probe_code)
+    rows = hash_shortlist(distances, ranks[owners], keep)
+    return distances[rows], ranks[owners[rows]], rows
+
+
+def _nearest(rows, owners, ranks, probe, limit, metric, rms_length) -> List[Tuple[float, int, int]]:
+    """The shard's ``limit`` nearest users as (distance, global rank, local user), nearest first."""
+    if rows is None or not len(ranks):
+        return []
+    nearest = nearest_per_user(_scores(rows, probe, metric, rms_length), owners, len(ranks))
+    order = np.lexsort((ranks, nearest))[:limit]
+    return [(float(nearest[local]), int(ranks[local]), int(local))
+            for local in order.tolist() if np.isfinite(nearest[local])]
+
+
+class _Shard:
+    def __init__(self, index: int, context):
+        self.index = index
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_shard_worker, args=(child_conn,),
+                                       name=f"face-shard-{index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.segments: List[shared_memory.SharedMemory] = []
+        self.user_ids: Tuple[str, ...] = ()
+        self.rows = 0
+
+    def publish(self, rows: np.ndarray, owners: np.ndarray, user_ids: Tuple[str, ...],
+                hashes: np.ndarray, ranks: List[int], gallery: FaceGallery) -> None:
+        """Copy a shard into fresh shared memory and point the worker at it."""
+        old = self.segments
+        if len(rows):
+            rows_segment = shared_memory.SharedMemory(create=True, size=rows.nbytes)
+            owners_segment = shared_memory.SharedMemory(create=True, size=owners.nbytes)
+            hashes_segment = shared_memory.SharedMemory(create=True, size=hashes.nbytes)
+            np.ndarray(rows.shape, dtype=rows.dtype, buffer=rows_segment.buf)[:] = rows
+            np.ndarray(owners.shape, dtype=np.intp, buffer=owners_segment.buf)[:] = owners
+            np.ndarray(hashes.shape, dtype=np.uint64, buffer=hashes_segment.buf)[:] = hashes
+            self.segments = [rows_segment, owners_segment, hashes_segment]
+            spec = {
+                "rows": rows_segment.name,
+                "owners": owners_segment.name,
+                "hashes": hashes_segment.name,
+                "shape": rows.shape,
+                "dtype": rows.dtype.str,
+                "ranks": ranks,
+                "metric": gallery.metric,
+                "rms_length": gallery.rms_length,
+            }
+        else:
+            self.segments, spec = [], None
+        self.conn.send(("map", spec))
+        self.conn.recv()
+        self.user_ids = user_ids
+        self.rows = len(rows)
+        # The worker has switched over, so the previous generation can go
+        for segment in old:
+            segment.close()
+            segment.unlink()
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(("stop",))
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+
+class ShardedFaceSearch:
+    """
+    1:N identification spread over several local worker processes.
+
+    Users are partitioned across ``shards`` processes by a stable hash of
+    their id. Each shard's templates sit in shared memory written by this
+    process and mapped by the worker, so they are never pickled per query.
+    A query is scattered to every shard and each returns its best
+    (match_count, enrollment rank) candidate; the overall winner is the
+    highest count, ties going to the earliest enrolled user, which is
+    exactly what ``FaceGallery.identify`` returns for the same gallery.
+    ``nearest_users`` merges each shard's nearest users the same way, after
+    the same Hamming prefilter as ``FaceGallery.nearest_users`` once the
+    shards hold COARSE_MIN_ROWS templates between them.
+
+    ``sync`` republishes only the shards holding users that changed since
+    the last call. Queries are serialized, since each one already keeps
+    every shard busy.
+    """
+
+    def __init__(self, shards: int):
+        self.shards = shards
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: List[_Shard] = []
+        self._lock = threading.Lock()
+        self._ranks: Dict[str, int] = {}
+        self._next_rank = 0
+        self._gallery: Optional[FaceGallery] = None
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [_Shard(index, self._context) for index in range(self.shards)]
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()
+            self._workers = []
+
+    def sync(self, gallery: FaceGallery, changed_users: Optional[Iterable[str]] = None) -> None:
+        """
+        Publish the gallery's contents to the shards.
+
+        With ``changed_users``, only the shards owning those users are
+        republished; otherwise every shard is rebuilt from scratch.
+        """
+        with self._lock:
+            self.start()
+            if changed_users is None:
+                targets = range(self.shards)
+            else:
+                targets = {shard_of(user_id, self.shards) for user_id in changed_users}
+            shard_fn = lambda user_id: shard_of(user_id, self.shards)
+            user_ids, parts = gallery.partition(shard_fn, targets)
+            # Probes are hashed like the published templates
+            self._gallery = gallery
+
+            if changed_users is None:
+                self._ranks = {user_id: rank for rank, user_id in enumerate(user_ids)}
+                self._next_rank = len(user_ids)
+            else:
+                # Ranks must rise along the gallery order. Users only ever
+                # join at the end (a replaced user is removed and re-added),
+                # so any user ranked below the one before it has moved there
+                # and takes a fresh rank, like a new user
+                reranked = set()
+                previous = -1
+                for user_id in user_ids:
+                    rank = self._ranks.get(user_id)
+                    if rank is None or rank <= previous:
+                        rank = self._ranks[user_id] = self._next_rank
+                        self._next_rank += 1
+                        reranked.add(shard_fn(user_id))
+                    previous = rank
+                present = set(user_ids)
+                for user_id in [u for u in self._ranks if u not in present]:
+                    del self._ranks[user_id]
+                stale = reranked.difference(parts)
+                if stale:
+                    parts.update(gallery.partition(shard_fn, stale)[1])
+
+            for index, (rows, owners, shard_users, hashes) in parts.items():
+                ranks = [self._ranks[user_id] for user_id in shard_users]
+                self._workers[index].publish(rows, owners, shard_users, hashes, ranks, gallery)
+
+    def identify(self, probe: np.ndarray, threshold: float = MATCH_THRESHOLD) -> Tuple[Optional[str], int]:
+        """Scatter a probe to every shard and merge their best candidates."""
+        with self._lock:
+            for worker in self._workers:
+                worker.conn.send(("identify", probe, threshold))
+            best = None
+            for worker in self._workers:
+                candidate = worker.conn.recv()
+                if candidate is None:
+                    continue
+                count, rank, local = candidate
+                if best is None or count > best[0] or (count == best[0] and rank < best[1]):
+                    best = (count, rank, worker.user_ids[local])
+        if best is None:
+            return None, 0
+        return best[2], best[0]
+
+    def nearest_users(self, probe: np.ndarray, limit: int) -> List[str]:
+        """
+        Merge every shard's nearest users; the same ranking as
+        ``FaceGallery.nearest_users`` over the synced gallery.
+
+        From COARSE_MIN_ROWS templates a first round gathers each shard's
+        nearest templates by hash, keeps the overall nearest exactly as the
+        gallery's prefilter would, and only those are scored.
+        """
+        with self._lock:
+            selections = [None] * len(self._workers)
+            total = sum(worker.rows for worker in self._workers)
+            if total >= COARSE_MIN_ROWS:
+                probe_code = self._gallery.probe_hash(probe)
+                keep = coarse_keep(total)
+                for worker in self._workers:
+                    worker.conn.send(("hashes", probe_code, keep))
+                replies = [worker.conn.recv() for worker in self._workers]
+                distances, ranks, rows = (np.concatenate(column) for column in zip(*replies))
+                shards = np.repeat(np.arange(len(replies)), [len(reply[2]) for reply in replies])
+                kept = hash_shortlist(distances, ranks, keep)
+                for index in range(len(self._workers)):
+                    selections[index] = rows[kept[shards[kept] == index]]
+            for worker, selected in zip(self._workers, selections):
+                worker.conn.send(("nearest", probe, limit, selected))
+            candidates = []
+            for worker in self._workers:
+                for distance, rank, local in worker.conn.recv():
+                    candidates.append((distance, rank, worker.user_ids[local]))
+        candidates.sort()
+        return [user_id for _, _, user_id in candidates[:limit]]
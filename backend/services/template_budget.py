@@ -0,0 +1,72 @@
+import os
+from typing import List, NamedTuple, Sequence
+
+import numpy as np
+
+from services.face_embedding import embed_faces
+from services.face_matcher import mean_abs_diff_many
+
+# Embedding distance below which two crops count as the same shot; the LBP
+# distance between noisy captures of one face is already several times
+# this, so only near-identical frames collapse
+DEDUP_DISTANCE = float(os.environ.get("FACE_DEDUP_DISTANCE", 1.0))
+
+# Templates kept per user at most
+MAX_TEMPLATES = int(os.environ.get("FACE_MAX_TEMPLATES", 30))
+
+# De-duplication never leaves fewer templates than this. Verification needs
+# more than 5 matching templates, so a user must keep comfortably more
+MIN_TEMPLATES = int(os.environ.get("FACE_MIN_TEMPLATES", 10))
+
+
+class TemplateSelection(NamedTuple):
+    """Indices into the candidate faces, each list in capture order."""
+    kept: List[int]
+    duplicates: List[int]
+    over_budget: List[int]
+
+
+def select_templates(faces: Sequence[np.ndarray], max_templates: int = MAX_TEMPLATES,
+                     min_templates: int = MIN_TEMPLATES,
+                     dedup_distance: float = DEDUP_DISTANCE) -> TemplateSelection:
+    """
+    Pick a bounded, diverse set of enrollment templates.
+
+    Frames are walked in capture order and one whose LBP embedding lies
+    within ``dedup_distance`` of an already kept frame is dropped as a
+    duplicate, unless that would leave fewer than ``min_templates``. If more
+    than ``max_templates`` remain, farthest-point sampling keeps the ones
+    that spread furthest across the captured poses.
+    """
+    count = len(faces)
+    if count == 0:
+        return TemplateSelection([], [], [])
+
+    embeddings = embed_faces(faces)
+    distances = mean_abs_diff_many(embeddings, embeddings)
+
+    kept = [0]
+    duplicates = []
+    for index in range(1, count):
+        # Never drop so many that the rest could not reach min_templates
+        remaining = count - index
+        if len(kept) + remaining > min_templates and distances[index, kept].min() < dedup_distance:
+            duplicates.append(index)
+        else:
+            kept.append(index)
+
+    over_budget = []
+    if len(kept) > max_templates:
+        candidates = np.array(kept)
+        sub = distances[np.ix_(candidates, candidates)]
+        chosen = [0]
+        nearest = sub[0].copy()
+        while len(chosen) < max_templates:
+            pick = int(np.argmax(nearest))
+            chosen.append(pick)
+            np.minimum(nearest, sub[pick], out=nearest)
+        chosen_set = set(chosen)
+        over_budget = [int(candidates[i]) for i in range(len(candidates)) if i not in chosen_set]
+        kept = sorted(int(candidates[i]) for i in chosen_set)
+
+    return TemplateSelection(kept, duplicates, over_budget)
@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+
+class PackedTemplateStore:
+    """
+    Fixed-stride, memory-mapped storage for face templates.
+
+    Every template of every user is packed back to back into a single data
+    file, and a small JSON index maps each user id to the (start, count) run
+    of records that belongs to them. Reading a user is a zero-copy slice of
+    the memory map instead of one file open and one PNG decode per template.
+
+    Writes only ever append: re-enrolling a user appends a new run and points
+    the index at it, which leaves the old run as dead space. Once enough of
+    the file is dead it is compacted into a new generation of the data file,
+    and the index is switched over with an atomic rename.
+
+    The index is re-read whenever it changes on disk, so several processes
+    can share one store directory.
+    """
+
+    COMPACT_MIN_DEAD = 256  # never compact for fewer dead records than this
+    COMPACT_RATIO = 0.5  # compact once this fraction of records is dead
+    READ_RETRIES = 3  # index re-reads when a compaction removes the file being mapped
+
+    def __init__(self, directory: str, record_shape: Tuple[int, ...] = (100, 100),
+                 dtype=np.uint8, name: str = "templates", fsync: bool = True):
+        self.directory = directory
+        self.record_shape = tuple(record_shape)
+        self.dtype = np.dtype(dtype)
+        self.record_size = int(np.prod(self.record_shape)) * self.dtype.itemsize
+        self.name = name
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._index = {"generation": 0, "records": 0, "dead": 0, "users": {}}
+        self._index_stamp = None
+        self._map = None
+        self._map_key = None
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, f"{self.name}.idx.json")
+
+    def _data_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"{self.name}.{generation}.bin")
+
+    def get(self, user_id: str) -> Optional[np.ndarray]:
+        """Return a read-only view of a user's templates, or None if not enrolled."""
+        with self._lock:
+            self._refresh_index()
+            for attempt in range(self.READ_RETRIES):
+                entry = self._index["users"].get(user_id)
+                if entry is None:
+                    return None
+                try:
+                    records = self._records()
+                    break
+                except FileNotFoundError:
+                    # Another process compacted between our index read and the
+                    # map, and removed the generation that index named; its
+                    # new index already points at the file that replaced it
+                    if attempt == self.READ_RETRIES - 1:
+                        raise
+                    self._index_stamp = None
+                    self._refresh_index()
+            return records[entry["start"]:entry["start"] + entry["count"]]
+
+    def metadata(self, user_id: str) -> Optional[Dict]:
+        """Return the index entry for a user (start, count, timestamp)."""
+        with self._lock:
+            self._refresh_index()
+            entry = self._index["users"].get(user_id)
+            return dict(entry) if entry is not None else None
+
+    def version(self, user_id: str) -> Optional[Tuple[int, int, int]]:
+        """
+        Stamp of a user's current templates, or None if not enrolled.
+
+        Every put or delete of the user changes it (compaction may too), so
+        it can key anything derived from those templates.
+        """
+        with self._lock:
+            self._refresh_index()
+            entry = self._index["users"].get(user_id)
+            if entry is None:
+                return None
+            return self._index["generation"], entry["start"], entry["count"]
+
+    def __contains__(self, user_id: str) -> bool:
+        with self._lock:
+            self._refresh_index()
+            return user_id in self._index["users"]
+
+    def users(self) -> List[str]:
+        with self._lock:
+            self._refresh_index()
+            return list(self._index["users"])
+
+    def put(self, user_id: str, templates) -> None:
+        """Store a new set of templates for a user, replacing any previous set."""
+        self.write_batch({user_id: templates})
+
+    def as_block(self, templates) -> np.ndarray:
+        """Templates as one contiguous (N,) + record_shape array of the store's dtype."""
+        block = np.ascontiguousarray(np.asarray(templates), dtype=self.dtype)
+        return block.reshape((-1,) + self.record_shape)
+
+    def write_batch(self, changes: Dict[str, Optional[np.ndarray]]) -> None:
+        """
+        Apply several users' changes with one append, one fsync and one index swap.
+
+        Each value replaces that user's templates, or forgets the user if None.
+        """
+        blocks = {user_id: self.as_block(templates)
+                  for user_id, templates in changes.items() if templates is not None}
+
+        with self._lock, self._file_lock():
+            self._refresh_index()
+            index = self._index
+            start = index["records"]
+
+            if blocks:
+                with open(self._data_path(index["generation"]), "ab") as f:
+                    # Drop any partial record left behind by an interrupted write
+                    f.truncate(start * self.record_size)
+                    for block in blocks.values():
+                        f.write(block.tobytes())
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+
+            timestamp = datetime.now().isoformat()
+            position = start
+            for user_id in changes:
+                previous = index["users"].pop(user_id, None)
+                if previous is not None:
+                    index["dead"] += previous["count"]
+                block = blocks.get(user_id)
+                if block is not None:
+                    index["users"][user_id] = {
+                        "start": position,
+                        "count": len(block),
+                        "timestamp": timestamp,
+                    }
+                    position += len(block)
+            index["records"] = position
+            self._write_index()
+
+            if self._should_compact():
+                self._compact_locked()
+
+    def delete(self, user_id: str) -> bool:
+        """Forget a user's templates. Returns False if the user was not enrolled."""
+        with self._lock, self._file_lock():
+            self._refresh_index()
+            entry = self._index["users"].pop(user_id, None)
+            if entry is None:
+                return False
+            self._index["dead"] += entry["count"]
+            self._write_index()
+
+            if self._should_compact():
+                self._compact_locked()
+            return True
+
+    def compact(self) -> None:
+        """Rewrite the live records into a fresh data file, dropping dead space."""
+        with self._lock, self._file_lock():
+            self._refresh_index()
+            self._compact_locked()
+
+    def _should_compact(self) -> bool:
+        dead = self._index["dead"]
+        return dead >= self.COMPACT_MIN_DEAD and dead >= self._index["records"] * self.COMPACT_RATIO
+
+    def _compact_locked(self) -> None:
+        index = self._index
+        records = self._records()
+        old_path = self._data_path(index["generation"])
+        generation = index["generation"] + 1
+
+        users = {}
+        position = 0
+        with open(self._data_path(generation), "wb") as f:
+            for user_id, entry in index["users"].items():
+                f.write(records[entry["start"]:entry["start"] + entry["count"]].tobytes())
+                users[user_id] = dict(entry, start=position)
+                position += entry["count"]
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+        self._index = {"generation": generation, "records": position, "dead": 0, "users": users}
+        self._write_index()
+        self._map = None
+        self._map_key = None
+
+        # Readers that still map the old file keep it alive until they remap;
+        # one about to map it finds it gone and re-reads the index (see get)
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    def _records(self) -> np.ndarray:
+        """Memory map of every record in the current generation's data file."""
+        index = self._index
+        path = self._data_path(index["generation"])
+        count = index["records"]
+        if count == 0:
+            return np.empty((0,) + self.record_shape, dtype=self.dtype)
+
+        # Runs are append-only within a generation, so a map that already
+        # covers the requested records can be reused as is
+        if self._map is not None and self._map_key[0] == path and self._map_key[1] >= count:
+            return self._map
+        self._map = np.memmap(path, dtype=self.dtype, mode="r", shape=(count,) + self.record_shape)
+        self._map_key = (path, count)
+        return self._map
+
+    def _refresh_index(self) -> None:
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stamp == self._index_stamp:
+            return
+        with open(self.index_path) as f:
+            self._index = json.load(f)
+        self._index_stamp = stamp
+
+    def _write_index(self) -> None:
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+        stat = os.stat(self.index_path)
+        self._index_stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @contextmanager
+    def _file_lock(self):
+        """Serialize writers across processes sharing the store directory."""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, f"{self.name}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
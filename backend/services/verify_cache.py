@@ -0,0 +1,70 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple, Union
+
+
+def image_digest(image_data: Union[str, bytes]) -> bytes:
+    """Digest of a frame exactly as it was received (base64 text or raw bytes)."""
+    if isinstance(image_data, str):
+        image_data = image_data.encode("utf-8")
+    return hashlib.blake2b(image_data, digest_size=16).digest()
+
+
+class VerificationCache:
+    """
+    Short-lived memo of verification results, for clients that resend a frame.
+
+    Entries are keyed by the digest of the image bytes, the target user id
+    and a gallery version, so an enrollment or reset that changes the
+    version makes the old entries unreachable; they then age out. At most
+    ``max_entries`` results are kept, least recently used evicted first, and
+    none outlives ``ttl`` seconds.
+
+    Defaults come from the FACE_VERIFY_CACHE_TTL and FACE_VERIFY_CACHE_SIZE
+    environment variables; a TTL of 0 disables the cache.
+    """
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        self.ttl = ttl if ttl is not None else float(os.environ.get("FACE_VERIFY_CACHE_TTL", 10))
+        self.max_entries = max_entries or int(os.environ.get("FACE_VERIFY_CACHE_SIZE", 1024))
+        self._entries: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @staticmethod
+    def key(image_data: Union[str, bytes], user_id: Optional[str], version: Hashable) -> Tuple:
+        return image_digest(image_data), user_id, version
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        """Return the cached result for a key, or None if absent or expired."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() > expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Tuple, value: Any) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
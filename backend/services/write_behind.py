@@ -0,0 +1,146 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from services.template_store import PackedTemplateStore
+
+# Opt-in: enrollment and reset return before their templates reach disk,
+# and other pool workers do not see them until the next flush
+WRITE_BEHIND = os.environ.get("FACE_STORE_WRITE_BEHIND", "0") == "1"
+
+# fsync data and index files on every flush; 0 trades durability on power
+# loss for throughput (the index rename keeps the store consistent either way)
+STORE_FSYNC = os.environ.get("FACE_STORE_FSYNC", "1") != "0"
+
+
+class WriteBehindStore:
+    """
+    Write-behind front for a PackedTemplateStore.
+
+    ``put`` and ``delete`` only record the change in an in-memory overlay
+    and return; reads in this process see the overlay immediately. A
+    background writer waits ``flush_interval`` seconds after the first
+    pending change, then writes everything pending in one
+    ``write_batch``: one append, one fsync and one atomic index rename.
+    A crash before that loses at most the changes of the last interval,
+    and never leaves a half-written index.
+
+    The overlay is per process. With several FaceWorkPool workers sharing
+    one store directory, a frame handled by another worker only sees an
+    enrollment or reset once it has been flushed, and two workers writing
+    the same user inside one interval land in flush order. It is therefore
+    off unless FACE_STORE_WRITE_BEHIND=1, which only suits a single worker
+    process or deployments that accept that window.
+
+    Defaults come from the FACE_STORE_FLUSH_INTERVAL environment variable.
+    """
+
+    RETRY_DELAY = 1.0  # seconds before retrying a failed flush
+
+    def __init__(self, store: PackedTemplateStore, flush_interval: Optional[float] = None):
+        self.store = store
+        self.flush_interval = (flush_interval if flush_interval is not None
+                               else float(os.environ.get("FACE_STORE_FLUSH_INTERVAL", 0.05)))
+        # user_id -> (sequence, templates or None for a delete, timestamp)
+        self._pending: Dict[str, Tuple[int, Optional[np.ndarray], str]] = {}
+        self._sequence = 0
+        self._changed = threading.Condition()
+        # Held for a whole flush, so the writer and flush() never interleave
+        self._write_lock = threading.Lock()
+        self._writer = None
+        atexit.register(self.flush)
+
+    def get(self, user_id: str) -> Optional[np.ndarray]:
+        with self._changed:
+            pending = self._pending.get(user_id)
+        if pending is not None:
+            return pending[1]
+        return self.store.get(user_id)
+
+    def metadata(self, user_id: str) -> Optional[Dict]:
+        with self._changed:
+            pending = self._pending.get(user_id)
+        if pending is None:
+            return self.store.metadata(user_id)
+        _, templates, timestamp = pending
+        if templates is None:
+            return None
+        return {"start": None, "count": len(templates), "timestamp": timestamp, "pending": True}
+
+    def version(self, user_id: str):
+        with self._changed:
+            pending = self._pending.get(user_id)
+        if pending is None:
+            return self.store.version(user_id)
+        return None if pending[1] is None else ("pending", pending[0])
+
+    def __contains__(self, user_id: str) -> bool:
+        with self._changed:
+            pending = self._pending.get(user_id)
+        if pending is not None:
+            return pending[1] is not None
+        return user_id in self.store
+
+    def users(self) -> List[str]:
+        with self._changed:
+            pending = dict(self._pending)
+        users = [user_id for user_id in self.store.users() if user_id not in pending]
+        return users + [user_id for user_id, entry in pending.items() if entry[1] is not None]
+
+    def put(self, user_id: str, templates) -> None:
+        """Queue a user's new templates; they are readable here at once."""
+        block = self.store.as_block(templates).copy()
+        block.flags.writeable = False
+        self._queue(user_id, block)
+
+    def delete(self, user_id: str) -> bool:
+        """Queue forgetting a user. Returns False if the user was not enrolled."""
+        existed = user_id in self
+        self._queue(user_id, None)
+        return existed
+
+    def flush(self) -> None:
+        """Write everything pending now and wait until it is on disk."""
+        with self._write_lock:
+            self._write_pending()
+
+    def _queue(self, user_id: str, templates: Optional[np.ndarray]) -> None:
+        with self._changed:
+            self._sequence += 1
+            self._pending[user_id] = (self._sequence, templates, datetime.now().isoformat())
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name=f"{self.store.name}-writer",
+                                                daemon=True)
+                self._writer.start()
+            self._changed.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._changed:
+                while not self._pending:
+                    self._changed.wait()
+            # Let the changes of one interval gather into a single batch
+            time.sleep(self.flush_interval)
+            with self._write_lock:
+                try:
+                    self._write_pending()
+                except Exception as e:
+                    print(f"Error flushing {self.store.name} store: {str(e)}")
+                    time.sleep(self.RETRY_DELAY)
+
+    def _write_pending(self) -> None:
+        with self._changed:
+            batch = dict(self._pending)
+        if not batch:
+            return
+        self.store.write_batch({user_id: templates for user_id, (_, templates, _) in batch.items()})
+        with self._changed:
+            # Keep entries that were replaced while the batch was written
+            for user_id, (sequence, _, _) in batch.items():
+                if self._pending.get(user_id, (None,))[0] == sequence:
+                    del self._pending[user_id]